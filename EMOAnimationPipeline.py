@@ -24,7 +24,7 @@ TODO:
 1. Finish this
 """
 from animated_diff import AnimatedDiff
-import inspect, math
+import inspect, math, time
 from typing import Callable, List, Optional, Union
 from dataclasses import dataclass
 from PIL import Image
@@ -59,7 +59,9 @@ from magicanimate.pipelines.context import (
     get_total_steps
 )
 from magicanimate.utils.util import get_tensor_interpolation_method
-from Net import Wav2VecFeatureExtractor,SpeedEncoder
+from magicanimate.utils.reference_banks import IdentityBankCache, ReferenceBankSource
+from Net import Wav2VecFeatureExtractor,SpeedEncoder,WAV2VEC_MODEL_NAME
+from feature_stores import Wav2VecFeatureStore
 from accelerate import Accelerator
 from transformers import CLIPVisionModelWithProjection
 from omegaconf import OmegaConf
@@ -81,6 +83,98 @@ class AnimationPipelineOutput(BaseOutput):
     videos: Union[torch.Tensor, np.ndarray]
 
 
+def _resident_bytes():
+    # current RSS of the process (Linux), 0 where /proc is not available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _modules_of(component):
+    # the nn.Modules making up a component (the component itself or its module attributes, e.g. Wav2VecFeatureExtractor.model)
+    if isinstance(component, torch.nn.Module):
+        return [component]
+    return [value for value in vars(component).values() if isinstance(value, torch.nn.Module)]
+
+
+class ComponentRegistry:
+    """
+    Auxiliary models of the pipeline (wav2vec2, SpeedEncoder...), each built once on an explicit
+    device/dtype on first use and reused by every later call.
+
+    Each factory is called as factory(device, dtype). Load time, parameter memory and the
+    resident (RSS / CUDA allocated) memory growth of every load are kept in stats.
+    """
+    def __init__(self, device="cpu", dtype=torch.float32):
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self._factories = {}
+        self._components = {}
+        self.stats = {}
+
+    def register(self, name, factory, device=None, dtype=None):
+        self._factories[name] = (factory, device, dtype)
+
+    def __contains__(self, name):
+        return name in self._components
+
+    def get(self, name):
+        if name not in self._components:
+            factory, device, dtype = self._factories[name]
+            device = torch.device(device) if device is not None else self.device
+            dtype = dtype if dtype is not None else self.dtype
+
+            rss_before = _resident_bytes()
+            cuda_before = torch.cuda.memory_allocated(device) if device.type == "cuda" else 0
+            start = time.perf_counter()
+            component = factory(device, dtype)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            self._components[name] = component
+            self.stats[name] = {
+                "device": str(device),
+                "dtype": str(dtype),
+                "load_seconds": time.perf_counter() - start,
+                "parameter_bytes": sum(t.numel() * t.element_size() for m in _modules_of(component) for t in list(m.parameters()) + list(m.buffers())),
+                "rss_bytes": _resident_bytes() - rss_before,
+                "cuda_bytes": torch.cuda.memory_allocated(device) - cuda_before if device.type == "cuda" else 0,
+            }
+        return self._components[name]
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def preload(self, names=None):
+        # build everything up front (e.g. at service start) so the first request doesn't pay for it
+        for name in (names or list(self._factories)):
+            self.get(name)
+        return self
+
+    def to(self, device=None, dtype=None):
+        # move the already built components; later loads use the new device/dtype too
+        self.device = torch.device(device) if device is not None else self.device
+        self.dtype = dtype if dtype is not None else self.dtype
+        for name, component in self._components.items():
+            for module in _modules_of(component):
+                module.to(device=self.device, dtype=self.dtype)
+            if hasattr(component, "device"):
+                component.device = self.device
+            if hasattr(component, "dtype") and not isinstance(component, torch.nn.Module):
+                component.dtype = self.dtype
+            self.stats[name].update(device=str(self.device), dtype=str(self.dtype))
+        return self
+
+    def report(self):
+        lines = []
+        for name, stats in self.stats.items():
+            lines.append(f"{name}: {stats['load_seconds']:.2f}s on {stats['device']} ({stats['dtype']}), "
+                         f"params {stats['parameter_bytes'] / 2**20:.1f} MB, RSS +{stats['rss_bytes'] / 2**20:.1f} MB, "
+                         f"CUDA +{stats['cuda_bytes'] / 2**20:.1f} MB")
+        return "\n".join(lines)
+
+
 class EMOAnimationPipeline(DiffusionPipeline):
     _optional_components = []
 
@@ -160,12 +254,42 @@ class EMOAnimationPipeline(DiffusionPipeline):
         )
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
 
-         # Initialize Wav2Vec feature extractor and SpeedEncoder
-        self.feature_extractor = Wav2VecFeatureExtractor(model_name='facebook/wav2vec2-base-960h', device=self.device)
+        # Wav2Vec feature extractor and SpeedEncoder are built once, on first use, and reused by every call
         num_speed_buckets = 10
         speed_embedding_dim = 64
-        self.speed_encoder = SpeedEncoder(num_speed_buckets, speed_embedding_dim)
+        self.component_registry = ComponentRegistry(device=self.device)
+        self.component_registry.register("feature_extractor", lambda device, dtype: Wav2VecFeatureExtractor(model_name=WAV2VEC_MODEL_NAME, device=device, dtype=dtype))
+        self.component_registry.register("speed_encoder", lambda device, dtype: SpeedEncoder(num_speed_buckets, speed_embedding_dim).to(device=device, dtype=dtype).eval())
+        self.audio_features = None
+        self.identity_cache = None
+
+    def to(self, *args, **kwargs):
+        # the registry's components (built or not yet built) follow the pipeline's execution device
+        pipeline = super().to(*args, **kwargs)
+        self.component_registry.to(self.device)
+        return pipeline
+
+    @property
+    def feature_extractor(self) -> Wav2VecFeatureExtractor:
+        return self.component_registry.get("feature_extractor")
+
+    @property
+    def speed_encoder(self) -> SpeedEncoder:
+        return self.component_registry.get("speed_encoder")
+
+    def enable_audio_feature_store(self, cache_dir: str):
+        # Serve wav2vec2 features from an on-disk store instead of re-encoding the audio on every call
+        self.audio_features = Wav2VecFeatureStore(cache_dir, model_name=self.feature_extractor.model_name, frame_rate=self.feature_extractor.frame_rate)
+
+    def disable_audio_feature_store(self):
+        self.audio_features = None
 
+    def enable_identity_cache(self, cache_dir: Optional[str] = None, max_cached: int = 4):
+        # Reuse the appearance encoder's reference banks across calls with the same source image / resolution / timesteps
+        self.identity_cache = IdentityBankCache(cache_dir, max_cached=max_cached)
+
+    def disable_identity_cache(self):
+        self.identity_cache = None
 
     def enable_vae_slicing(self):
         self.vae.enable_slicing()
@@ -572,6 +696,8 @@ class EMOAnimationPipeline(DiffusionPipeline):
         reference_control_reader = None,
         source_image: str = None,
         decoder_consistency = None,
+        reference_timesteps: Optional[Union[int, List[int]]] = None,
+        reference_lookup: str = "nearest",
         audio: Optional[str] = None,
         head_rotation_speeds: Optional[List[float]] = None,
         **kwargs,
@@ -582,14 +708,17 @@ class EMOAnimationPipeline(DiffusionPipeline):
         - controlnet_conditioning_scale : conditioning scale for controlnet
         - init_latents                  : initial latents to begin with (used along with invert())
         - num_actual_inference_steps    : number of actual inference steps (while total steps is num_inference_steps) 
+        - reference_timesteps           : anchor timestep(s) to compute the reference banks at once, instead of running the appearance encoder every step
+        - reference_lookup              : "nearest" anchor or "interpolate" between anchors (with reference_timesteps)
         """
         controlnet = self.controlnet
-        feature_extractor = Wav2VecFeatureExtractor(model_name='facebook/wav2vec2-base-960h', device=self.device)
-        num_speed_buckets = 10
-        speed_embedding_dim = 64
-        speed_encoder = SpeedEncoder(num_speed_buckets, speed_embedding_dim)
+        feature_extractor = self.feature_extractor
+        speed_encoder = self.speed_encoder
 
-        if audio is not None:
+        if audio is not None and self.audio_features is not None:
+            audio_features = self.audio_features.clip_features(audio, m=2, n=2, build_fn=feature_extractor.hidden_states_from_mp4)
+            audio_features = torch.from_numpy(audio_features).flatten(1).to(device=self.device, dtype=torch.float32)
+        elif audio is not None:
             audio_features = feature_extractor.extract_features_from_mp4(audio, m=2, n=2)
         else:
             audio_features = None
@@ -685,14 +814,25 @@ class EMOAnimationPipeline(DiffusionPipeline):
             num_actual_inference_steps = num_inference_steps
         
         if isinstance(source_image, str):
-            ref_image_latents = self.images2latents(np.array(Image.open(source_image).resize((width, height)))[None, :], latents_dtype).cuda()
-        elif isinstance(source_image, np.ndarray):
-            ref_image_latents = self.images2latents(source_image[None, :], latents_dtype).cuda()
+            source_image = np.array(Image.open(source_image).resize((width, height)))
+        ref_image_latents = self.images2latents(source_image[None, :], latents_dtype).cuda()
         
         context_scheduler = get_context_scheduler(context_schedule)
-        
-
 
+        # Reference banks: anchor timesteps / identity cache / appearance encoder at every step
+        reference_banks = ReferenceBankSource(
+            reference_control_writer,
+            appearance_encoder,
+            ref_image_latents.repeat(context_batch_size * (2 if do_classifier_free_guidance else 1), 1, 1, 1),
+            text_embeddings,
+            timesteps.tolist(),
+            reference_timesteps=reference_timesteps,
+            lookup=reference_lookup,
+            identity_cache=self.identity_cache,
+            source_image=source_image,
+            resolution=(height, width),
+            extra=(appearance_encoder.config.get("_name_or_path", ""), repr(prompt), repr(negative_prompt), context_batch_size, do_classifier_free_guidance),
+        )
 
         # Denoising loop
         for i, t in tqdm(enumerate(timesteps), total=len(timesteps), disable=(rank!=0)):
@@ -708,12 +848,7 @@ class EMOAnimationPipeline(DiffusionPipeline):
                 (1, 1, latents.shape[2], 1, 1), device=latents.device, dtype=latents.dtype
             )
 
-            appearance_encoder(
-                ref_image_latents.repeat(context_batch_size * (2 if do_classifier_free_guidance else 1), 1, 1, 1),
-                t,
-                encoder_hidden_states=text_embeddings,
-                return_dict=False,
-            )
+            reference_banks.step(t)
             
             context_queue = list(context_scheduler(
                 0, num_inference_steps, latents.shape[2], context_frames, context_stride, 0
@@ -754,6 +889,8 @@ class EMOAnimationPipeline(DiffusionPipeline):
             for i in range(num_context_batches):
                 global_context.append(context_queue[i*context_batch_size: (i+1)*context_batch_size])
             
+            # the reader shares the writer's banks for every window of this step
+            reference_control_reader.update(reference_control_writer)
             for context in global_context[rank::world_size]:
                 # expand the latents if we are doing classifier free guidance
                 latent_model_input = (
@@ -771,8 +908,6 @@ class EMOAnimationPipeline(DiffusionPipeline):
                     b, f
                 )
                 
-                reference_control_reader.update(reference_control_writer)
-                
                 # predict the noise residual
                 pred = self.unet(
                     latent_model_input,
@@ -785,14 +920,14 @@ class EMOAnimationPipeline(DiffusionPipeline):
                     return_dict=False,
                 )[0]
                 
-                reference_control_reader.clear()
-                
                 pred_uc, pred_c = pred.chunk(2)
                 pred = torch.cat([pred_uc.unsqueeze(0), pred_c.unsqueeze(0)])
                 for j, c in enumerate(context):
                     noise_pred[:, :, c] = noise_pred[:, :, c] + pred[:, j]
                     counter[:, :, c] = counter[:, :, c] + 1
                     
+            reference_control_reader.clear()
+
             if is_dist_initialized:
                 noise_pred_gathered = [torch.zeros_like(noise_pred) for _ in range(world_size)]
                 if rank == 0:
@@ -822,6 +957,8 @@ class EMOAnimationPipeline(DiffusionPipeline):
             
             reference_control_writer.clear()
 
+        reference_banks.finish()
+
         interpolation_factor = 1
         latents = self.interpolate_latents(latents, interpolation_factor, device)
         # Post-processing
@@ -1,7 +1,17 @@
+import argparse
 import cv2
 from PIL import Image
 import json
+import multiprocessing
 import os
+import shutil
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+from clip_decode import ClipWindowReader, resolve_clip_source
+from manifest import ClipManifest
 
 # Your JSON data for the video clip
 clip_data = {
@@ -80,6 +90,141 @@ def extract_and_save_frames(video_path, images_folder):
     cap.release()
     print(f"Total frames extracted: {frame_count}")
 
-# Assuming your video is named 'M2Ohb0FAaJU_1.mp4' and located in the current directory
-video_path = 'M2Ohb0FAaJU_1.mp4'
-extract_and_save_frames(video_path,'./images_folder')
+# Parallel, resumable extraction of ./images_folder for a whole manifest.
+# Videos are sharded over a process pool; each worker decodes the clip window (cropped to the
+# bbox) in batches with clip_decode.ClipWindowReader and writes the batch of JPEGs from a small
+# thread pool. Finished videos are appended to a journal so a killed run picks up where it stopped.
+#
+# python ExtractFrames.py --json_file ./data/overfit.json --video_dir /path/to/35666 --images_folder ./images_folder --workers 8
+
+JOURNAL_FILENAME = "extract_journal.jsonl"
+
+
+def read_journal(journal_path):
+    done = set()
+    if os.path.exists(journal_path):
+        with open(journal_path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    done.add(json.loads(line)["video_id"])
+    return done
+
+
+def extract_clip_frames(task):
+    """
+    Decode one clip window and write its frames as <images_folder>/<video_id>/frame_XXXX.jpg.
+
+    The frames go to a .partial folder that is renamed when the clip is complete, so an
+    interrupted clip is never mistaken for a finished one. A clip that yields no frames (or fails
+    to decode) is reported with frames=0 and an "error" and left without a folder.
+    """
+    video_id, mp4_path, start_sec, end_sec, bbox, images_folder, size, batch_size, jpeg_quality = task
+    start = time.perf_counter()
+    result = {"video_id": video_id, "frames": 0, "worker": multiprocessing.current_process().name}
+
+    subfolder_path = os.path.join(images_folder, video_id)
+    partial_path = subfolder_path + ".partial"
+    shutil.rmtree(partial_path, ignore_errors=True)
+    os.makedirs(partial_path)
+
+    def write_frame(frame_num, frame_rgb):
+        frame_filename = os.path.join(partial_path, f"frame_{frame_num:04d}.jpg")
+        cv2.imwrite(frame_filename, cv2.cvtColor(frame_rgb, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+
+    frame_count = 0
+    try:
+        reader = ClipWindowReader(mp4_path, start_sec, end_sec, bbox, size=size)
+        with ThreadPoolExecutor(max_workers=4) as writers:
+            for batch in reader.iter_batches(batch_size):
+                list(writers.map(write_frame, range(frame_count, frame_count + len(batch)), batch))
+                frame_count += len(batch)
+        reader.close()
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    result["seconds"] = time.perf_counter() - start
+    if frame_count == 0:
+        result.setdefault("error", f"no frames decoded from {mp4_path} in [{start_sec}, {end_sec}]")
+        shutil.rmtree(partial_path, ignore_errors=True)
+        return result
+
+    shutil.rmtree(subfolder_path, ignore_errors=True)
+    os.replace(partial_path, subfolder_path)
+    result["frames"] = frame_count
+    return result
+
+
+def extract_dataset(json_file, video_dir, images_folder, workers=4, trim=True, width=None, height=None, batch_size=32, jpeg_quality=95, clip_filter=None):
+    """
+    Extract frames for every clip of a manifest (.json or .db) with a pool of worker processes.
+    """
+    manifest = ClipManifest.open(json_file)
+    os.makedirs(images_folder, exist_ok=True)
+    journal_path = os.path.join(images_folder, JOURNAL_FILENAME)
+    done = read_journal(journal_path)
+
+    size = (height, width) if width and height else None
+    tasks = []
+    for video_id in manifest.video_ids(**(clip_filter or {})):
+        if video_id in done:
+            continue
+        if trim:
+            # the manifest window/bbox is in {ytb_id}.mp4 time; a trimmed {video_id}.mp4 is taken whole
+            mp4_path, start_sec, end_sec, bbox = resolve_clip_source(video_dir, video_id, manifest.get(video_id))
+        else:
+            mp4_path, start_sec, end_sec, bbox = os.path.join(video_dir, f"{video_id}.mp4"), None, None, None
+        if not os.path.exists(mp4_path):
+            print(f"Skipping {video_id}: {mp4_path} not found")
+            continue
+        tasks.append((video_id, mp4_path, start_sec, end_sec, bbox, images_folder, size, batch_size, jpeg_quality))
+
+    print(f"{len(done)} clips already extracted, {len(tasks)} to go with {workers} workers")
+    if not tasks:
+        return
+
+    worker_frames = defaultdict(int)
+    worker_seconds = defaultdict(float)
+    total_frames = 0
+    start = time.perf_counter()
+    with Pool(processes=workers) as pool, open(journal_path, 'a') as journal:
+        for i, result in enumerate(pool.imap_unordered(extract_clip_frames, tasks)):
+            if result["frames"] == 0:
+                # not journaled, so the next run retries it
+                print(f"[{i + 1}/{len(tasks)}] WARNING {result['video_id']}: {result['error']}")
+                continue
+            # Only the parent writes the journal, one line per finished clip
+            journal.write(json.dumps(result) + "\n")
+            journal.flush()
+
+            worker_frames[result["worker"]] += result["frames"]
+            worker_seconds[result["worker"]] += result["seconds"]
+            total_frames += result["frames"]
+            elapsed = time.perf_counter() - start
+            print(f"[{i + 1}/{len(tasks)}] {result['video_id']}: {result['frames']} frames "
+                  f"({result['frames'] / max(result['seconds'], 1e-6):.1f} fps), overall {total_frames / elapsed:.1f} fps")
+
+    elapsed = time.perf_counter() - start
+    for worker in sorted(worker_frames):
+        print(f"{worker}: {worker_frames[worker]} frames, {worker_frames[worker] / max(worker_seconds[worker], 1e-6):.1f} fps")
+    print(f"Total: {total_frames} frames in {elapsed:.1f}s, {total_frames / max(elapsed, 1e-6):.1f} fps")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract frames for every clip of a CelebV-HQ manifest")
+    parser.add_argument("--json_file", type=str, default="./data/overfit.json", help="manifest .json or .db")
+    parser.add_argument("--video_dir", type=str, required=True)
+    parser.add_argument("--images_folder", type=str, default="./images_folder")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--no_trim", action="store_true", help="videos are already trimmed/cropped clips: extract every frame as is")
+    parser.add_argument("--width", type=int, default=None)
+    parser.add_argument("--height", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--jpeg_quality", type=int, default=95)
+    parser.add_argument("--clip_filter", type=json.loads, default=None,
+                        help='ClipManifest.video_ids filters as JSON, e.g. \'{"actions": ["talk"], "min_duration": 3}\'')
+    args = parser.parse_args()
+
+    extract_dataset(args.json_file, args.video_dir, args.images_folder, workers=args.workers, trim=not args.no_trim,
+                    width=args.width, height=args.height, batch_size=args.batch_size, jpeg_quality=args.jpeg_quality,
+                    clip_filter=args.clip_filter)
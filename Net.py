@@ -1,31 +1,35 @@
 import json
 import os
+import math
 from math import cos, sin, pi
-from typing import List, Tuple, Dict, Any
+from functools import partial
+from typing import List, Tuple, Dict, Any, Callable
 from camera import Camera
 import cv2
 import decord
-import librosa
 import mediapipe as mp
 import numpy as np
-import soundfile as sf
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.transforms as transforms
-from decord import VideoReader,AVReader
+from decord import VideoReader
 from diffusers import AutoencoderKL
 from diffusers.models.modeling_utils import ModelMixin
 from magicanimate.models.controlnet import UNet2DConditionModel
 from magicanimate.models.unet import UNet3DConditionModel
 from magicanimate.models.unet_controlnet import UNet3DConditionModel
-from moviepy.editor import VideoFileClip
 from PIL import Image
 from torch.utils.data import Dataset
 from torchvision.transforms import ToTensor
 from transformers import Wav2Vec2Model, Wav2Vec2Processor
 from diffusers.models.unets.unet_2d_blocks import CrossAttnDownBlock2D, CrossAttnUpBlock2D, DownBlock2D, UpBlock2D
 from models.motionmodule import VanillaTemporalModule
+from audio_io import load_audio
+from clip_decode import ClipWindowReader, clip_media_path, resolve_clip_source
+from frame_shards import FrameShardReader
+from manifest import ClipManifest
+from feature_stores import FaceTrack, FaceTrackStore, Wav2VecFeatureStore
 
 # Use decord's CPU or GPU context
 # For GPU: decord.gpu(0)
@@ -475,6 +479,7 @@ class EMOModel(ModelMixin):
         audio_embeds = self.wav2vec_feature_extractor(audio_features)
 
         # Compute face region mask
+        # pose_cond_fea keeps its [B, F, 1, H, W] full-resolution logits; FaceLocator.latent_mask is the latent-space variant
         face_region_mask = self.face_locator(ref_image)
         face_region_mask = face_region_mask.unsqueeze(1).repeat(1, num_frames, 1, 1, 1)
 
@@ -500,197 +505,223 @@ class EMOModel(ModelMixin):
         
 
 
+WAV2VEC_MODEL_NAME = 'facebook/wav2vec2-base-960h'
+
+
 class Wav2VecFeatureExtractor:
-    def __init__(self, model_name='facebook/wav2vec2-base-960h', device='cpu'):
+    def __init__(self, model_name=WAV2VEC_MODEL_NAME, device='cpu', dtype=torch.float32):
         self.model_name = model_name
         self.device = device
+        self.dtype = dtype
         self.processor = Wav2Vec2Processor.from_pretrained(model_name)
-        self.model = Wav2Vec2Model.from_pretrained(model_name).to(device)
-
-    def extract_features_from_wav(self, audio_path, m=2, n=2):
-            """
-            Extract audio features from a WAV file using Wav2Vec 2.0.
+        self.model = Wav2Vec2Model.from_pretrained(model_name).to(device=device, dtype=dtype)
+        # wav2vec2 emits one hidden state per conv_stride product of samples (320 -> 50 frames/s at 16 kHz)
+        self.frame_rate = self.processor.feature_extractor.sampling_rate / float(np.prod(self.model.config.conv_stride))
 
-            Args:
-                audio_path (str): Path to the WAV audio file.
-                m (int): The number of frames before the current frame to include.
-                n (int): The number of frames after the current frame to include.
-
-            Returns:
-                torch.Tensor: Features extracted from the audio for each frame.
-            """
-            # Load the audio file
-            waveform, sample_rate = sf.read(audio_path)
-
-            # Check if we need to resample
-            if sample_rate != self.processor.feature_extractor.sampling_rate:
-                waveform = librosa.resample(np.float32(waveform), orig_sr=sample_rate, target_sr=self.processor.feature_extractor.sampling_rate)
-                sample_rate = self.processor.feature_extractor.sampling_rate
+    def load_waveform(self, audio_path):
+        """
+        Decode the audio of a WAV/MP4 file in-process as a mono waveform at the processor sampling rate.
+        """
+        return load_audio(audio_path, target_sr=self.processor.feature_extractor.sampling_rate)
 
-            # Ensure waveform is a 1D array for a single-channel audio
-            if waveform.ndim > 1:
-                waveform = waveform.mean(axis=1)  # Taking mean across channels for simplicity
+    def hidden_states_from_waveform(self, waveform):
+        """
+        Run wav2vec2 over a mono waveform at the processor sampling rate.
 
-            # Process the audio to extract features
-            input_values = self.processor(waveform, sampling_rate=sample_rate, return_tensors="pt").input_values
-            input_values = input_values.to(self.device)
+        Returns:
+            torch.Tensor: last_hidden_state of shape [T, D], one row per wav2vec2 frame.
+        """
+        input_values = self.processor(waveform, sampling_rate=self.processor.feature_extractor.sampling_rate, return_tensors="pt").input_values
+        input_values = input_values.to(device=self.device, dtype=self.dtype)
 
-            # Pass the input_values to the model
-            with torch.no_grad():
-                hidden_states = self.model(input_values).last_hidden_state
+        with torch.no_grad():
+            hidden_states = self.model(input_values).last_hidden_state
 
-            num_frames = hidden_states.shape[1]
-            feature_dim = hidden_states.shape[2]
+        # features leave the extractor as float32 whatever the model runs in
+        return hidden_states[0].float()
 
-            # Concatenate nearby frame features
-            all_features = []
-            for f in range(num_frames):
-                start_frame = max(f - m, 0)
-                end_frame = min(f + n + 1, num_frames)
-                frame_features = hidden_states[0, start_frame:end_frame, :].flatten()
+    def receptive_field(self):
+        # Number of input samples behind one hidden state of the conv feature encoder (400 for wav2vec2-base)
+        samples = 1
+        for kernel, stride in reversed(list(zip(self.model.config.conv_kernel, self.model.config.conv_stride))):
+            samples = (samples - 1) * stride + kernel
+        return samples
 
-                # Add padding if necessary
-                if f - m < 0:
-                    front_padding = torch.zeros((m - f) * feature_dim, device=self.device)
-                    frame_features = torch.cat((front_padding, frame_features), dim=0)
-                if f + n + 1 > num_frames:
-                    end_padding = torch.zeros(((f + n + 1 - num_frames) * feature_dim), device=self.device)
-                    frame_features = torch.cat((frame_features, end_padding), dim=0)
+    def stream_hidden_states(self, waveform, chunk_seconds=20.0, margin_seconds=1.0, overlap='discard'):
+        """
+        Run wav2vec2 over a long waveform in overlapping chunks so model memory stays constant in the audio length.
 
-                all_features.append(frame_features)
+        Every chunk owns chunk_seconds of audio and sees margin_seconds of extra context on each side.
+        With overlap='discard' the margin frames are dropped; with overlap='crossfade' the 2 * margin
+        frames shared by neighbouring chunks are linearly blended.
 
-            all_features = torch.stack(all_features, dim=0)
-            return all_features
+        Args:
+            waveform (np.ndarray): Mono waveform at the processor sampling rate.
+            chunk_seconds (float): Audio owned by each chunk.
+            margin_seconds (float): Context added on each side of a chunk.
+            overlap (str): 'discard' or 'crossfade'.
 
+        Yields:
+            torch.Tensor: Consecutive [t, D] slices of last_hidden_state (on the CPU).
+        """
+        assert overlap in ('discard', 'crossfade'), "overlap must be 'discard' or 'crossfade'"
+        sampling_rate = self.processor.feature_extractor.sampling_rate
+        samples_per_frame = int(np.prod(self.model.config.conv_stride))
+        receptive_field = self.receptive_field()
+
+        # Normalize over the whole waveform once so chunks see the same input values as a full pass
+        input_values = self.processor(waveform, sampling_rate=sampling_rate, return_tensors="np").input_values[0]
+        num_samples = input_values.shape[0]
+        num_frames = int(self.model._get_feat_extract_output_lengths(torch.tensor(num_samples)))
+
+        hop = max(int(round(chunk_seconds * self.frame_rate)), 1)
+        margin = int(round(margin_seconds * self.frame_rate))
+        if overlap == 'crossfade':
+            assert hop >= 2 * margin, "crossfade needs chunk_seconds >= 2 * margin_seconds"
+
+        pending = None
+        for start in range(0, num_frames, hop):
+            lo = max(start - margin, 0)
+            hi = min(start + hop + margin, num_frames)
+
+            # Samples needed to produce hidden states lo..hi-1
+            chunk = input_values[lo * samples_per_frame:min((hi - 1) * samples_per_frame + receptive_field, num_samples)]
+            chunk = torch.from_numpy(np.ascontiguousarray(chunk)).unsqueeze(0).to(device=self.device, dtype=self.dtype)
+            with torch.no_grad():
+                features = self.model(chunk).last_hidden_state[0, :hi - lo].float().cpu()
+
+            last_chunk = start + hop >= num_frames
+            if overlap == 'discard':
+                yield features[start - lo:min(start + hop, num_frames) - lo]
+                continue
+
+            begin = 0
+            if pending is not None:
+                weight = torch.linspace(0, 1, pending.shape[0] + 2)[1:-1, None]
+                yield pending * (1 - weight) + features[:pending.shape[0]] * weight
+                begin = pending.shape[0]
+            end = hi - lo if last_chunk else start + hop - margin - lo
+            yield features[begin:end]
+            pending = None if last_chunk else features[end:]
+
+    def compare_streaming(self, audio_path, chunk_seconds=20.0, margin_seconds=1.0, overlap='discard'):
+        """
+        Report how far streamed hidden states deviate from a single full-sequence pass on a test clip.
 
-    def extract_features_from_mp4(self, video_path, m=2, n=2):
+        Returns:
+            dict: num_frames, max_abs_diff and mean_abs_diff between the two.
         """
-        Extract audio features from an MP4 file using Wav2Vec 2.0.
+        waveform = self.load_waveform(audio_path)
+        full = self.hidden_states_from_waveform(waveform).float().cpu()
+        streamed = torch.cat(list(self.stream_hidden_states(waveform, chunk_seconds, margin_seconds, overlap)), dim=0)
+        assert streamed.shape == full.shape, f"Streamed features {tuple(streamed.shape)} != full features {tuple(full.shape)}"
+
+        diff = (streamed - full).abs()
+        report = {"num_frames": full.shape[0], "max_abs_diff": diff.max().item(), "mean_abs_diff": diff.mean().item()}
+        print(f"wav2vec2 streaming ({overlap}, chunk {chunk_seconds}s, margin {margin_seconds}s): "
+              f"max |diff| {report['max_abs_diff']:.5f}, mean |diff| {report['mean_abs_diff']:.5f} over {report['num_frames']} frames")
+        return report
+
+    def stack_context(self, hidden_states, m=2, n=2, fps=None, frame_indices=None):
+        """
+        Concatenate each frame's features with the m frames before and n frames after it (zero padded at the edges).
+
+        The sequence is padded once and windowed with unfold, so no per-frame tensors are allocated.
 
         Args:
-            video_path (str): Path to the MP4 video file.
+            hidden_states (torch.Tensor): wav2vec2 features of shape [T, D].
             m (int): The number of frames before the current frame to include.
             n (int): The number of frames after the current frame to include.
+            fps (float): Target video frame rate. When given, rows are resampled from wav2vec2 frames to video frames.
+            frame_indices (List[int]): Only return these frames (video frames if fps is given, else wav2vec2 frames).
 
         Returns:
-            torch.Tensor: Features extracted from the audio for each frame.
+            torch.Tensor: Features of shape [T', (m + n + 1) * D].
         """
-        # Create the audio file path from the video file path
-        audio_path = os.path.splitext(video_path)[0] + '.wav'
+        num_frames, feature_dim = hidden_states.shape
 
-        # Check if the audio file already exists
-        if not os.path.exists(audio_path):
-            # Extract audio from video
-            video_clip = VideoFileClip(video_path)
-            video_clip.audio.write_audiofile(audio_path)
+        padded = F.pad(hidden_states, (0, 0, m, n))  # [T + m + n, D]
+        windows = padded.unfold(0, m + n + 1, 1).transpose(1, 2)  # [T, m + n + 1, D] view
 
-        # Load the audio file
-        waveform, sample_rate = sf.read(audio_path)
+        if fps is not None:
+            if frame_indices is None:
+                frame_indices = torch.arange(int(round(num_frames * fps / self.frame_rate)))
+            # Nearest wav2vec2 frame for every video frame
+            frame_indices = torch.as_tensor(frame_indices, dtype=torch.float64)
+            frame_indices = (frame_indices * self.frame_rate / fps).round().long().clamp_(0, num_frames - 1)
+        if frame_indices is not None:
+            windows = windows[torch.as_tensor(frame_indices, dtype=torch.long, device=windows.device)]
 
-        # Check if we need to resample
-        if sample_rate != self.processor.feature_extractor.sampling_rate:
-            waveform = librosa.resample(np.float32(waveform), orig_sr=sample_rate, target_sr=self.processor.feature_extractor.sampling_rate)
-            sample_rate = self.processor.feature_extractor.sampling_rate
+        return windows.reshape(windows.shape[0], (m + n + 1) * feature_dim)
 
-        # Ensure waveform is a 1D array for a single-channel audio
-        if waveform.ndim > 1:
-            waveform = waveform.mean(axis=1)  # Taking mean across channels for simplicity
-
-        # Process the audio to extract features
-        input_values = self.processor(waveform, sampling_rate=sample_rate, return_tensors="pt").input_values
-        input_values = input_values.to(self.device)
+    def extract_features_from_wav(self, audio_path, m=2, n=2, fps=None, chunk_seconds=None):
+        """
+        Extract audio features from a WAV file using Wav2Vec 2.0.
 
-        # Pass the input_values to the model
-        with torch.no_grad():
-            hidden_states = self.model(input_values).last_hidden_state
+        Args:
+            audio_path (str): Path to the WAV audio file.
+            m (int): The number of frames before the current frame to include.
+            n (int): The number of frames after the current frame to include.
+            fps (float): Optional video frame rate to resample the features to.
+            chunk_seconds (float): Stream the model over chunks of this length (bounded memory for long audio).
 
-        num_frames = hidden_states.shape[1]
-        feature_dim = hidden_states.shape[2]
+        Returns:
+            torch.Tensor: Features extracted from the audio for each frame.
+        """
+        waveform = self.load_waveform(audio_path)
+        if chunk_seconds is not None:
+            hidden_states = torch.cat(list(self.stream_hidden_states(waveform, chunk_seconds)), dim=0)
+        else:
+            hidden_states = self.hidden_states_from_waveform(waveform)
+        return self.stack_context(hidden_states, m, n, fps)
 
-        # Concatenate nearby frame features
-        all_features = []
-        for f in range(num_frames):
-            start_frame = max(f - m, 0)
-            end_frame = min(f + n + 1, num_frames)
-            frame_features = hidden_states[0, start_frame:end_frame, :].flatten()
+    def extract_features_from_mp4(self, video_path, m=2, n=2, fps=None, chunk_seconds=None):
+        """
+        Extract audio features from an MP4 file using Wav2Vec 2.0.
 
-            # Add padding if necessary
-            if f - m < 0:
-                front_padding = torch.zeros((m - f) * feature_dim, device=self.device)
-                frame_features = torch.cat((front_padding, frame_features), dim=0)
-            if f + n + 1 > num_frames:
-                end_padding = torch.zeros(((f + n + 1 - num_frames) * feature_dim), device=self.device)
-                frame_features = torch.cat((frame_features, end_padding), dim=0)
+        Args:
+            video_path (str): Path to the MP4 video file.
+            m (int): The number of frames before the current frame to include.
+            n (int): The number of frames after the current frame to include.
+            fps (float): Optional video frame rate to resample the features to.
+            chunk_seconds (float): Stream the model over chunks of this length (bounded memory for long audio).
 
-            all_features.append(frame_features)
+        Returns:
+            torch.Tensor: Features extracted from the audio for each frame.
+        """
+        return self.extract_features_from_wav(video_path, m, n, fps, chunk_seconds)
 
-        all_features = torch.stack(all_features, dim=0)
-        return all_features
-    
+    def hidden_states_from_mp4(self, video_path):
+        """
+        Run wav2vec2 once over the audio track of an MP4 file (build_fn for feature_stores.Wav2VecFeatureStore).
 
+        Args:
+            video_path (str): Path to the MP4 video file.
 
+        Returns:
+            np.ndarray: float32 last_hidden_state of shape [T, D], one row per wav2vec2 frame.
+        """
+        waveform = self.load_waveform(video_path)
+        return self.hidden_states_from_waveform(waveform).float().cpu().numpy()
 
-    def extract_features_for_frame(self, video_path, frame_index, m=2):
+    def extract_features_for_frame(self, video_path, frame_index, m=2, n=None, fps=None):
         """
         Extract audio features for a specific frame from an MP4 file using Wav2Vec 2.0.
 
         Args:
             video_path (str): Path to the MP4 video file.
             frame_index (int): The index of the frame to extract features for.
-            m (int): The number of frames before and after the current frame to include.
+            m (int): The number of frames before the current frame to include.
+            n (int): The number of frames after the current frame to include (defaults to m).
+            fps (float): Optional video frame rate; frame_index is then a video frame index.
 
         Returns:
-            torch.Tensor: Features extracted from the audio for the specified frame.
+            torch.Tensor: Features extracted from the audio for the specified frame, shape [1, (m + n + 1) * D].
         """
-        # Create the audio file path from the video file path
-        audio_path = os.path.splitext(video_path)[0] + '.wav'
-
-        # Check if the audio file already exists
-        if not os.path.exists(audio_path):
-            # Extract audio from video
-            video_clip = VideoFileClip(video_path)
-            video_clip.audio.write_audiofile(audio_path)
-
-        # Load the audio file
-        waveform, sample_rate = sf.read(audio_path)
-
-        # Check if we need to resample
-        if sample_rate != self.processor.feature_extractor.sampling_rate:
-            waveform = librosa.resample(np.float32(waveform), orig_sr=sample_rate, target_sr=self.processor.feature_extractor.sampling_rate)
-            sample_rate = self.processor.feature_extractor.sampling_rate
-
-        # Ensure waveform is a 1D array for a single-channel audio
-        if waveform.ndim > 1:
-            waveform = waveform.mean(axis=1)  # Taking mean across channels for simplicity
-
-        # Process the audio to extract features
-        input_values = self.processor(waveform, sampling_rate=sample_rate, return_tensors="pt").input_values
-        input_values = input_values.to(self.device)
-
-        # Pass the input_values to the model
-        with torch.no_grad():
-            hidden_states = self.model(input_values).last_hidden_state
-
-        num_frames = hidden_states.shape[1]
-        feature_dim = hidden_states.shape[2]
-
-        # Concatenate nearby frame features
-        all_features = []
-        start_frame = max(frame_index - m, 0)
-        end_frame = min(frame_index + m + 1, num_frames)
-        frame_features = hidden_states[0, start_frame:end_frame, :].flatten()
-        
-        # Add padding if necessary
-        if frame_index - m < 0:
-            front_padding = torch.zeros((m - frame_index) * feature_dim, device=self.device)
-            frame_features = torch.cat((front_padding, frame_features), dim=0)
-        if frame_index + m + 1 > num_frames:
-            end_padding = torch.zeros(((frame_index + m + 1) - num_frames) * feature_dim, device=self.device)
-            frame_features = torch.cat((frame_features, end_padding), dim=0)
-        
-        all_features.append(frame_features)
-        
-        return torch.stack(all_features)
+        n = m if n is None else n
+        waveform = self.load_waveform(video_path)
+        hidden_states = self.hidden_states_from_waveform(waveform)
+        return self.stack_context(hidden_states, m, n, fps, frame_indices=[frame_index])
     
     # This is a dummy example of a neural network module that might take the concatenated frame features
 class AudioFeatureModel(nn.Module):
@@ -723,7 +754,15 @@ class FaceLocator(nn.Module):
         self.final_conv = nn.Conv2d(64, 1, kernel_size=1)
         self.pool = nn.MaxPool2d(kernel_size=2, stride=2, padding=0)
 
-    def forward(self, images):
+    def forward(self, images, latent_resolution=False):
+        """
+        Args:
+            images (torch.Tensor): float32 [B, C, H, W].
+            latent_resolution (bool): Return the H/8 x W/8 logits as computed instead of upsampling them to H x W.
+
+        Returns:
+            torch.Tensor: mask logits [B, 1, H, W] (or [B, 1, H/8, W/8]).
+        """
         # Forward pass through the convolutional layers
         # Assert that images are of the correct type (floating-point)
         assert images.dtype == torch.float32, 'Images must be of type torch.float32'
@@ -744,59 +783,266 @@ class FaceLocator(nn.Module):
         logits = self.final_conv(x)  # Output logits directly, Shape: (B, 1, H/8, W/8)
         
         # No sigmoid or thresholding here because BCEWithLogitsLoss will handle it
+        if latent_resolution:
+            return logits
 
         # Upsample logits to the size of the original image
         logits_upsampled = F.interpolate(logits, size=(images.shape[2], images.shape[3]), mode='bilinear', align_corners=False)
         
         return logits_upsampled
 
+    def latent_mask(self, images, threshold=None):
+        """
+        Face mask in the VAE latent space (H/8 x W/8), shaped to broadcast over [B, F, C, h, w] latents.
+
+        Args:
+            images (torch.Tensor): float32 reference images [B, C, H, W].
+            threshold (float, optional): Binarize the probabilities at this value; soft sigmoid mask when None.
 
+        Returns:
+            torch.Tensor: [B, 1, 1, H/8, W/8] mask.
+        """
+        mask = torch.sigmoid(self.forward(images, latent_resolution=True))
+        if threshold is not None:
+            mask = (mask > threshold).to(mask.dtype)
+        return mask.unsqueeze(1)
 
+    @torch.no_grad()
+    def predict_clip(self, frames, batch_size=32, threshold=None):
+        """
+        Batched inference over a whole clip on the module's device (CPU by default), in chunks of batch_size frames.
 
+        Args:
+            frames (torch.Tensor): float32 [F, C, H, W].
+
+        Returns:
+            torch.Tensor: [F, 1, H/8, W/8] latent-resolution masks (soft, or binary with threshold).
+        """
+        was_training = self.training
+        self.eval()
+        device = next(self.parameters()).device
+        masks = []
+        for start in range(0, frames.shape[0], batch_size):
+            chunk = frames[start:start + batch_size].to(device)
+            masks.append(self.latent_mask(chunk, threshold)[:, 0])
+        self.train(was_training)
+        return torch.cat(masks, dim=0)
+
+
+
+
+
+class HeadPoseTracker:
+    """
+    Yaw/pitch/roll for a whole clip in one pass.
+
+    Intrinsics are cached per frame resolution and each solvePnP is warm-started from the
+    previous frame's extrinsics, so a clip costs one cheap refinement per frame instead of
+    an iterative solve from scratch.
+    """
+    # Same 3D reference points as FaceHelper.calculate_pose, in landmark order 1, 33, 61, 199, 263, 291
+    LANDMARK_IDS = [1, 33, 61, 199, 263, 291]
+    FACE_3D = np.array([[0, -1.126865, 7.475604], # 1
+                        [-4.445859, 2.663991, 3.173422], # 33
+                        [-2.456206, -4.342621, 4.283884], # 61
+                        [0, -9.403378, 4.264492], # 199
+                        [4.445859, 2.663991, 3.173422], # 263
+                        [2.456206, -4.342621, 4.283884]], dtype=np.float64) # 291
 
-class FaceHelper:
     def __init__(self):
+        self._intrinsics: Dict[Tuple[int, int], Tuple[np.ndarray, np.ndarray]] = {}
+
+    def intrinsics(self, height: int, width: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Pinhole camera in the same style as camera.Camera, scaled to the frame resolution
+        key = (height, width)
+        if key not in self._intrinsics:
+            focal_length = height * 1.28
+            internal_matrix = np.array([[focal_length, 0, width / 2],
+                                        [0, focal_length, height / 2],
+                                        [0, 0, 1]], dtype=np.float64)
+            distortion_matrix = np.zeros((4, 1), dtype=np.float64)
+            self._intrinsics[key] = (internal_matrix, distortion_matrix)
+        return self._intrinsics[key]
+
+    @staticmethod
+    def euler_angles(rot_vec: np.ndarray) -> Tuple[float, float, float]:
+        # Same convention as FaceHelper.calculate_pose
+        rmat = cv2.Rodrigues(rot_vec)[0]
+        P = np.hstack((rmat, np.zeros((3, 1), dtype=np.float64)))
+        eulerAngles = cv2.decomposeProjectionMatrix(P)[6]
+        yaw = eulerAngles[1, 0]
+        pitch = eulerAngles[0, 0]
+        roll = eulerAngles[2, 0]
+
+        if pitch < 0:
+            pitch = - 180 - pitch
+        elif pitch >= 0:
+            pitch = 180 - pitch
+
+        return -yaw, -pitch, roll
+
+    def solve(self, face2d: np.ndarray, height: int, width: int) -> np.ndarray:
+        """
+        Args:
+            face2d (np.ndarray): [F, 6, 2] pixel positions of LANDMARK_IDS, NaN for frames without a face.
+            height (int), width (int): Frame resolution the landmarks are expressed in.
+
+        Returns:
+            np.ndarray: [F, 3] (yaw, pitch, roll) in degrees, NaN for frames without a face.
+        """
+        camera_matrix, distortion_matrix = self.intrinsics(height, width)
+        poses = np.full((face2d.shape[0], 3), np.nan, dtype=np.float64)
+        rot_vec = trans_vec = None
+        for idx in range(face2d.shape[0]):
+            points = np.ascontiguousarray(face2d[idx], dtype=np.float64)
+            if np.isnan(points).any():
+                continue
+            if rot_vec is None:
+                success, rot_vec, trans_vec = cv2.solvePnP(self.FACE_3D, points, camera_matrix, distortion_matrix,
+                                                           flags=cv2.SOLVEPNP_ITERATIVE)
+            else:
+                success, rot_vec, trans_vec = cv2.solvePnP(self.FACE_3D, points, camera_matrix, distortion_matrix,
+                                                           rvec=rot_vec.copy(), tvec=trans_vec.copy(),
+                                                           useExtrinsicGuess=True, flags=cv2.SOLVEPNP_ITERATIVE)
+            if not success:
+                rot_vec = trans_vec = None
+                continue
+            poses[idx] = self.euler_angles(rot_vec)
+        return poses
+
+    def track(self, face_track: FaceTrack) -> np.ndarray:
+        # Poses for every frame of a stored track, computed once and cached on the track
+        if face_track.head_poses is None:
+            height, width = face_track.frame_size
+            face2d = face_track.landmarks_px(np.arange(len(face_track)), self.LANDMARK_IDS)
+            face_track.head_poses = self.solve(face2d, height, width)
+        return face_track.head_poses
+
+    @staticmethod
+    def velocities(poses: np.ndarray, previous_poses: np.ndarray) -> np.ndarray:
+        """
+        Per-frame head rotation speeds in the (roll, pitch, yaw) order of get_head_pose_velocities_at_frame.
+        Frames where either pose is missing get zero speed.
+        """
+        diff = (poses - previous_poses)[:, ::-1]  # (yaw, pitch, roll) -> (roll, pitch, yaw)
+        return np.nan_to_num(diff, nan=0.0).astype(np.float32)
+
+
+class FaceTrackingSession:
+    """
+    Detect-then-track face localization over consecutive frames of one video.
+
+    FaceMesh runs in video mode (it re-detects internally only when it loses the face) and the
+    face detector only runs every detect_every frames, when the mesh is lost, or when the mesh
+    extent jumps by more than max_shift (normalized) since the previous frame. In between, the
+    last detected box is carried along with the mesh extent (same scale and translation).
+
+    Args:
+        face_detection: MediaPipe FaceDetection to use for the (re)detections.
+        detect_every (int): Maximum number of frames between two detections.
+        max_shift (float): Mesh extent change (normalized centre/size) that forces a detection.
+    """
+    def __init__(self, face_detection, detect_every: int = 8, max_shift: float = 0.05):
+        self.face_detection = face_detection
+        self.face_mesh = mp.solutions.face_mesh.FaceMesh(static_image_mode=False, max_num_faces=1, min_detection_confidence=0.5, min_tracking_confidence=0.5)
+        self.detect_every = detect_every
+        self.max_shift = max_shift
+        self.anchor = None  # (box, score, mesh extent) of the last detection
+        self.previous_extent = None
+        self.since_detection = 0
+        self.frames = 0
+        self.detections = 0
+
+    def close(self):
+        self.face_mesh.close()
+
+    @property
+    def detection_rate(self) -> float:
+        return self.detections / self.frames if self.frames else 0.0
+
+    @staticmethod
+    def extent(landmarks: np.ndarray) -> np.ndarray:
+        # normalized (xmin, ymin, xmax, ymax) of the mesh
+        return np.array([landmarks[:, 0].min(), landmarks[:, 1].min(), landmarks[:, 0].max(), landmarks[:, 1].max()])
+
+    def needs_detection(self, extent: np.ndarray) -> bool:
+        if self.anchor is None or extent is None or self.since_detection >= self.detect_every:
+            return True
+        if self.previous_extent is None:
+            return True
+        # centre shift and size change of the mesh since the previous frame
+        return np.abs(extent - self.previous_extent).max() > self.max_shift
+
+    def process(self, frame_rgb: np.ndarray) -> Tuple[np.ndarray, float, np.ndarray]:
+        """
+        Returns:
+            Tuple: normalized (xmin, ymin, width, height) box (NaN if no face), detection score, [468, 3] landmarks (None if no mesh).
+        """
+        self.frames += 1
+        landmarks = None
+        mesh_results = self.face_mesh.process(frame_rgb)
+        if mesh_results.multi_face_landmarks:
+            landmarks = np.array([(lm.x, lm.y, lm.z) for lm in mesh_results.multi_face_landmarks[0].landmark[:468]], dtype=np.float32)
+        extent = self.extent(landmarks) if landmarks is not None else None
+
+        if self.needs_detection(extent):
+            self.detections += 1
+            self.since_detection = 0
+            self.anchor = None
+            box, score = np.full((4,), np.nan, dtype=np.float32), 0.0
+            detection_results = self.face_detection.process(frame_rgb)
+            if detection_results.detections:
+                detection = max(detection_results.detections, key=lambda d: d.score[0])
+                bboxC = detection.location_data.relative_bounding_box
+                box = np.array([bboxC.xmin, bboxC.ymin, bboxC.width, bboxC.height], dtype=np.float32)
+                score = float(detection.score[0])
+                if extent is not None:
+                    self.anchor = (box, score, extent)
+        else:
+            # map the detected box from the anchor mesh extent to the current one
+            anchor_box, score, anchor_extent = self.anchor
+            scale = (extent[2:] - extent[:2]) / np.maximum(anchor_extent[2:] - anchor_extent[:2], 1e-6)
+            xy = extent[:2] + (anchor_box[:2] - anchor_extent[:2]) * scale
+            box = np.concatenate([xy, anchor_box[2:] * scale]).astype(np.float32)
+
+        self.since_detection += 1
+        self.previous_extent = extent
+        return box, score, landmarks
+
+
+class FaceHelper:
+    def __init__(self, detect_every: int = 1, max_shift: float = 0.05):
         self.mp_face_detection = mp.solutions.face_detection
         self.mp_face_mesh = mp.solutions.face_mesh
         # Initialize FaceDetection once here
         self.face_detection = self.mp_face_detection.FaceDetection(model_selection=1, min_detection_confidence=0.5)
         self.face_mesh = self.mp_face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1, min_detection_confidence=0.5)
 
-        self.face_detection = self.mp_face_detection.FaceDetection(model_selection=1, min_detection_confidence=0.5)
-        self.face_mesh = self.mp_face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1, min_detection_confidence=0.5)
-
         self.HEAD_POSE_LANDMARKS = [33, 263, 1, 61, 291, 199]
+        self.pose_tracker = HeadPoseTracker()
+
+        # detect_every > 1: face tracks are built detect-then-track (see FaceTrackingSession)
+        self.detect_every = detect_every
+        self.max_shift = max_shift
+        self.detection_rate = None  # share of frames the detector ran on, for the last tracked video
     def __del__(self):
         self.face_detection.close()
         self.face_mesh.close()
 
     def generate_face_region_mask(self,frame_image, video_id=0,frame_idx=0):
         frame_np = np.array(frame_image.convert('RGB'))  # Ensure the image is in RGB
-        return self.generate_face_region_mask_np_image(video_id,frame_idx,frame_np)
+        return self.generate_face_region_mask_np_image(frame_np,video_id,frame_idx)
 
     def generate_face_region_mask_np_image(self,frame_np, video_id=0,frame_idx=0, padding=10):
-        # Convert from RGB to BGR for MediaPipe processing
-        frame_bgr = cv2.cvtColor(frame_np, cv2.COLOR_RGB2BGR)
-        height, width, _ = frame_bgr.shape
+        # frame_np is the decoded RGB frame, which is what MediaPipe expects: no color conversion
+        frame_rgb = np.ascontiguousarray(frame_np)
+        height, width, _ = frame_rgb.shape
 
         # Create a blank mask with the same dimensions as the frame
         mask = np.zeros((height, width), dtype=np.uint8)
 
-        # Optionally save a debug image
-        debug_image = mask
-        # Detect faces
-        detection_results = self.face_detection.process(frame_bgr)
-        if detection_results.detections:
-            for detection in detection_results.detections:
-                bboxC = detection.location_data.relative_bounding_box
-                xmin = int(bboxC.xmin * width)
-                ymin = int(bboxC.ymin * height)
-                bbox_width = int(bboxC.width * width)
-                bbox_height = int(bboxC.height * height)
-
-                # Draw a rectangle on the debug image for each detection
-                cv2.rectangle(debug_image, (xmin, ymin), (xmin + bbox_width, ymin + bbox_height), (0, 255, 0), 2)
-        # Check that detections are not None
+        # Detect faces (once) and fill a padded rectangle per detection
+        detection_results = self.face_detection.process(frame_rgb)
         if detection_results.detections:
             for detection in detection_results.detections:
                 bboxC = detection.location_data.relative_bounding_box
@@ -814,16 +1060,103 @@ class FaceHelper:
                 # Draw a white padded rectangle on the mask
                 mask[pad_ymin:pad_ymax, pad_xmin:pad_xmax] = 255
 
-               
-                # cv2.rectangle(debug_image, (pad_xmin, pad_ymin), 
-                            #   (pad_xmax, pad_ymax), (255, 255, 255), thickness=-1)
-                # cv2.imwrite(f'./temp/debug_face_mask_{video_id}-{frame_idx}.png', debug_image)
+                # cv2.imwrite(f'./temp/debug_face_mask_{video_id}-{frame_idx}.png', mask)
 
         return mask
 
+    def tracking_session(self) -> FaceTrackingSession:
+        return FaceTrackingSession(self.face_detection, self.detect_every, self.max_shift)
+
+    def detect_face_track(self, frames: np.ndarray, session: FaceTrackingSession = None) -> FaceTrack:
+        """
+        Run face detection and FaceMesh on every frame and pack the results, or detect-then-track
+        through session (consecutive frames of one video) when given.
+
+        Args:
+            frames (np.ndarray): RGB uint8 frames [F, H, W, 3].
+            session (FaceTrackingSession, optional): Tracking state carried across chunks of a video.
+
+        Returns:
+            FaceTrack: boxes, confidences and 468 mesh landmarks per frame.
+        """
+        num_frames, height, width, _ = frames.shape
+        boxes = np.full((num_frames, 4), np.nan, dtype=np.float32)
+        scores = np.zeros((num_frames,), dtype=np.float32)
+        landmarks = np.full((num_frames, 468, 3), np.nan, dtype=np.float32)
+
+        for idx in range(num_frames):
+            frame_rgb = np.ascontiguousarray(frames[idx])
+
+            if session is not None:
+                boxes[idx], scores[idx], frame_landmarks = session.process(frame_rgb)
+                if frame_landmarks is not None:
+                    landmarks[idx] = frame_landmarks
+                continue
+
+            detection_results = self.face_detection.process(frame_rgb)
+            if detection_results.detections:
+                # Keep the most confident face
+                detection = max(detection_results.detections, key=lambda d: d.score[0])
+                bboxC = detection.location_data.relative_bounding_box
+                boxes[idx] = (bboxC.xmin, bboxC.ymin, bboxC.width, bboxC.height)
+                scores[idx] = detection.score[0]
+
+            mesh_results = self.face_mesh.process(frame_rgb)
+            if mesh_results.multi_face_landmarks:
+                face_landmarks = mesh_results.multi_face_landmarks[0]
+                landmarks[idx] = [(lm.x, lm.y, lm.z) for lm in face_landmarks.landmark[:468]]
+
+        return FaceTrack(boxes, scores, landmarks, (height, width))
+
+    def build_face_track(self, mp4_path: str, chunk_size: int = 64) -> FaceTrack:
+        # Decode the whole video in chunks and track the face in every frame
+        video_reader = VideoReader(mp4_path, ctx=decord.cpu())
+        num_frames = len(video_reader)
+        session = self.tracking_session() if self.detect_every > 1 else None
+        tracks = []
+        for start in range(0, num_frames, chunk_size):
+            batch = video_reader.get_batch(list(range(start, min(start + chunk_size, num_frames))))
+            batch = batch.numpy() if isinstance(batch, torch.Tensor) else batch.asnumpy()
+            tracks.append(self.detect_face_track(batch, session))
+        if session is not None:
+            self.detection_rate = session.detection_rate
+            session.close()
+        return FaceTrack(
+            np.concatenate([t.boxes for t in tracks]),
+            np.concatenate([t.scores for t in tracks]),
+            np.concatenate([t.landmarks for t in tracks]),
+            tracks[0].frame_size,
+        )
+
+    def compare_face_tracking(self, frames: np.ndarray, padding: int = 10) -> Dict[str, float]:
+        """
+        Build the track of a clip both per frame and detect-then-track and compare the padded mask boxes.
+
+        Returns:
+            dict: detection_rate, mean/max box corner error in pixels, and frames where only one mode found a face.
+        """
+        reference = self.detect_face_track(frames)
+        session = self.tracking_session()
+        tracked = self.detect_face_track(frames, session)
+        session.close()
+
+        num_frames, height, width, _ = frames.shape
+        frame_indices = np.arange(num_frames)
+        reference_boxes = reference.pixel_boxes(frame_indices, height, width, padding)
+        tracked_boxes = tracked.pixel_boxes(frame_indices, height, width, padding)
+        reference_found, tracked_found = reference_boxes[:, 0] >= 0, tracked_boxes[:, 0] >= 0
+        both = reference_found & tracked_found
+        errors = np.abs(reference_boxes[both] - tracked_boxes[both]).max(axis=1) if both.any() else np.zeros(1)
+        return {
+            "detection_rate": session.detection_rate,
+            "mean_error_px": float(errors.mean()),
+            "max_error_px": float(errors.max()),
+            "mismatched_frames": int((reference_found != tracked_found).sum()),
+        }
+
     
     def generate_face_region_mask_pil_image(self,frame_image,video_id=0, frame_idx=0):
-        # Convert from PIL Image to NumPy array in BGR format
+        # Convert from PIL Image to an RGB NumPy array
         frame_np = np.array(frame_image.convert('RGB'))  # Ensure the image is in RGB
         return self.generate_face_region_mask_np_image(frame_np,video_id,frame_idx,)
     
@@ -1051,39 +1384,196 @@ class FaceHelper:
 
         return head_velocities
 
+    def get_head_pose_velocities_from_track(self, face_track: FaceTrack, frame_indices: List[int]) -> np.ndarray:
+        """
+        Head rotation speeds for a window of frames, derived from a stored FaceTrack.
+
+        Returns:
+            np.ndarray: float32 [F, 3] (roll, pitch, yaw) difference to the previous frame.
+        """
+        poses = self.pose_tracker.track(face_track)
+        frame_indices = np.asarray(frame_indices)
+        return HeadPoseTracker.velocities(poses[frame_indices], poses[np.maximum(frame_indices - 1, 0)])
+
+    def get_head_pose_velocities(self, video_reader: VideoReader, frame_indices: List[int]) -> np.ndarray:
+        """
+        Head rotation speeds for a window of frames without a FaceTrack: FaceMesh runs once on
+        each frame of the window and on the frame before it (not n+1 times per frame), then
+        poses for the whole window are solved in one warm-started pass.
+
+        Returns:
+            np.ndarray: float32 [F, 3] (roll, pitch, yaw) difference to the previous frame.
+        """
+        frame_indices = np.asarray(frame_indices)
+        previous_indices = np.maximum(frame_indices - 1, 0)
+        needed = np.unique(np.concatenate([previous_indices, frame_indices]))
+
+        frames = video_reader.get_batch(needed.tolist())
+        frames = frames.numpy() if isinstance(frames, torch.Tensor) else frames.asnumpy()
+        _, img_h, img_w, _ = frames.shape
+
+        face2d = np.full((len(needed), len(HeadPoseTracker.LANDMARK_IDS), 2), np.nan, dtype=np.float64)
+        for i, image in enumerate(frames):
+            results = self.face_mesh.process(image)
+            if results.multi_face_landmarks:
+                landmark = results.multi_face_landmarks[0].landmark
+                face2d[i] = [(landmark[idx].x * img_w, landmark[idx].y * img_h) for idx in HeadPoseTracker.LANDMARK_IDS]
+
+        poses = self.pose_tracker.solve(face2d, img_h, img_w)
+        position = {frame_idx: i for i, frame_idx in enumerate(needed)}
+        current = poses[[position[idx] for idx in frame_indices]]
+        previous = poses[[position[idx] for idx in previous_indices]]
+        return HeadPoseTracker.velocities(current, previous)
 
 
 
 
-# from torchvision.transforms.functional import to_tensor
+
+class ClipAugmentation:
+    """
+    RandomResizedCrop -> ToTensor -> Normalize for a whole clip in one batched op.
+
+    The crop is sampled once per clip from a caller-supplied torch.Generator (the global
+    RNG state is never touched, so it is safe with multi-worker loading) and the same
+    crop/resize is applied to every frame of the stacked uint8 tensor. A second instance
+    with normalize=False handles the conditioning masks with the same params, keeping
+    frames and masks pixel-aligned.
+    """
+    def __init__(self, size: Tuple[int, int], scale: Tuple[float, float] = (0.08, 1.0), ratio: Tuple[float, float] = (3.0 / 4.0, 4.0 / 3.0), normalize: bool = True):
+        self.size = size  # (height, width)
+        self.scale = scale
+        self.ratio = ratio
+        self.normalize = normalize
+
+    def get_params(self, height: int, width: int, generator: torch.Generator) -> Tuple[int, int, int, int]:
+        # Same sampling scheme as transforms.RandomResizedCrop.get_params, driven by `generator`
+        area = height * width
+        log_ratio = (math.log(self.ratio[0]), math.log(self.ratio[1]))
+        for _ in range(10):
+            target_area = area * torch.empty(1).uniform_(self.scale[0], self.scale[1], generator=generator).item()
+            aspect_ratio = math.exp(torch.empty(1).uniform_(log_ratio[0], log_ratio[1], generator=generator).item())
+
+            w = int(round(math.sqrt(target_area * aspect_ratio)))
+            h = int(round(math.sqrt(target_area / aspect_ratio)))
+            if 0 < w <= width and 0 < h <= height:
+                i = torch.randint(0, height - h + 1, (1,), generator=generator).item()
+                j = torch.randint(0, width - w + 1, (1,), generator=generator).item()
+                return i, j, h, w
+
+        # Fallback to central crop
+        in_ratio = float(width) / float(height)
+        if in_ratio < min(self.ratio):
+            w = width
+            h = int(round(w / min(self.ratio)))
+        elif in_ratio > max(self.ratio):
+            h = height
+            w = int(round(h * max(self.ratio)))
+        else:
+            w = width
+            h = height
+        i = (height - h) // 2
+        j = (width - w) // 2
+        return i, j, h, w
+
+    def apply(self, frames: torch.Tensor, params: Tuple[int, int, int, int]) -> torch.Tensor:
+        """
+        Args:
+            frames (torch.Tensor): uint8 clip [F, H, W, C] (decord layout) or masks [F, H, W].
+            params (tuple): (top, left, height, width) crop from get_params.
+
+        Returns:
+            torch.Tensor: float clip [F, C, size[0], size[1]] in [-1, 1] (normalize) or [0, 1].
+        """
+        if not isinstance(frames, torch.Tensor):
+            frames = torch.from_numpy(frames.asnumpy() if hasattr(frames, 'asnumpy') else np.asarray(frames))
+        if frames.ndim == 3:
+            frames = frames.unsqueeze(-1)
+        assert frames.ndim == 4, "Expected frames of shape [F, H, W, C]"
+
+        i, j, h, w = params
+        clip = frames[:, i:i + h, j:j + w].permute(0, 3, 1, 2).float()
+        clip = F.interpolate(clip, size=self.size, mode='bilinear', align_corners=False, antialias=True)
+        clip = clip.clamp_(0, 255).div_(255.0)
+        if self.normalize:
+            clip = clip.sub_(0.5).div_(0.5)
+        return clip
+
+    def __call__(self, frames: torch.Tensor, generator: torch.Generator) -> torch.Tensor:
+        params = self.get_params(frames.shape[1], frames.shape[2], generator)
+        return self.apply(frames, params)
+
+
 class EmoVideoReader(VideoReader):
 
-    def __init__(self, pixel_transform: transforms.Compose, cond_transform: transforms.Compose, state: torch.Tensor = None):
-        super.__init__()
-        
+    def __init__(self, uri: str, pixel_transform: ClipAugmentation, cond_transform: ClipAugmentation = None, generator: torch.Generator = None, **kwargs):
+        super().__init__(uri, **kwargs)
+
         self.pixel_transform = pixel_transform
         self.cond_transform = cond_transform
-        self.state = state
+        self.generator = generator if generator is not None else torch.Generator()
+        self.params = None
+
+    def crop_params(self) -> Tuple[int, int, int, int]:
+        # One crop for the whole video so frames read one at a time stay aligned
+        if self.params is None:
+            height, width = self[0].shape[:2]
+            self.params = self.pixel_transform.get_params(height, width, self.generator)
+        return self.params
 
     def augmentedImageAtFrame(self, index: int) -> torch.Tensor:
 
-        img = self[index]
-        return self.augmentation(img,self.pixel_transform,self.state)
-    
-    def augmentation(self, images: Any, transform: transforms.Compose, state: torch.Tensor = None) -> torch.Tensor:
+        img = self.get_batch([index])  # (1, h, w, c) for any decord bridge
+        return self.augmentation(img, self.pixel_transform)[0]
 
-            if state is not None:
-                torch.set_rng_state(state)
-            if isinstance(images, List):
-                transformed_images = [transform(img) for img in images]
-                ret_tensor = torch.stack(transformed_images, dim=0)  # (f, c, h, w)
-            else:
-                ret_tensor = transform(images)  # (c, h, w)
-            return ret_tensor
+    def augmentation(self, frames: Any, transform: ClipAugmentation) -> torch.Tensor:
+        return transform.apply(frames, self.crop_params())  # (f, c, h, w)
     
 
+class WorkerResources:
+    """
+    Per-process pool of heavy helpers (MediaPipe graphs, wav2vec2...), each built on first use
+    and reused for the lifetime of the process. Built objects are never pickled, so a dataset
+    holding a pool can be sent to DataLoader workers and every worker builds its own copies.
+    """
+    def __init__(self, factories: Dict[str, Callable[[], Any]]):
+        self.factories = factories
+        self._resources: Dict[str, Any] = {}
+
+    def get(self, name: str) -> Any:
+        if name not in self._resources:
+            self._resources[name] = self.factories[name]()
+        return self._resources[name]
+
+    def reset(self):
+        # Drop anything inherited from the parent through fork
+        self._resources = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_resources"] = {}
+        return state
+
+
+def worker_init_fn(worker_id: int):
+    """
+    DataLoader worker_init_fn for EMODataset: start the worker with an empty resource pool, its own
+    manifest connection and single-threaded OpenCV/torch so that num_workers processes share the CPU cores instead of
+    oversubscribing them.
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    cv2.setNumThreads(1)
+    torch.set_num_threads(1)
+    decord.bridge.set_bridge('torch')
+    resources = getattr(worker_info.dataset, "resources", None)
+    if resources is not None:
+        resources.reset()
+    manifest = getattr(worker_info.dataset, "manifest", None)
+    if manifest is not None:
+        manifest.reset()
+
+
 class EMODataset(Dataset):
-    def __init__(self, use_gpu:False,data_dir: str, sample_rate: int, n_sample_frames: int, width: int, height: int, img_scale: Tuple[float, float], img_ratio: Tuple[float, float] = (0.9, 1.0), video_dir: str = ".", drop_ratio: float = 0.1, json_file: str = "", stage: str = 'stage1', transform: transforms.Compose = None):
+    def __init__(self, use_gpu:False,data_dir: str, sample_rate: int, n_sample_frames: int, width: int, height: int, img_scale: Tuple[float, float], img_ratio: Tuple[float, float] = (0.9, 1.0), video_dir: str = ".", drop_ratio: float = 0.1, json_file: str = "", stage: str = 'stage1', transform: transforms.Compose = None, shard_dir: str = None, face_track_dir: str = None, audio_feature_dir: str = None, clip_filter: Dict[str, Any] = None, clip_decode: bool = False, face_detect_every: int = 1):
         self.sample_rate = sample_rate
         self.n_sample_frames = n_sample_frames
         self.width = width
@@ -1094,248 +1584,249 @@ class EMODataset(Dataset):
         self.data_dir = data_dir
         self.transform = transform
         self.stage = stage
-        self.feature_extractor = Wav2VecFeatureExtractor(model_name='facebook/wav2vec2-base-960h', device='cuda')
-
-        self.face_mask_generator = FaceHelper()
-        self.pixel_transform = transforms.Compose(
-            [
-                transforms.RandomResizedCrop(
-                    (height, width),
-                    scale=self.img_scale,
-                    ratio=self.img_ratio,
-                    interpolation=transforms.InterpolationMode.BILINEAR,
-                ),
-                transforms.ToTensor(),
-                transforms.Normalize([0.5], [0.5]),
-            ]
-        )
 
-        self.cond_transform = transforms.Compose(
-            [
-                transforms.RandomResizedCrop(
-                    (height, width),
-                    scale=self.img_scale,
-                    ratio=self.img_ratio,
-                    interpolation=transforms.InterpolationMode.BILINEAR,
-                ),
-                transforms.ToTensor(),
-            ]
-        )
+        # MediaPipe graphs and wav2vec2 are built lazily inside each DataLoader worker (see worker_init_fn).
+        # wav2vec2 runs on the CPU here: CUDA can't be initialized in forked workers.
+        self.resources = WorkerResources({
+            "face_helper": partial(FaceHelper, detect_every=face_detect_every),
+            "feature_extractor": partial(Wav2VecFeatureExtractor, model_name=WAV2VEC_MODEL_NAME, device='cpu'),
+        })
+        self.pixel_transform = ClipAugmentation((height, width), scale=self.img_scale, ratio=self.img_ratio)
+        self.cond_transform = ClipAugmentation((height, width), scale=self.img_scale, ratio=self.img_ratio, normalize=False)
 
         self.drop_ratio = drop_ratio
-        with open(json_file, 'r') as f:
-            self.celebvhq_info = json.load(f)
-
-        self.video_ids = list(self.celebvhq_info['clips'].keys())
+        # SQLite manifest (built next to json_file on first use) - clips are selected with SQL filters
+        # instead of holding the whole CelebV-HQ json in every worker
+        self.manifest = ClipManifest.open(json_file)
+        self.video_ids = self.manifest.video_ids(**(clip_filter or {}))
+        self.manifest.close()  # workers open their own connection on first use
         self.use_gpu = use_gpu
 
         decord.bridge.set_bridge('torch')  # Optional: This line sets decord to directly output PyTorch tensors.
         self.ctx = decord.cpu()
 
+        # Decode only the manifest's duration window of each source video, cropped to its bbox and
+        # scaled close to (height, width) by the decoder (see clip_decode.ClipWindowReader)
+        self.clip_decode = clip_decode
+
+        # Pre-decoded frames written by `python frame_shards.py` - skips video decode entirely
+        self.frame_shards = FrameShardReader(shard_dir) if shard_dir is not None else None
+
+        # Face boxes/landmarks computed once per video (keyed by mp4 content hash) - masks and
+        # head pose are derived from the track instead of running MediaPipe in __getitem__
+        self.face_tracks = FaceTrackStore(face_track_dir) if face_track_dir is not None else None
+
+        # wav2vec2 hidden states computed once per clip - audio_features are gathered from the mmap
+        self.audio_features = Wav2VecFeatureStore(audio_feature_dir, model_name=WAV2VEC_MODEL_NAME) if audio_feature_dir is not None else None
+
+
+    @property
+    def face_mask_generator(self) -> "FaceHelper":
+        return self.resources.get("face_helper")
+
+    @property
+    def feature_extractor(self) -> "Wav2VecFeatureExtractor":
+        return self.resources.get("feature_extractor")
 
     def __len__(self) -> int:
         
         return len(self.video_ids)
 
-    def augmentation(self, images, transform, state=None):
-            if state is not None:
-                torch.set_rng_state(state)
-            if isinstance(images, List):
-                transformed_images = [transform(img) for img in images]
-                ret_tensor = torch.stack(transformed_images, dim=0)  # (f, c, h, w)
-            else:
-                ret_tensor = transform(images)  # (c, h, w)
-            return ret_tensor
+    def make_generator(self) -> torch.Generator:
+        # Per-sample generator seeded from the (per-worker) global RNG, so crops differ across
+        # samples/epochs/workers while augmentation never mutates global RNG state.
+        return torch.Generator().manual_seed(torch.randint(0, 2 ** 62, (1,)).item())
+
+    def augmentation(self, frames: torch.Tensor, generator: torch.Generator, masks: torch.Tensor = None):
+        """
+        Crop/resize/normalize a whole clip with a single set of crop params.
+
+        Args:
+            frames (torch.Tensor): uint8 frames [F, H, W, C].
+            generator (torch.Generator): Per-sample generator for the crop params.
+            masks (torch.Tensor, optional): uint8 masks [F, H, W] aligned with frames.
+
+        Returns:
+            torch.Tensor or Tuple[torch.Tensor, torch.Tensor]: images [F, C, h, w] (and masks [F, 1, h, w]).
+        """
+        params = self.pixel_transform.get_params(frames.shape[1], frames.shape[2], generator)
+        images = self.pixel_transform.apply(frames, params)
+        if masks is None:
+            return images
+        return images, self.cond_transform.apply(masks, params)
+
+    def open_video_reader(self, video_id: str, mp4_path: str):
+        # Zero-copy view into the memory-mapped shards when the clip has been packed, then the
+        # trimmed/cropped decode of the clip window, decord otherwise
+        if self.frame_shards is not None and video_id in self.frame_shards:
+            return self.frame_shards.open(video_id)
+        if self.clip_decode:
+            path, start_sec, end_sec, bbox = resolve_clip_source(self.video_dir, video_id, self.manifest.get(video_id))
+            return ClipWindowReader(path, start_sec, end_sec, bbox, size=(self.height, self.width))
+        return VideoReader(mp4_path, ctx=self.ctx)
+
+    def media_path(self, video_id: str) -> str:
+        # The file frames, audio and face tracks of a clip come from: the ytb_id source video when
+        # clip_decode finds one (manifest windows are in source time), the clip's own mp4 otherwise
+        return clip_media_path(self.video_dir, video_id, self.manifest if self.clip_decode else None, self.frame_shards)
+
+    def source_frame_indices(self, video_reader, frame_indices: List[int]) -> List[int]:
+        # Frame indices in the source video (shifted by the clip window start for ClipWindowReader)
+        start_frame = getattr(video_reader, "start_frame", 0)
+        return [start_frame + frame_idx for frame_idx in frame_indices]
+
+    def audio_frames(self, mp4_path: str, source_indices: List[int], fps: float, sample_rate: int = 44100) -> List[torch.Tensor]:
+        """
+        The audio samples under each video frame as [1, 1, sample_rate / fps] mono tensors, decoded
+        in-process without touching the video stream. Only the span covered by source_indices is decoded.
+        """
+        first, last = min(source_indices), max(source_indices)
+        waveform = load_audio(mp4_path, target_sr=sample_rate, start_sec=first / fps, end_sec=(last + 1) / fps)
+        base = int(round(first * sample_rate / fps))  # sample index of waveform[0]
+        samples_per_frame = int(round(sample_rate / fps))
+        padded = np.pad(waveform, (0, samples_per_frame))
+        transform_to_tensor = ToTensor()
+        audio_frames = []
+        for frame_idx in source_indices:
+            start = min(max(int(round(frame_idx * sample_rate / fps)) - base, 0), waveform.shape[0])
+            audio_frames.append(transform_to_tensor(padded[None, start:start + samples_per_frame]))
+        return audio_frames
     
-    def __getitem__(self, index: int) -> Dict[str, Any]:
-        video_id = self.video_ids[index]
-        mp4_path = os.path.join(self.video_dir, f"{video_id}.mp4")
+    def sample_frame_indices(self, video_length: int, generator: torch.Generator = None) -> List[int]:
+        """
+        Pick a window of n_sample_frames frames, sample_rate frames apart, at a random start.
 
-        
+        Clips that are too short for the full stride get a smaller stride, and if even
+        consecutive frames don't fit the last frame is repeated, so every sample has
+        exactly n_sample_frames frames and batch shapes stay static.
 
-        if  self.stage == 'stage0-facelocator':
-            video_reader = VideoReader(mp4_path, ctx=self.ctx)
-            video_length = len(video_reader)
-            
-            transform_to_tensor = ToTensor()
-            # Read frames and generate masks
-            vid_pil_image_list = []
-            mask_tensor_list = []
-            face_locator = FaceHelper()
-        
-            speeds_tensor_list = []
-            for frame_idx in range(video_length):
-                # Read frame and convert to PIL Image
-                frame = Image.fromarray(video_reader[frame_idx].numpy())
+        Args:
+            video_length (int): Number of frames in the clip.
+            generator (torch.Generator, optional): Per-sample generator for the start frame.
 
-                # Transform the frame
-                state = torch.get_rng_state()
-                pixel_values_frame = self.augmentation(frame, self.pixel_transform, state)
-                vid_pil_image_list.append(pixel_values_frame)
+        Returns:
+            List[int]: Frame indices of the window.
+        """
+        assert video_length > 0, "Video has no frames"
+        stride = max(1, self.sample_rate)
+        while stride > 1 and (self.n_sample_frames - 1) * stride + 1 > video_length:
+            stride -= 1
+        span = (self.n_sample_frames - 1) * stride + 1
+
+        start = torch.randint(0, max(1, video_length - span + 1), (1,), generator=generator).item()
+        return [min(start + i * stride, video_length - 1) for i in range(self.n_sample_frames)]
+
+    def head_rotation_speeds(self, video_reader, mp4_path: str, frame_indices: List[int]) -> torch.Tensor:
+        # [F, 3] speeds for the SpeedEncoder, from the face track store when available
+        if self.face_tracks is not None:
+            face_track = self.face_tracks.get(mp4_path, self.face_mask_generator.build_face_track)
+            speeds = self.face_mask_generator.get_head_pose_velocities_from_track(face_track, self.source_frame_indices(video_reader, frame_indices))
+        else:
+            speeds = self.face_mask_generator.get_head_pose_velocities(video_reader, frame_indices)
+        return torch.from_numpy(speeds)
 
+    def audio_window_features(self, mp4_path: str, frame_indices: List[int], fps: float, m: int = 2, n: int = 2) -> torch.Tensor:
+        # [F, (m + n + 1) * D] context-stacked wav2vec2 features for video frames, from the feature store
+        features = self.audio_features.window_features(mp4_path, frame_indices, m, n, build_fn=self.feature_extractor.hidden_states_from_mp4, fps=fps)
+        return torch.from_numpy(features).flatten(1).float()
 
-                # Convert the transformed frame back to NumPy array in RGB format
-                transformed_frame_np = np.array(pixel_values_frame.permute(1, 2, 0).numpy() * 255, dtype=np.uint8)
-                transformed_frame_np = cv2.cvtColor(transformed_frame_np, cv2.COLOR_RGB2BGR)
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        video_id = self.video_ids[index]
+        mp4_path = self.media_path(video_id)
+        generator = self.make_generator()
 
-                # Generate the mask using the face mask generator
-                mask_np = self.face_mask_generator.generate_face_region_mask_np_image(transformed_frame_np, video_id, frame_idx)
+        # Every branch decodes only the sampled window through a single batched get_batch call
+        # and returns "images" as a fixed [F, C, H, W] tensor with F = n_sample_frames.
+        if  self.stage == 'stage0-facelocator':
+            video_reader = self.open_video_reader(video_id, mp4_path)
+            frame_indices = self.sample_frame_indices(len(video_reader), generator)
+            frames = video_reader.get_batch(frame_indices)  # [F, H, W, C] uint8
+
+            # Masks are generated on the source frames and then cropped with the same params
+            # as the frames by cond_transform, so both stay pixel-aligned
+            # (track boxes are in full-frame coordinates, so bbox-cropped clip decodes run MediaPipe instead)
+            if self.face_tracks is not None and not self.clip_decode:
+                face_track = self.face_tracks.get(mp4_path, self.face_mask_generator.build_face_track)
+                masks = face_track.face_region_mask(frame_indices, frames.shape[1], frames.shape[2])
+            else:
+                masks = []
+                for frame_idx, frame_tensor in zip(frame_indices, frames):
+                    masks.append(self.face_mask_generator.generate_face_region_mask_np_image(frame_tensor.numpy(), video_id, frame_idx))
+                masks = np.stack(masks, axis=0)
+            masks = torch.from_numpy(masks)
 
-                    # Convert the mask from numpy array to PIL Image
-                mask_pil = Image.fromarray(mask_np)
+            images, mask_tensor = self.augmentation(frames, generator, masks)
 
-                # Transform the PIL Image mask to a PyTorch tensor
-                mask_tensor = transform_to_tensor(mask_pil)
-                mask_tensor_list.append(mask_tensor)
-            
-            # Convert list of lists to a tensor
-   
             sample = {
                 "video_id": video_id,
-                "images": vid_pil_image_list,
-                "masks": mask_tensor_list,
+                "frame_indices": frame_indices,
+                "images": images,
+                "masks": mask_tensor,
             }
         elif  self.stage == 'stage1-0-framesencoder': # so when can freeze this https://github.com/johndpope/Emote-hack/issues/25
-            video_reader = VideoReader(mp4_path, ctx=self.ctx)
-            video_length = len(video_reader)
-            
+            video_reader = self.open_video_reader(video_id, mp4_path)
+            frame_indices = self.sample_frame_indices(len(video_reader), generator)
+            frames = video_reader.get_batch(frame_indices)
 
-            vid_pil_image_list = []
-         
-            
-            for frame_idx in range(video_length):
-                # Read frame and convert to PIL Image
-                frame = Image.fromarray(video_reader[frame_idx].numpy())
-
-                # Transform the frame
-                state = torch.get_rng_state()
-                pixel_values_frame = self.augmentation(frame, self.pixel_transform, state)
-                vid_pil_image_list.append(pixel_values_frame)
-
-            # Convert list of lists to a tensor
             sample = {
                 "video_id": video_id,
-                "images": vid_pil_image_list
+                "frame_indices": frame_indices,
+                "images": self.augmentation(frames, generator)
             }
         elif self.stage == 'stage1-vae':
-            video_reader = VideoReader(mp4_path, ctx=self.ctx)
-            video_length = len(video_reader)
-            
-            # Read frames and generate masks
-            vid_pil_image_list = []
-            speeds_tensor_list = []
-            face_locator = FaceHelper()
-            
-            for frame_idx in range(video_length):
-                # Read frame and convert to PIL Image
-                frame = Image.fromarray(video_reader[frame_idx].numpy())
-
-                # Transform the frame
-                state = torch.get_rng_state()
-                pixel_values_frame = self.augmentation(frame, self.pixel_transform, state)
-                vid_pil_image_list.append(pixel_values_frame)
-
-                # Calculate head rotation speeds at the current frame (previous 1 frames)
-                head_rotation_speeds = face_locator.get_head_pose_velocities_at_frame(video_reader, frame_idx, 1)
-
-                # Check if head rotation speeds are successfully calculated
-                if head_rotation_speeds:
-                    head_tensor = torch.tensor(head_rotation_speeds[0], dtype=torch.float32)  # Convert tuple to tensor
-                    speeds_tensor_list.append(head_tensor)
-                else:
-                    # Provide a default value if no speeds were calculated
-                    default_speeds = torch.zeros(3, dtype=torch.float32)  # Create a tensor of shape [3]
-                    speeds_tensor_list.append(default_speeds)
-
-            # Convert list of lists to a tensor
+            video_reader = self.open_video_reader(video_id, mp4_path)
+            frame_indices = self.sample_frame_indices(len(video_reader), generator)
+            frames = video_reader.get_batch(frame_indices)
+
+            # Head rotation speeds at each sampled frame (vs. the previous frame)
+            speeds = self.head_rotation_speeds(video_reader, mp4_path, frame_indices)
+
+            images = self.augmentation(frames, generator)
             sample = {
                 "video_id": video_id,
-                "images": vid_pil_image_list,
-                "motion_frames": vid_pil_image_list[1:],  # Exclude the first frame as motion frame
-                "speeds": speeds_tensor_list
+                "frame_indices": frame_indices,
+                "images": images,
+                "motion_frames": images[1:],  # Exclude the first frame as motion frame
+                "speeds": speeds
             }
 
 
-       
-
-
         elif self.stage == 'stage2-temporal-audio':
-            av_reader = AVReader(mp4_path, ctx=self.ctx)
-            av_length = len(av_reader)
-            transform_to_tensor = ToTensor()
-            
-            # Read frames and generate masks
-            vid_pil_image_list = []
-            audio_frame_tensor_list = []
-            
-            for frame_idx in range(av_length):
-                audio_frame, video_frame = av_reader[frame_idx]
-                
-                # Read frame and convert to PIL Image
-                frame = Image.fromarray(video_frame.numpy())
-                
-                # Transform the frame
-                state = torch.get_rng_state()
-                pixel_values_frame = self.augmentation(frame, self.pixel_transform, state)
-                vid_pil_image_list.append(pixel_values_frame)
-                
-                # Convert audio frame to tensor
-                audio_frame_tensor = transform_to_tensor(audio_frame.asnumpy())
-                audio_frame_tensor_list.append(audio_frame_tensor)
-            
+            video_reader = self.open_video_reader(video_id, mp4_path)
+            frame_indices = self.sample_frame_indices(len(video_reader), generator)
+            video_frames = video_reader.get_batch(frame_indices)
+            source_indices = self.source_frame_indices(video_reader, frame_indices)
+            audio_frame_tensor_list = self.audio_frames(mp4_path, source_indices, video_reader.get_avg_fps())
+
             sample = {
                 "video_id": video_id,
-                "images": vid_pil_image_list,
+                "frame_indices": frame_indices,
+                "images": self.augmentation(video_frames, generator),
                 "audio_frames": audio_frame_tensor_list,
             }
-        
+            if self.audio_features is not None:
+                sample["audio_features"] = self.audio_window_features(mp4_path, source_indices, video_reader.get_avg_fps())
+
         elif self.stage == 'stage3-speedlayers':
-            av_reader = AVReader(mp4_path, ctx=self.ctx)
-            av_length = len(av_reader)
-            transform_to_tensor = ToTensor()
-            
-            # Read frames and generate masks
-            vid_pil_image_list = []
-            audio_frame_tensor_list = []
-            head_rotation_speeds = []
-            face_locator = FaceHelper()
-            for frame_idx in range(av_length):
-                audio_frame, video_frame = av_reader[frame_idx]
-                
-                # Read frame and convert to PIL Image
-                frame = Image.fromarray(video_frame.numpy())
-                
-                # Transform the frame
-                state = torch.get_rng_state()
-                pixel_values_frame = self.augmentation(frame, self.pixel_transform, state)
-                vid_pil_image_list.append(pixel_values_frame)
-                
-                # Convert audio frame to tensor
-                audio_frame_tensor = transform_to_tensor(audio_frame.asnumpy())
-                audio_frame_tensor_list.append(audio_frame_tensor)
-
-                 # Calculate head rotation speeds at the current frame (previous 1 frames)
-                head_rotation_speeds = face_locator.get_head_pose_velocities_at_frame(video_reader, frame_idx,1)
-
-                # Check if head rotation speeds are successfully calculated
-                if head_rotation_speeds:
-                    head_tensor = transform_to_tensor(head_rotation_speeds)
-                    speeds_tensor_list.append(head_tensor)
-                else:
-                    # Provide a default value if no speeds were calculated
-                    #expected_speed_vector_length = 3
-                    #default_speeds = torch.zeros(1, expected_speed_vector_length)  # Shape [1, 3]
-                    default_speeds = (0.0, 0.0, 0.0)  # List containing one tuple with three elements
-                    head_tensor = transform_to_tensor(default_speeds)
-                    speeds_tensor_list.append(head_tensor)
-            
+            video_reader = self.open_video_reader(video_id, mp4_path)
+            frame_indices = self.sample_frame_indices(len(video_reader), generator)
+            video_frames = video_reader.get_batch(frame_indices)
+            source_indices = self.source_frame_indices(video_reader, frame_indices)
+            audio_frame_tensor_list = self.audio_frames(mp4_path, source_indices, video_reader.get_avg_fps())
+
+            # Head rotation speeds at each sampled frame (vs. the previous frame)
+            speeds = self.head_rotation_speeds(video_reader, mp4_path, frame_indices)
+
             sample = {
                 "video_id": video_id,
-                "images": vid_pil_image_list,
+                "frame_indices": frame_indices,
+                "images": self.augmentation(video_frames, generator),
                 "audio_frames": audio_frame_tensor_list,
-                "speeds": head_rotation_speeds
+                "speeds": speeds
             }
-        
+            if self.audio_features is not None:
+                sample["audio_features"] = self.audio_window_features(mp4_path, source_indices, video_reader.get_avg_fps())
+
 
 
         return sample
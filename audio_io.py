@@ -0,0 +1,95 @@
+from fractions import Fraction
+from functools import lru_cache
+from typing import Optional
+
+import av
+import numpy as np
+from scipy.signal import firwin, resample_poly
+
+
+# In-process audio loading for the wav2vec2 feature extractor.
+# The audio stream is demuxed and decoded straight from the mp4 (or any container PyAV reads),
+# downmixed to mono frame by frame and resampled with a cached polyphase filter, so nothing is
+# ever written next to the dataset.
+
+
+RESAMPLE_MARGIN_SEC = 0.1
+
+
+@lru_cache(maxsize=16)
+def polyphase_filter(up: int, down: int, half_width: int = 10, beta: float = 5.0) -> np.ndarray:
+    """
+    Kaiser-windowed low-pass FIR taps for an up/down polyphase resampler (the scipy.signal.resample_poly default),
+    built once per rate pair.
+    """
+    max_rate = max(up, down)
+    return firwin(2 * half_width * max_rate + 1, 1.0 / max_rate, window=('kaiser', beta))
+
+
+def resample(waveform: np.ndarray, orig_sr: int, target_sr: int) -> np.ndarray:
+    """
+    Polyphase resampling of a 1D float waveform from orig_sr to target_sr.
+    """
+    if orig_sr == target_sr:
+        return waveform
+    ratio = Fraction(int(target_sr), int(orig_sr))
+    taps = polyphase_filter(ratio.numerator, ratio.denominator)
+    return resample_poly(waveform, ratio.numerator, ratio.denominator, window=taps).astype(np.float32)
+
+
+def load_audio(path: str, target_sr: Optional[int] = 16000, mono: bool = True,
+               start_sec: Optional[float] = None, end_sec: Optional[float] = None) -> np.ndarray:
+    """
+    Demux and decode the first audio stream of a file into a float32 NumPy buffer.
+
+    Args:
+        path (str): Path to an mp4/wav/... file.
+        target_sr (int): Output sampling rate, None to keep the stream rate.
+        mono (bool): Downmix to mono while decoding.
+        start_sec (float), end_sec (float): Only decode this span (seeking to start_sec), None for the start/end of the stream.
+
+    Returns:
+        np.ndarray: float32 waveform of shape [N] (mono) or [C, N].
+    """
+    start_sec = max(0.0, start_sec or 0.0)
+    with av.open(path) as container:
+        assert container.streams.audio, f"No audio stream in {path}"
+        stream = container.streams.audio[0]
+        sample_rate = stream.codec_context.sample_rate
+        # Planar float output whatever the codec's native sample format is
+        converter = av.AudioResampler(format='fltp')
+        if start_sec > 0:
+            container.seek(int(start_sec / stream.time_base), stream=stream, backward=True, any_frame=False)
+
+        chunks = []
+        first_sec = None  # time of the first decoded sample
+        num_samples = 0
+        for frame in container.decode(stream):
+            if first_sec is None:
+                first_sec = float(frame.time) if frame.time is not None else 0.0
+            # a little past end_sec so the resampling filter has context at the window's end
+            if end_sec is not None and first_sec + num_samples / sample_rate >= end_sec + RESAMPLE_MARGIN_SEC:
+                break
+            frame.pts = None
+            converted = converter.resample(frame)
+            for out in (converted if isinstance(converted, list) else [converted]):
+                samples = out.to_ndarray()  # [C, n]
+                chunks.append(samples.mean(axis=0) if mono else samples)
+                num_samples += samples.shape[-1]
+
+    if not chunks:
+        return np.zeros(0 if mono else (1, 0), dtype=np.float32)
+    waveform = np.concatenate(chunks, axis=-1).astype(np.float32, copy=False)
+
+    if target_sr is not None and target_sr != sample_rate:
+        if mono:
+            waveform = resample(waveform, sample_rate, target_sr)
+        else:
+            waveform = np.stack([resample(channel, sample_rate, target_sr) for channel in waveform])
+
+    if start_sec > 0 or end_sec is not None:
+        output_sr = target_sr or sample_rate
+        begin = max(0, int(round((start_sec - first_sec) * output_sr)))
+        stop = max(begin, int(round((end_sec - first_sec) * output_sr))) if end_sec is not None else None
+        waveform = waveform[..., begin:stop]
+    return waveform
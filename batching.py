@@ -0,0 +1,202 @@
+import json
+import os
+import random
+from collections import defaultdict
+from typing import Any, Callable, Dict, Hashable, Iterator, List
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Sampler
+
+
+# Batching for EMODataset.
+# EMODataset resizes every clip to the same (height, width) and samples exactly n_sample_frames
+# frames, so images always stack; the only per-clip shape left is the length of each audio_frames
+# tensor (audio sample rate / video fps) in the stages that emit them. Clips are bucketed on that
+# (from a cached metadata index) so stack_collate never has to pad or fails to stack audio.
+
+# EMODataset stages whose samples carry audio_frames, and their default sampling rate
+AUDIO_FRAME_STAGES = ('stage2-temporal-audio', 'stage3-speedlayers')
+AUDIO_SAMPLE_RATE = 44100
+
+
+class VideoMetadataIndex:
+    """
+    video_id -> {"num_frames", "height", "width", "fps"}, cached as JSON so containers are only probed once.
+    """
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self.videos: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                self.videos = json.load(f)["videos"]
+
+    def __contains__(self, video_id: str) -> bool:
+        return video_id in self.videos
+
+    def __getitem__(self, video_id: str) -> Dict[str, Any]:
+        return self.videos[video_id]
+
+    def update(self, video_ids: List[str], video_dir: str, frame_shards=None, path_fn: Callable[[str], str] = None):
+        """
+        Probe any videos missing from the index and rewrite the cache.
+
+        Args:
+            video_ids (List[str]): Clips to index.
+            video_dir (str): Directory holding <video_id>.mp4.
+            frame_shards (FrameShardReader): Optional shards; their index is used instead of opening the mp4.
+            path_fn (callable): video_id -> the file actually decoded for it (e.g. EMODataset.media_path).
+        """
+        missing = [video_id for video_id in video_ids if video_id not in self.videos]
+        if not missing:
+            return
+
+        from decord import VideoReader, cpu
+
+        for video_id in missing:
+            if frame_shards is not None and video_id in frame_shards:
+                entry = frame_shards.index[video_id]
+                height, width, _ = entry["shape"]
+                self.videos[video_id] = {"num_frames": entry["num_frames"], "height": height, "width": width, "fps": entry["fps"]}
+                continue
+
+            mp4_path = path_fn(video_id) if path_fn is not None else os.path.join(video_dir, f"{video_id}.mp4")
+            if not os.path.exists(mp4_path):
+                continue
+            video_reader = VideoReader(mp4_path, ctx=cpu())
+            height, width = video_reader[0].shape[:2]
+            self.videos[video_id] = {"num_frames": len(video_reader), "height": int(height), "width": int(width), "fps": video_reader.get_avg_fps()}
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"videos": self.videos}, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def bucket_key(self, video_id: str, audio_sample_rate: int = None) -> Hashable:
+        """
+        Audio samples per video frame of a clip (the length of its audio_frames tensors).
+        None without audio_sample_rate or for unknown clips, i.e. a single bucket.
+        """
+        if audio_sample_rate is None or video_id not in self.videos:
+            return None
+        return int(round(audio_sample_rate / self.videos[video_id]["fps"]))
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Yields batches whose samples all share a bucket key. Batches are shuffled within and across
+    buckets every epoch (call set_epoch for a new order when not using persistent iteration).
+    """
+    def __init__(self, bucket_keys: List[Hashable], batch_size: int, shuffle: bool = True, drop_last: bool = False, seed: int = 0):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        self.buckets: Dict[Hashable, List[int]] = defaultdict(list)
+        for index, key in enumerate(bucket_keys):
+            self.buckets[key].append(index)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[List[int]]:
+        rng = random.Random(self.seed + self.epoch)
+        self.epoch += 1
+
+        batches = []
+        for indices in self.buckets.values():
+            indices = list(indices)
+            if self.shuffle:
+                rng.shuffle(indices)
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            rng.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return sum(len(indices) // self.batch_size for indices in self.buckets.values())
+        return sum((len(indices) + self.batch_size - 1) // self.batch_size for indices in self.buckets.values())
+
+
+def stack_collate(batch: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Collate bucketed EMODataset samples by concatenating their frames: images [B * F, C, H, W].
+
+    Tensors are concatenated along the frame dim, lists of tensors (audio_frames) are stacked,
+    anything else is returned as a list. Should a batch still mix resolutions, images fall back
+    to zero padding and the padded pixel count is reported in "padded_pixels" / "total_pixels"
+    so the waste shows up in the epoch metrics.
+    """
+    assert isinstance(batch, list), "Batch should be a list"
+
+    collated: Dict[str, Any] = {}
+    for key in batch[0]:
+        values = [item[key] for item in batch]
+        if key == "images":
+            continue
+        if all(isinstance(value, torch.Tensor) for value in values):
+            collated[key] = torch.cat(values, dim=0) if values[0].ndim > 0 else torch.stack(values)
+        elif all(isinstance(value, list) and value and isinstance(value[0], torch.Tensor) for value in values):
+            collated[key] = torch.stack([tensor for value in values for tensor in value])
+        else:
+            collated[key] = values
+
+    images = [item["images"] for item in batch]
+    assert all(isinstance(clip, torch.Tensor) and clip.ndim == 4 for clip in images), "images must be [F, C, H, W] tensors"
+    real_pixels = sum(clip.shape[0] * clip.shape[2] * clip.shape[3] for clip in images)
+
+    max_height = max(clip.shape[2] for clip in images)
+    max_width = max(clip.shape[3] for clip in images)
+    if any(clip.shape[2:] != (max_height, max_width) for clip in images):
+        images = [F.pad(clip, (0, max_width - clip.shape[3], 0, max_height - clip.shape[2])) for clip in images]
+
+    collated["images"] = torch.cat(images, dim=0)
+    total_pixels = collated["images"].shape[0] * max_height * max_width
+    collated["padded_pixels"] = total_pixels - real_pixels
+    collated["total_pixels"] = total_pixels
+    return collated
+
+
+class PaddingWasteMeter:
+    """
+    Accumulates the share of padded pixels over an epoch from stack_collate batches.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.padded_pixels = 0
+        self.total_pixels = 0
+
+    def update(self, batch: Dict[str, Any]):
+        self.padded_pixels += batch.get("padded_pixels", 0)
+        self.total_pixels += batch.get("total_pixels", 0)
+
+    @property
+    def waste(self) -> float:
+        return self.padded_pixels / self.total_pixels if self.total_pixels else 0.0
+
+
+def build_bucket_sampler(dataset, batch_size: int, metadata_path: str,
+                         shuffle: bool = True, drop_last: bool = False, seed: int = 0) -> BucketBatchSampler:
+    """
+    Bucket dataset.video_ids by the length of their audio_frames tensors (fps from the metadata
+    index cached at metadata_path). Stages without audio_frames get one bucket, i.e. plain shuffled
+    batches, and skip the probing.
+    """
+    if dataset.stage not in AUDIO_FRAME_STAGES:
+        return BucketBatchSampler([None] * len(dataset.video_ids), batch_size, shuffle=shuffle, drop_last=drop_last, seed=seed)
+    metadata = VideoMetadataIndex(metadata_path)
+    metadata.update(dataset.video_ids, dataset.video_dir, getattr(dataset, "frame_shards", None), getattr(dataset, "media_path", None))
+    audio_sample_rate = getattr(dataset, "audio_sample_rate", AUDIO_SAMPLE_RATE)
+    bucket_keys = [metadata.bucket_key(video_id, audio_sample_rate) for video_id in dataset.video_ids]
+    return BucketBatchSampler(bucket_keys, batch_size, shuffle=shuffle, drop_last=drop_last, seed=seed)
@@ -0,0 +1,224 @@
+import argparse
+import functools
+import json
+import multiprocessing
+import resource
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List
+
+
+# Throughput benchmark for EMODataset.
+# Each dataset stage runs in its own fresh process (so peak RSS is per stage) and reports
+# samples/s, frames/s and where __getitem__ spends its time: decode, face (masks / face tracks),
+# pose (head rotation speeds), audio (waveform windows / wav2vec2 features), augment, other.
+# Stage times are exclusive (decode inside the pose helper counts as decode) and are only
+# collected in-process, i.e. with --num_workers 0.
+#
+# python synthetic_dataset.py --output_dir ./data/synthetic --num_clips 32
+# python bench_dataloader.py --json_file ./data/synthetic/synthetic.json --video_dir ./data/synthetic/videos
+
+STAGES = ['stage0-facelocator', 'stage1-0-framesencoder', 'stage1-vae', 'stage2-temporal-audio', 'stage3-speedlayers']
+TIMED_STAGES = ['decode', 'face', 'pose', 'audio', 'augment']
+
+
+class StageTimer:
+    """
+    Accumulates exclusive wall time per stage of wrapped callables (nested calls are subtracted from their caller).
+    """
+    def __init__(self):
+        self.totals: Dict[str, float] = defaultdict(float)
+        self._stack: List[float] = []
+
+    def wrap(self, stage: str, fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            self._stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = self._stack.pop()
+                self.totals[stage] += elapsed - nested
+                if self._stack:
+                    self._stack[-1] += elapsed
+        return timed
+
+    def reset(self):
+        self.totals = defaultdict(float)
+
+
+class TimedVideoReader:
+    # Delegates to a video reader, timing frame access as "decode"
+    def __init__(self, video_reader, timer: StageTimer):
+        self._video_reader = video_reader
+        self.get_batch = timer.wrap("decode", video_reader.get_batch)
+        self._getitem = timer.wrap("decode", video_reader.__getitem__)
+
+    def __len__(self) -> int:
+        return len(self._video_reader)
+
+    def __getitem__(self, index):
+        return self._getitem(index)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._video_reader, name)
+
+
+def instrument(dataset, timer: StageTimer):
+    """
+    Wrap the EMODataset helpers used by __getitem__ with stage timers (instance attributes only).
+    """
+    open_video_reader = timer.wrap("decode", dataset.open_video_reader)
+    dataset.open_video_reader = lambda *args, **kwargs: TimedVideoReader(open_video_reader(*args, **kwargs), timer)
+    dataset.augmentation = timer.wrap("augment", dataset.augmentation)
+    dataset.audio_frames = timer.wrap("audio", dataset.audio_frames)
+    dataset.audio_window_features = timer.wrap("audio", dataset.audio_window_features)
+    dataset.head_rotation_speeds = timer.wrap("pose", dataset.head_rotation_speeds)
+    if dataset.face_tracks is not None:
+        dataset.face_tracks.get = timer.wrap("face", dataset.face_tracks.get)
+
+    if dataset.stage in ('stage0-facelocator', 'stage1-vae', 'stage3-speedlayers'):
+        face_helper = dataset.face_mask_generator
+        face_helper.generate_face_region_mask_np_image = timer.wrap("face", face_helper.generate_face_region_mask_np_image)
+        face_helper.build_face_track = timer.wrap("face", face_helper.build_face_track)
+        face_helper.get_head_pose_velocities = timer.wrap("pose", face_helper.get_head_pose_velocities)
+        face_helper.get_head_pose_velocities_from_track = timer.wrap("pose", face_helper.get_head_pose_velocities_from_track)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux; DataLoader workers are counted through RUSAGE_CHILDREN
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(self_rss, children_rss) / 1024.0
+
+
+def bench_stage(stage: str, args: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Benchmark one EMODataset stage; meant to run in a fresh process.
+
+    Returns:
+        dict: samples_per_sec, frames_per_sec, stage_seconds (per sample), peak_rss_mb...
+    """
+    import torch
+    from torch.utils.data import DataLoader
+    from Net import EMODataset, worker_init_fn
+    from batching import build_bucket_sampler, stack_collate
+
+    torch.manual_seed(args["seed"])
+    dataset = EMODataset(
+        use_gpu=False,
+        width=args["width"],
+        height=args["height"],
+        n_sample_frames=args["n_sample_frames"],
+        sample_rate=args["sample_rate"],
+        img_scale=(1.0, 1.0),
+        data_dir='./images_folder',
+        video_dir=args["video_dir"],
+        json_file=args["json_file"],
+        stage=stage,
+        shard_dir=args["shard_dir"],
+        face_track_dir=args["face_track_dir"],
+        audio_feature_dir=args["audio_feature_dir"],
+        clip_decode=args["clip_decode"],
+        face_detect_every=args["face_detect_every"],
+    )
+    num_samples = min(args["num_samples"], len(dataset))
+    assert num_samples > 0, f"No clips in {args['json_file']}"
+    rss_before = peak_rss_mb()
+
+    timer = StageTimer()
+    if args["num_workers"] == 0:
+        instrument(dataset, timer)
+        # warmup builds MediaPipe / wav2vec2 and fills caches outside the timed window
+        for index in range(min(args["warmup"], num_samples)):
+            dataset[index]
+        timer.reset()
+
+        start = time.perf_counter()
+        for index in range(num_samples):
+            dataset[index]
+        elapsed = time.perf_counter() - start
+    else:
+        # the same bucketed batches as the training scripts (mixed-fps clips are never stacked together)
+        batch_sampler = build_bucket_sampler(dataset, args["batch_size"], args["metadata_index"], seed=args["seed"])
+        data_loader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=args["num_workers"],
+                                 collate_fn=stack_collate, worker_init_fn=worker_init_fn)
+        start = None
+        seen = 0
+        warmup_batches = max(1, args["warmup"] // args["batch_size"])
+        for batch_index, batch in enumerate(data_loader):
+            if batch_index == warmup_batches - 1:
+                start = time.perf_counter()
+                continue
+            if start is None:
+                continue
+            seen += len(batch["video_id"])
+            if seen >= num_samples:
+                break
+        elapsed = time.perf_counter() - start if start is not None else 0.0
+        num_samples = seen
+
+    stage_seconds = {name: timer.totals.get(name, 0.0) / num_samples for name in TIMED_STAGES} if timer.totals else {}
+    if stage_seconds:
+        stage_seconds["other"] = max(0.0, elapsed / num_samples - sum(stage_seconds.values()))
+    return {
+        "stage": stage,
+        "samples": num_samples,
+        "seconds": elapsed,
+        "samples_per_sec": num_samples / elapsed if elapsed else 0.0,
+        "frames_per_sec": num_samples * args["n_sample_frames"] / elapsed if elapsed else 0.0,
+        "stage_seconds": stage_seconds,
+        "rss_after_setup_mb": rss_before,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def print_report(results: List[Dict[str, Any]]):
+    header = f"{'stage':<24}{'samples/s':>10}{'frames/s':>10}" + "".join(f"{name + ' ms':>12}" for name in TIMED_STAGES + ['other']) + f"{'peak RSS MB':>13}"
+    print(header)
+    print("-" * len(header))
+    for result in results:
+        row = f"{result['stage']:<24}{result['samples_per_sec']:>10.2f}{result['frames_per_sec']:>10.1f}"
+        for name in TIMED_STAGES + ['other']:
+            value = result["stage_seconds"].get(name)
+            row += f"{value * 1000:>12.1f}" if value is not None else f"{'n/a':>12}"
+        print(row + f"{result['peak_rss_mb']:>13.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark EMODataset throughput per stage")
+    parser.add_argument("--json_file", type=str, default="./data/synthetic/synthetic.json")
+    parser.add_argument("--video_dir", type=str, default="./data/synthetic/videos")
+    parser.add_argument("--stages", type=str, nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--num_samples", type=int, default=32)
+    parser.add_argument("--warmup", type=int, default=2, help="samples excluded from the timing")
+    parser.add_argument("--n_sample_frames", type=int, default=8)
+    parser.add_argument("--sample_rate", type=int, default=1, help="frame stride")
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--num_workers", type=int, default=0, help="> 0 measures DataLoader throughput only (no stage times)")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--metadata_index", type=str, default="./data/video_metadata.json", help="fps index the bucketed batches are built from (training.metadata_index)")
+    parser.add_argument("--shard_dir", type=str, default=None)
+    parser.add_argument("--face_track_dir", type=str, default=None)
+    parser.add_argument("--audio_feature_dir", type=str, default=None)
+    parser.add_argument("--clip_decode", action="store_true")
+    parser.add_argument("--face_detect_every", type=int, default=1, help="> 1: detect-then-track when building face tracks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="also write the results as json")
+    args = parser.parse_args()
+
+    results = []
+    for stage in args.stages:
+        # a fresh spawned process per stage, so models/caches of one stage don't inflate the next one's RSS
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results.append(executor.submit(bench_stage, stage, vars(args)).result())
+        print(f"{stage}: {results[-1]['samples_per_sec']:.2f} samples/s")
+
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
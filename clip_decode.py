@@ -0,0 +1,209 @@
+import os
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import av
+import numpy as np
+import torch
+
+
+# Decode-time trimming, cropping and downscaling for CelebV-HQ clips.
+# Each clip only covers duration.start_sec..end_sec and the normalized bbox of its source video.
+# ClipWindowReader seeks straight to the window and runs every decoded frame through an FFmpeg
+# filter graph (crop -> scale -> rgb24), so frames reach Python already cropped and at roughly
+# the training resolution instead of as full-HD RGB arrays.
+
+
+def scaled_size(crop_height: int, crop_width: int, size: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    Smallest (height, width) with the crop's aspect ratio that still covers size; never upscales.
+    Dimensions are kept even for the yuv -> rgb conversion.
+    """
+    scale = min(1.0, max(size[0] / crop_height, size[1] / crop_width))
+    height = max(2, int(round(crop_height * scale / 2)) * 2)
+    width = max(2, int(round(crop_width * scale / 2)) * 2)
+    return height, width
+
+
+def resolve_clip_source(video_dir: str, video_id: str, clip: Dict[str, Any]) -> Tuple[str, Optional[float], Optional[float], Optional[Dict[str, float]]]:
+    """
+    Video file and window to decode for a manifest clip.
+
+    The manifest's duration window and bbox are relative to the clip's ytb_id source video, so they
+    are applied when video_dir holds {ytb_id}.mp4. Otherwise {video_id}.mp4 is the already trimmed
+    and cropped clip file and is decoded whole (window and bbox are not applied a second time).
+
+    Returns:
+        tuple: (path, start_sec, end_sec, bbox).
+    """
+    ytb_id = clip.get("ytb_id")
+    source_path = os.path.join(video_dir, f"{ytb_id}.mp4") if ytb_id else None
+    if source_path is not None and os.path.exists(source_path):
+        return source_path, clip["duration"]["start_sec"], clip["duration"]["end_sec"], clip["bbox"]
+    return os.path.join(video_dir, f"{video_id}.mp4"), None, None, None
+
+
+def clip_media_path(video_dir: str, video_id: str, manifest: Any = None, frame_shards: Any = None) -> str:
+    """
+    File a clip's frames, audio and per-video caches (face tracks, audio features) come from.
+
+    With a manifest (clip decode) that is the ytb_id source video resolve_clip_source finds, unless
+    the clip's frames are served from frame_shards; otherwise it is {video_id}.mp4.
+    """
+    if manifest is not None and not (frame_shards is not None and video_id in frame_shards):
+        return resolve_clip_source(video_dir, video_id, manifest.get(video_id))[0]
+    return os.path.join(video_dir, f"{video_id}.mp4")
+
+
+class ClipWindowReader:
+    """
+    Frames of one clip window of a source video, cropped to a bbox and scaled during decode.
+
+    Implements the parts of decord.VideoReader that EMODataset uses (len, [], get_batch,
+    get_avg_fps); frame 0 is the first frame at or after start_sec.
+
+    Args:
+        path (str): Source video.
+        start_sec (float), end_sec (float): Clip window, None for the start/end of the video.
+        bbox (dict): Normalized {"top", "bottom", "left", "right"} crop, None for the full frame.
+        size (tuple): Target (height, width); frames are scaled to cover it, keeping the crop's aspect ratio.
+    """
+    def __init__(self, path: str, start_sec: float = None, end_sec: float = None,
+                 bbox: Optional[Dict[str, float]] = None, size: Optional[Tuple[int, int]] = None):
+        self.path = path
+        self._container = None
+
+        stream = self.container.streams.video[0]
+        self.fps = float(stream.average_rate) if stream.average_rate else 25.0
+        duration = float(stream.duration * stream.time_base) if stream.duration else float(self.container.duration) / av.time_base
+        self.start_sec = max(0.0, start_sec or 0.0)
+        self.end_sec = min(duration, end_sec) if end_sec is not None else duration
+        # Index of the window's first frame in the source video (for audio / face track lookups)
+        self.start_frame = int(round(self.start_sec * self.fps))
+        self.num_frames = max(1, int(round((self.end_sec - self.start_sec) * self.fps)))
+
+        source_width, source_height = stream.codec_context.width, stream.codec_context.height
+        if bbox is not None:
+            x = int(bbox["left"] * source_width) // 2 * 2
+            y = int(bbox["top"] * source_height) // 2 * 2
+            crop_width = max(2, int((bbox["right"] - bbox["left"]) * source_width) // 2 * 2)
+            crop_height = max(2, int((bbox["bottom"] - bbox["top"]) * source_height) // 2 * 2)
+            crop_width, crop_height = min(crop_width, source_width - x), min(crop_height, source_height - y)
+        else:
+            x, y, crop_width, crop_height = 0, 0, source_width, source_height
+        self.crop = (x, y, crop_width, crop_height)
+        self.height, self.width = scaled_size(crop_height, crop_width, size) if size is not None else (crop_height, crop_width)
+
+    @property
+    def container(self):
+        # Opened lazily so readers can be created in the parent and used in DataLoader workers
+        if self._container is None:
+            self._container = av.open(self.path)
+            self._container.streams.video[0].thread_type = 'AUTO'
+        return self._container
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_container"] = None
+        return state
+
+    def close(self):
+        if self._container is not None:
+            self._container.close()
+            self._container = None
+
+    def __len__(self) -> int:
+        return self.num_frames
+
+    def get_avg_fps(self) -> float:
+        return self.fps
+
+    def build_graph(self, stream) -> "av.filter.Graph":
+        x, y, crop_width, crop_height = self.crop
+        graph = av.filter.Graph()
+        source = graph.add_buffer(template=stream)
+        crop = graph.add("crop", f"{crop_width}:{crop_height}:{x}:{y}")
+        scale = graph.add("scale", f"{self.width}:{self.height}:flags=area")
+        rgb = graph.add("format", "rgb24")
+        sink = graph.add("buffersink")
+        source.link_to(crop)
+        crop.link_to(scale)
+        scale.link_to(rgb)
+        rgb.link_to(sink)
+        graph.configure()
+        return graph
+
+    def get_batch(self, indices: List[int]) -> torch.Tensor:
+        """
+        Decode the requested window-relative frames in one forward pass from a single seek.
+
+        Returns:
+            torch.Tensor: uint8 [F, H, W, 3] in the order of indices.
+        """
+        indices = [min(max(int(i), 0), self.num_frames - 1) for i in indices]
+        wanted = set(indices)
+        first, last = min(wanted), max(wanted)
+
+        stream = self.container.streams.video[0]
+        time_base = stream.time_base
+        first_sec = self.start_sec + first / self.fps
+        # seek to the keyframe before the first wanted frame
+        self.container.seek(int(first_sec / time_base), stream=stream, backward=True, any_frame=False)
+
+        graph = self.build_graph(stream)
+        frames: Dict[int, np.ndarray] = {}
+        last_frame = None
+        for packet_frame in self.container.decode(stream):
+            if packet_frame.pts is None:
+                continue
+            index = int(round((float(packet_frame.pts * time_base) - self.start_sec) * self.fps))
+            if index < first:
+                continue
+            if index > last:
+                break
+            if index not in wanted:
+                continue
+            graph.push(packet_frame)
+            last_frame = graph.pull().to_ndarray()
+            frames[index] = last_frame
+
+        assert last_frame is not None, f"No frames decoded from {self.path} in [{self.start_sec}, {self.end_sec}]"
+        # Frames missing at the end of a short stream repeat the last decoded frame
+        filled = []
+        for index in indices:
+            if index not in frames:
+                earlier = [i for i in frames if i <= index]
+                frames[index] = frames[max(earlier)] if earlier else frames[min(frames)]
+            filled.append(frames[index])
+        return torch.from_numpy(np.stack(filled, axis=0))
+
+    def __getitem__(self, index: int) -> torch.Tensor:
+        return self.get_batch([index])[0]
+
+    def iter_batches(self, batch_size: int = 32) -> Iterator[np.ndarray]:
+        """
+        Decode the whole window sequentially from a single seek.
+
+        Yields:
+            np.ndarray: uint8 [B, H, W, 3] batches of consecutive frames (the last one may be shorter).
+        """
+        stream = self.container.streams.video[0]
+        time_base = stream.time_base
+        self.container.seek(int(self.start_sec / time_base), stream=stream, backward=True, any_frame=False)
+
+        graph = self.build_graph(stream)
+        batch = []
+        for packet_frame in self.container.decode(stream):
+            if packet_frame.pts is None:
+                continue
+            index = int(round((float(packet_frame.pts * time_base) - self.start_sec) * self.fps))
+            if index < 0:
+                continue
+            if index >= self.num_frames:
+                break
+            graph.push(packet_frame)
+            batch.append(graph.pull().to_ndarray())
+            if len(batch) == batch_size:
+                yield np.stack(batch, axis=0)
+                batch = []
+        if batch:
+            yield np.stack(batch, axis=0)
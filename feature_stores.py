@@ -0,0 +1,352 @@
+import argparse
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+# Persistent per-video caches so that nothing expensive (MediaPipe, wav2vec...) runs inside
+# the DataLoader more than once per video. Entries are keyed by a content hash of the mp4
+# (audio features: of its audio stream only), so renaming/moving clips keeps the cache valid
+# and re-encoded clips are never served stale.
+#
+# python feature_stores.py --json_file ./data/overfit.json --video_dir /path/to/35666 --face_track_dir ./face_tracks --audio_feature_dir ./audio_features
+
+_HASH_CACHE: Dict[Tuple[str, int, int], str] = {}
+_AUDIO_HASH_CACHE: Dict[Tuple[str, int, int], str] = {}
+
+
+def content_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    sha1 of the file contents, memoized per process on (path, size, mtime).
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _HASH_CACHE:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+        _HASH_CACHE[key] = sha1.hexdigest()
+    return _HASH_CACHE[key]
+
+
+def audio_hash(path: str) -> str:
+    """
+    sha1 of the first audio stream (codec parameters + demuxed packet payloads, no decoding),
+    memoized per process on (path, size, mtime).
+
+    Unlike content_hash it survives a remux or a re-encode of the video track, which leaves
+    wav2vec2 features unchanged; any change to the audio itself changes the hash.
+    """
+    import av
+
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _AUDIO_HASH_CACHE:
+        sha1 = hashlib.sha1()
+        with av.open(path) as container:
+            if not container.streams.audio:
+                raise ValueError(f"No audio stream in {path}")
+            stream = container.streams.audio[0]
+            codec = stream.codec_context
+            sha1.update(f"{codec.name}|{codec.sample_rate}|{codec.layout.name}|{len(codec.layout.channels)}|{stream.time_base}".encode())
+            for packet in container.demux(stream):
+                if packet.size == 0:
+                    continue
+                sha1.update(f"{packet.pts}|".encode())
+                sha1.update(bytes(packet))
+        _AUDIO_HASH_CACHE[key] = sha1.hexdigest()
+    return _AUDIO_HASH_CACHE[key]
+
+
+def atomic_write(path: str, write_fn: Callable) -> None:
+    """
+    Write path through write_fn(file) into a uniquely named temp file next to it, then rename it into
+    place, so DataLoader workers that build the same missing entry never write the same temp file.
+    """
+    directory, name = os.path.split(path)
+    with tempfile.NamedTemporaryFile(dir=directory or ".", prefix=name + ".", suffix=".tmp", delete=False) as f:
+        tmp_path = f.name
+        try:
+            write_fn(f)
+        except BaseException:
+            f.close()
+            os.remove(tmp_path)
+            raise
+    os.replace(tmp_path, path)
+
+
+class FaceTrack:
+    """
+    Per-frame face detection and mesh results for one video.
+
+    Attributes:
+        boxes (np.ndarray): float16 [F, 4] normalized (xmin, ymin, width, height), NaN where no face was found.
+        scores (np.ndarray): float16 [F] detection confidence, 0 where no face was found.
+        landmarks (np.ndarray): float16 [F, 468, 3] normalized FaceMesh landmarks, NaN where no mesh was found.
+        frame_size (tuple): (height, width) of the frames the track was computed on.
+    """
+    def __init__(self, boxes: np.ndarray, scores: np.ndarray, landmarks: np.ndarray, frame_size: Tuple[int, int]):
+        assert boxes.shape[0] == scores.shape[0] == landmarks.shape[0], "boxes, scores and landmarks must have the same number of frames"
+        self.boxes = boxes.astype(np.float16)
+        self.scores = scores.astype(np.float16)
+        self.landmarks = landmarks.astype(np.float16)
+        self.frame_size = tuple(int(s) for s in frame_size)
+        # [F, 3] yaw/pitch/roll, filled lazily by Net.HeadPoseTracker and kept with the cached track
+        self.head_poses = None
+
+    def __len__(self) -> int:
+        return self.boxes.shape[0]
+
+    def save(self, path: str):
+        atomic_write(path, lambda f: np.savez(f, boxes=self.boxes, scores=self.scores, landmarks=self.landmarks, frame_size=np.array(self.frame_size)))
+
+    @classmethod
+    def load(cls, path: str) -> "FaceTrack":
+        with np.load(path) as data:
+            return cls(data["boxes"], data["scores"], data["landmarks"], tuple(data["frame_size"]))
+
+    def pixel_boxes(self, frame_indices: List[int], height: int, width: int, padding: int = 10) -> np.ndarray:
+        """
+        Padded boxes in pixel coordinates of a (height, width) frame.
+
+        Returns:
+            np.ndarray: int [F, 4] (xmin, ymin, xmax, ymax), all -1 for frames without a face.
+        """
+        boxes = self.boxes[np.asarray(frame_indices)].astype(np.float32)
+        found = ~np.isnan(boxes).any(axis=1)
+        boxes = np.nan_to_num(boxes)
+
+        xmin = (boxes[:, 0] * width).astype(np.int64)
+        ymin = (boxes[:, 1] * height).astype(np.int64)
+        xmax = xmin + (boxes[:, 2] * width).astype(np.int64)
+        ymax = ymin + (boxes[:, 3] * height).astype(np.int64)
+
+        pixel_boxes = np.stack([
+            np.clip(xmin - padding, 0, width),
+            np.clip(ymin - padding, 0, height),
+            np.clip(xmax + padding, 0, width),
+            np.clip(ymax + padding, 0, height),
+        ], axis=1)
+        pixel_boxes[~found] = -1
+        return pixel_boxes
+
+    def face_region_mask(self, frame_indices: List[int], height: int, width: int, padding: int = 10, union: bool = False) -> np.ndarray:
+        """
+        Rasterize face region masks (255 inside the padded box) at any resolution.
+
+        Args:
+            frame_indices (List[int]): Frames to rasterize.
+            height (int), width (int): Output resolution.
+            padding (int): Box padding in output pixels.
+            union (bool): Return the single clip-level mask M (union of all boxes) instead of per-frame masks.
+
+        Returns:
+            np.ndarray: uint8 [F, H, W] masks, or [H, W] when union=True.
+        """
+        pixel_boxes = self.pixel_boxes(frame_indices, height, width, padding)
+        masks = np.zeros((1 if union else len(frame_indices), height, width), dtype=np.uint8)
+        for i, (xmin, ymin, xmax, ymax) in enumerate(pixel_boxes):
+            if xmin < 0:
+                continue
+            masks[0 if union else i, ymin:ymax, xmin:xmax] = 255
+        return masks[0] if union else masks
+
+    def landmarks_px(self, frame_indices: List[int], landmark_ids: List[int], height: int = None, width: int = None) -> np.ndarray:
+        """
+        Selected mesh landmarks in pixel coordinates (defaults to the track resolution).
+
+        Returns:
+            np.ndarray: float64 [F, len(landmark_ids), 2], NaN for frames without a mesh.
+        """
+        height = height or self.frame_size[0]
+        width = width or self.frame_size[1]
+        points = self.landmarks[np.asarray(frame_indices)][:, landmark_ids, :2].astype(np.float64)
+        return points * np.array([width, height], dtype=np.float64)
+
+
+class FaceTrackStore:
+    """
+    On-disk store of FaceTracks (<cache_dir>/<sha1 of mp4>.npz) with a small in-memory LRU.
+    """
+    def __init__(self, cache_dir: str, max_cached: int = 64):
+        self.cache_dir = cache_dir
+        self.max_cached = max_cached
+        self._cache: "OrderedDict[str, FaceTrack]" = OrderedDict()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, mp4_path: str) -> str:
+        return os.path.join(self.cache_dir, f"{content_hash(mp4_path)}.npz")
+
+    def __contains__(self, mp4_path: str) -> bool:
+        return os.path.exists(self.path_for(mp4_path))
+
+    def get(self, mp4_path: str, build_fn: Optional[Callable[[str], FaceTrack]] = None) -> Optional[FaceTrack]:
+        """
+        Load the track for a video, building and persisting it with build_fn if it doesn't exist yet.
+        """
+        key = content_hash(mp4_path)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        path = os.path.join(self.cache_dir, f"{key}.npz")
+        if os.path.exists(path):
+            track = FaceTrack.load(path)
+        elif build_fn is not None:
+            track = build_fn(mp4_path)
+            track.save(path)
+        else:
+            return None
+
+        self._cache[key] = track
+        if len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return track
+
+    def __getstate__(self):
+        # Don't ship cached arrays into DataLoader workers
+        state = self.__dict__.copy()
+        state["_cache"] = OrderedDict()
+        return state
+
+
+class Wav2VecFeatureStore:
+    """
+    On-disk store of wav2vec2 last_hidden_state per clip (<cache_dir>/<sha1 of audio>_<model>_<rate>hz.npy, float16 [T, D]).
+
+    Entries are keyed on the audio stream (audio_hash) and on the wav2vec2 frame rate the rows are
+    indexed at; the video fps only enters at lookup (window_features), so one entry serves any fps.
+    Arrays are memory-mapped, so per-frame and per-window features are small gathers from the page cache
+    instead of a full wav2vec2 forward pass.
+    """
+    def __init__(self, cache_dir: str, model_name: str = 'facebook/wav2vec2-base-960h', max_cached: int = 64, frame_rate: float = 50.0):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.frame_rate = frame_rate  # wav2vec2 hidden states per second
+        self.max_cached = max_cached
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, mp4_path: str) -> str:
+        model_slug = self.model_name.replace('/', '--')
+        return os.path.join(self.cache_dir, f"{audio_hash(mp4_path)}_{model_slug}_{self.frame_rate:g}hz.npy")
+
+    def __contains__(self, mp4_path: str) -> bool:
+        return os.path.exists(self.path_for(mp4_path))
+
+    def get(self, mp4_path: str, build_fn: Optional[Callable[[str], np.ndarray]] = None) -> Optional[np.ndarray]:
+        """
+        Memory-map the hidden states of a clip, computing and persisting them with build_fn if needed.
+
+        Returns:
+            np.ndarray: float16 [T, D] hidden states (one row per wav2vec2 frame), or None if missing and no build_fn.
+        """
+        path = self.path_for(mp4_path)
+        if path in self._cache:
+            self._cache.move_to_end(path)
+            return self._cache[path]
+
+        if not os.path.exists(path):
+            if build_fn is None:
+                return None
+            hidden_states = np.asarray(build_fn(mp4_path), dtype=np.float16)
+            assert hidden_states.ndim == 2, "build_fn must return [T, D] hidden states"
+            atomic_write(path, lambda f: np.save(f, hidden_states))
+
+        # copy-on-write mapping so torch.from_numpy gets a writable view
+        hidden_states = np.load(path, mmap_mode='c')
+        self._cache[path] = hidden_states
+        if len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return hidden_states
+
+    def window_features(self, mp4_path: str, frame_indices: List[int], m: int = 2, n: int = 2,
+                        build_fn: Optional[Callable[[str], np.ndarray]] = None, fps: float = None) -> np.ndarray:
+        """
+        Context-stacked features (m frames before, n after, zero padded at the clip edges) for a set of frames.
+
+        Args:
+            frame_indices (List[int]): wav2vec2 frame indices, or video frame indices when fps is given.
+            fps (float): Video frame rate used to map video frames to the nearest wav2vec2 frame.
+
+        Returns:
+            np.ndarray: float16 [F, m + n + 1, D]; flatten the last two dims for the [F, (m + n + 1) * D] layout.
+        """
+        hidden_states = self.get(mp4_path, build_fn)
+        assert hidden_states is not None, f"No audio features for {mp4_path}"
+        num_frames = hidden_states.shape[0]
+
+        frame_indices = np.asarray(frame_indices)
+        if fps is not None:
+            frame_indices = np.clip(np.round(frame_indices * self.frame_rate / fps).astype(np.int64), 0, num_frames - 1)
+        window = frame_indices[:, None] + np.arange(-m, n + 1)[None, :]
+        valid = (window >= 0) & (window < num_frames)
+        features = hidden_states[np.clip(window, 0, num_frames - 1)]
+        features[~valid] = 0
+        return features
+
+    def frame_features(self, mp4_path: str, frame_index: int, m: int = 2, n: int = 2,
+                       build_fn: Optional[Callable[[str], np.ndarray]] = None, fps: float = None) -> np.ndarray:
+        return self.window_features(mp4_path, [frame_index], m, n, build_fn, fps)[0]
+
+    def clip_features(self, mp4_path: str, m: int = 2, n: int = 2,
+                      build_fn: Optional[Callable[[str], np.ndarray]] = None, fps: float = None) -> np.ndarray:
+        num_frames = self.get(mp4_path, build_fn).shape[0]
+        if fps is not None:
+            num_frames = int(round(num_frames * fps / self.frame_rate))
+        return self.window_features(mp4_path, np.arange(num_frames), m, n, fps=fps)
+
+    def __getstate__(self):
+        # Don't ship open memmaps into DataLoader workers
+        state = self.__dict__.copy()
+        state["_cache"] = OrderedDict()
+        return state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute per-video caches for EMODataset")
+    parser.add_argument("--json_file", type=str, default="./data/overfit.json")
+    parser.add_argument("--video_dir", type=str, required=True)
+    parser.add_argument("--face_track_dir", type=str, default="./face_tracks")
+    parser.add_argument("--audio_feature_dir", type=str, default=None)
+    parser.add_argument("--wav2vec_model", type=str, default="facebook/wav2vec2-base-960h")
+    parser.add_argument("--detect_every", type=int, default=1, help="> 1: run the face detector every N frames and track in between")
+    parser.add_argument("--max_shift", type=float, default=0.05, help="normalized mesh movement between frames that forces a detection")
+    parser.add_argument("--clip_decode", action="store_true", help="cache the ytb_id source videos, as EMODataset(clip_decode=True) reads them")
+    parser.add_argument("--shard_dir", type=str, default=None, help="frame shards of the dataset (clips served from them keep their own mp4)")
+    args = parser.parse_args()
+
+    from Net import FaceHelper, Wav2VecFeatureExtractor
+    from clip_decode import clip_media_path
+    from frame_shards import FrameShardReader
+    from manifest import ClipManifest
+
+    manifest = ClipManifest.open(args.json_file)
+    video_ids = manifest.video_ids()
+    frame_shards = FrameShardReader(args.shard_dir) if args.shard_dir is not None else None
+
+    face_helper = FaceHelper(detect_every=args.detect_every, max_shift=args.max_shift)
+    face_tracks = FaceTrackStore(args.face_track_dir)
+    if args.audio_feature_dir is not None:
+        feature_extractor = Wav2VecFeatureExtractor(model_name=args.wav2vec_model)
+        audio_features = Wav2VecFeatureStore(args.audio_feature_dir, model_name=args.wav2vec_model)
+
+    for i, video_id in enumerate(video_ids):
+        # the same file EMODataset.media_path looks the caches up with
+        mp4_path = clip_media_path(args.video_dir, video_id, manifest if args.clip_decode else None, frame_shards)
+        if not os.path.exists(mp4_path):
+            print(f"Skipping {video_id}: {mp4_path} not found")
+            continue
+        face_helper.detection_rate = None
+        track = face_tracks.get(mp4_path, face_helper.build_face_track)
+        detected = int((track.scores > 0).sum())
+        rate = f", detector ran on {face_helper.detection_rate:.0%} of frames" if face_helper.detection_rate is not None else ""
+        print(f"[{i + 1}/{len(video_ids)}] {video_id}: face found in {detected}/{len(track)} frames{rate}")
+        if args.audio_feature_dir is not None:
+            hidden_states = audio_features.get(mp4_path, feature_extractor.hidden_states_from_mp4)
+            print(f"[{i + 1}/{len(video_ids)}] {video_id}: {hidden_states.shape[0]} wav2vec frames")
@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+from typing import Dict, List, Optional
+
+import decord
+import numpy as np
+import torch
+from decord import VideoReader
+
+decord.logging.set_level(decord.logging.ERROR)
+
+
+# Pre-decoded frame shards for EMODataset.
+# Each CelebV-HQ clip is decoded once (resized to the training resolution) and its raw
+# uint8 RGB frames are appended to a flat shard file. index.json maps every video_id to
+# (shard, byte offset, frame count, fps, shape) so the dataset can take a zero-copy view
+# of the frames through np.memmap. Because the shards are plain files, the page cache
+# shares them between all DataLoader workers.
+#
+# python frame_shards.py --json_file ./data/overfit.json --video_dir /path/to/35666 --out_dir ./frame_shards
+
+INDEX_FILENAME = "index.json"
+
+
+class FrameShardWriter:
+    def __init__(self, out_dir: str, max_shard_bytes: int = 4 * 1024 ** 3):
+        self.out_dir = out_dir
+        self.max_shard_bytes = max_shard_bytes
+        os.makedirs(out_dir, exist_ok=True)
+
+        self.index_path = os.path.join(out_dir, INDEX_FILENAME)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {"videos": {}}
+
+        # Keep appending to the last shard of a previous run
+        shards = sorted({entry["shard"] for entry in self.index["videos"].values()})
+        self.shard_id = int(shards[-1].split('_')[1].split('.')[0]) if shards else 0
+
+    def shard_name(self, shard_id: int) -> str:
+        return f"shard_{shard_id:05d}.bin"
+
+    def __contains__(self, video_id: str) -> bool:
+        return video_id in self.index["videos"]
+
+    def add_video(self, video_id: str, frames: np.ndarray, fps: float):
+        """
+        Append the frames of one video to the current shard.
+
+        Args:
+            video_id (str): Key of the clip in the CelebV-HQ json.
+            frames (np.ndarray): uint8 frames of shape [F, H, W, 3].
+            fps (float): Frame rate of the source video.
+        """
+        assert frames.dtype == np.uint8, "Frames must be uint8"
+        assert frames.ndim == 4 and frames.shape[-1] == 3, "Frames must have shape [F, H, W, 3]"
+
+        shard_path = os.path.join(self.out_dir, self.shard_name(self.shard_id))
+        offset = os.path.getsize(shard_path) if os.path.exists(shard_path) else 0
+        if offset > 0 and offset + frames.nbytes > self.max_shard_bytes:
+            self.shard_id += 1
+            shard_path = os.path.join(self.out_dir, self.shard_name(self.shard_id))
+            offset = 0
+
+        with open(shard_path, 'ab') as f:
+            f.write(np.ascontiguousarray(frames).tobytes())
+
+        self.index["videos"][video_id] = {
+            "shard": self.shard_name(self.shard_id),
+            "offset": offset,
+            "num_frames": int(frames.shape[0]),
+            "fps": float(fps),
+            "shape": [int(s) for s in frames.shape[1:]],
+        }
+
+    def flush(self):
+        # Write the index atomically so a killed pack run never leaves a truncated index
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+
+class FrameShardReader:
+    def __init__(self, shard_dir: str):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, INDEX_FILENAME), 'r') as f:
+            self.index = json.load(f)["videos"]
+        # memmaps are opened lazily so that each DataLoader worker maps the shards itself
+        self._memmaps: Dict[str, np.memmap] = {}
+
+    def __contains__(self, video_id: str) -> bool:
+        return video_id in self.index
+
+    def _shard(self, name: str) -> np.memmap:
+        if name not in self._memmaps:
+            # copy-on-write mapping: pages stay shared in the page cache but the views are writable for torch
+            self._memmaps[name] = np.memmap(os.path.join(self.shard_dir, name), dtype=np.uint8, mode='c')
+        return self._memmaps[name]
+
+    def get_frames(self, video_id: str) -> np.ndarray:
+        """
+        Returns a [F, H, W, 3] uint8 view of all frames of a video (no copy).
+        """
+        entry = self.index[video_id]
+        height, width, channels = entry["shape"]
+        num_bytes = entry["num_frames"] * height * width * channels
+        shard = self._shard(entry["shard"])
+        flat = shard[entry["offset"]:entry["offset"] + num_bytes]
+        return flat.reshape(entry["num_frames"], height, width, channels)
+
+    def open(self, video_id: str) -> "ShardVideoReader":
+        return ShardVideoReader(self.get_frames(video_id), self.index[video_id]["fps"])
+
+    def __getstate__(self):
+        # Never pickle open memmaps into DataLoader workers
+        state = self.__dict__.copy()
+        state["_memmaps"] = {}
+        return state
+
+
+class ShardVideoReader:
+    """
+    Drop-in for the parts of decord.VideoReader that EMODataset uses, backed by a shard view.
+    Frames are returned as torch tensors to match decord.bridge.set_bridge('torch').
+    """
+    def __init__(self, frames: np.ndarray, fps: float):
+        self.frames = frames
+        self.fps = fps
+
+    def __len__(self) -> int:
+        return self.frames.shape[0]
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        return torch.from_numpy(np.asarray(self.frames[idx]))
+
+    def get_batch(self, indices: List[int]) -> torch.Tensor:
+        return torch.from_numpy(self.frames[np.asarray(indices)])
+
+    def get_avg_fps(self) -> float:
+        return self.fps
+
+
+def decode_video(mp4_path: str, width: int, height: int, chunk_size: int = 64):
+    """
+    Decode every frame of a video once, letting decord resize to (width, height).
+
+    Returns:
+        Tuple[np.ndarray, float]: uint8 frames [F, H, W, 3] and the average fps.
+    """
+    video_reader = VideoReader(mp4_path, ctx=decord.cpu(), width=width, height=height)
+    num_frames = len(video_reader)
+    frames = np.empty((num_frames, height, width, 3), dtype=np.uint8)
+    for start in range(0, num_frames, chunk_size):
+        indices = list(range(start, min(start + chunk_size, num_frames)))
+        batch = video_reader.get_batch(indices)
+        frames[start:start + len(indices)] = batch.asnumpy() if hasattr(batch, 'asnumpy') else batch.numpy()
+    return frames, video_reader.get_avg_fps()
+
+
+def pack(json_file: str, video_dir: str, out_dir: str, width: int, height: int, max_shard_bytes: int, video_ids: Optional[List[str]] = None):
+    with open(json_file, 'r') as f:
+        celebvhq_info = json.load(f)
+
+    video_ids = video_ids or list(celebvhq_info['clips'].keys())
+    writer = FrameShardWriter(out_dir, max_shard_bytes=max_shard_bytes)
+
+    for i, video_id in enumerate(video_ids):
+        if video_id in writer:
+            continue
+        mp4_path = os.path.join(video_dir, f"{video_id}.mp4")
+        if not os.path.exists(mp4_path):
+            print(f"Skipping {video_id}: {mp4_path} not found")
+            continue
+
+        frames, fps = decode_video(mp4_path, width, height)
+        writer.add_video(video_id, frames, fps)
+        # Flush after every clip so an interrupted pack can be resumed
+        writer.flush()
+        print(f"[{i + 1}/{len(video_ids)}] packed {video_id}: {frames.shape[0]} frames")
+
+    writer.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Decode CelebV-HQ clips once into memory-mappable frame shards")
+    parser.add_argument("--json_file", type=str, default="./data/overfit.json")
+    parser.add_argument("--video_dir", type=str, required=True)
+    parser.add_argument("--out_dir", type=str, default="./frame_shards")
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--max_shard_gb", type=float, default=4.0)
+    args = parser.parse_args()
+
+    pack(args.json_file, args.video_dir, args.out_dir, args.width, args.height, int(args.max_shard_gb * 1024 ** 3))
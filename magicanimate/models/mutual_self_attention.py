@@ -21,6 +21,44 @@ from diffusers.models.unet_2d_blocks import CrossAttnDownBlock2D, CrossAttnUpBlo
 from .stable_diffusion_controlnet_reference import torch_dfs
 
 
+def _map_bank(bank, fn):
+    # banks are lists of tensors, or lists of lists of tensors for the down/up AdaIN blocks
+    return [_map_bank(v, fn) if isinstance(v, list) else fn(v) for v in bank]
+
+
+# score elements (batch x heads x queries x keys) materialized at once by _partial_attention
+ATTENTION_CHUNK_ELEMENTS = 2 ** 27
+
+
+def _split_heads(x, heads):
+    # [B, L, H * D] -> [B, H, L, D] (view)
+    return x.view(x.shape[0], x.shape[1], heads, -1).transpose(1, 2)
+
+
+def _partial_attention(q, k, v, scale):
+    """
+    Softmax attention of q [B, H, N, D] over k, v [B, H, M, D], in query chunks.
+
+    Returns:
+        out [B, H, N, D] (normalized over these keys only) and lse [B, H, N, 1], the
+        log-sum-exp of the scores, so partials over disjoint key sets can be merged exactly.
+    """
+    chunk_size = max(1, ATTENTION_CHUNK_ELEMENTS // (q.shape[0] * q.shape[1] * k.shape[2]))
+    outs, lses = [], []
+    for start in range(0, q.shape[2], chunk_size):
+        scores = torch.matmul(q[:, :, start:start + chunk_size] * scale, k.transpose(-1, -2)).float()
+        lse = torch.logsumexp(scores, dim=-1, keepdim=True)
+        outs.append(torch.matmul(torch.exp(scores - lse).to(v.dtype), v))
+        lses.append(lse)
+    return torch.cat(outs, dim=2), torch.cat(lses, dim=2)
+
+
+def _merge_partials(out_a, lse_a, out_b, lse_b):
+    # softmax over the union of both key sets from the two partials
+    lse = torch.logaddexp(lse_a, lse_b)
+    return (out_a.float() * torch.exp(lse_a - lse) + out_b.float() * torch.exp(lse_b - lse)).to(out_a.dtype)
+
+
 class AttentionBase:
     def __init__(self):
         self.cur_step = 0
@@ -146,6 +184,12 @@ class ReferenceAttentionControl():
         self.reference_attn = reference_attn
         self.reference_adain = reference_adain
         self.fusion_blocks = fusion_blocks
+        # module lists and writer -> reader pairing are computed once, not on every update()
+        self._attention_modules = None
+        self._norm_modules = None
+        self._paired_writer = None
+        self._attn_pairs = []
+        self._norm_pairs = []
         self.register_reference_hooks(
             mode, 
             do_classifier_free_guidance,
@@ -234,10 +278,50 @@ class ReferenceAttentionControl():
                         attention_mask=attention_mask,
                         **cross_attention_kwargs,
                     )
-                if MODE == "read":
-                    self.bank = [rearrange(d.unsqueeze(1).repeat(1, video_length, 1, 1), "b t l c -> (b t) l c")[:hidden_states.shape[0]] for d in self.bank]
+                if MODE == "read" and attention_mask is None:
+                    # attention over [frame tokens || reference tokens] as two partials merged by
+                    # log-sum-exp: the reference K/V are projected once per step and broadcast over
+                    # the frames instead of being repeated and concatenated per frame
+                    attn = self.attn1
+                    heads = attn.heads
+                    bf, length, _ = norm_hidden_states.shape
+                    b = bf // video_length
+                    query = attn.to_q(norm_hidden_states)
+                    out_self, lse_self = _partial_attention(
+                        _split_heads(query, heads), _split_heads(attn.to_k(norm_hidden_states), heads), _split_heads(attn.to_v(norm_hidden_states), heads), attn.scale
+                    )
+                    out_self, lse_self = out_self.transpose(1, 2), lse_self.transpose(1, 2)  # [(b f), L, H, *]
+                    if len(self.bank) > 0:
+                        if self.bank_kv is None:
+                            reference = torch.cat(self.bank, dim=1).to(norm_hidden_states.dtype)
+                            self.bank_kv = (_split_heads(attn.to_k(reference), heads), _split_heads(attn.to_v(reference), heads))
+                        key_ref, value_ref = self.bank_kv
+                        # frames of batch row i attend to reference row i: queries as [b, H, f * L, D]
+                        out_ref, lse_ref = _partial_attention(
+                            query.view(b, video_length * length, heads, -1).transpose(1, 2), key_ref[:b], value_ref[:b], attn.scale
+                        )
+                        out_ref = out_ref.transpose(1, 2).reshape(bf, length, heads, -1)
+                        lse_ref = lse_ref.transpose(1, 2).reshape(bf, length, heads, 1)
+                        out = _merge_partials(out_self, lse_self, out_ref, lse_ref)
+                    else:
+                        out = out_self
+                    if do_classifier_free_guidance:
+                        _uc_mask = uc_mask
+                        if hidden_states.shape[0] != _uc_mask.shape[0]:
+                            _uc_mask = (
+                                torch.Tensor([1] * (hidden_states.shape[0]//2) + [0] * (hidden_states.shape[0]//2))
+                                .to(device)
+                                .bool()
+                            )
+                        # the uc rows attend to their own frame only: that's the self partial
+                        out[_uc_mask.to(out.device)] = out_self[_uc_mask.to(out.device)]
+                    out = out.reshape(bf, length, -1)
+                    hidden_states = attn.to_out[1](attn.to_out[0](out)) + hidden_states
+                elif MODE == "read":
+                    # the bank is shared with the writer for the whole step, so it is only read here
+                    bank = [rearrange(d.unsqueeze(1).repeat(1, video_length, 1, 1), "b t l c -> (b t) l c")[:hidden_states.shape[0]] for d in self.bank]
                     hidden_states_uc = self.attn1(norm_hidden_states, 
-                                                encoder_hidden_states=torch.cat([norm_hidden_states] + self.bank, dim=1),
+                                                encoder_hidden_states=torch.cat([norm_hidden_states] + bank, dim=1),
                                                 attention_mask=attention_mask) + hidden_states
                     hidden_states_c = hidden_states_uc.clone()
                     _uc_mask = uc_mask.clone()
@@ -254,8 +338,8 @@ class ReferenceAttentionControl():
                             attention_mask=attention_mask,
                         ) + hidden_states[_uc_mask]
                     hidden_states = hidden_states_c.clone()
-                        
-                    self.bank.clear()
+
+                if MODE == "read":
                     if self.attn2 is not None:
                         # Cross-Attention
                         norm_hidden_states = (
@@ -336,8 +420,6 @@ class ReferenceAttentionControl():
                     if do_classifier_free_guidance and style_fidelity > 0:
                         x_c[uc_mask] = x[uc_mask]
                     x = style_fidelity * x_c + (1.0 - style_fidelity) * x_uc
-                self.mean_bank = []
-                self.var_bank = []
             return x
 
         def hack_CrossAttnDownBlock2D_forward(
@@ -384,10 +466,6 @@ class ReferenceAttentionControl():
 
                 output_states = output_states + (hidden_states,)
 
-            if MODE == "read":
-                self.mean_bank = []
-                self.var_bank = []
-
             if self.downsamplers is not None:
                 for downsampler in self.downsamplers:
                     hidden_states = downsampler(hidden_states)
@@ -424,10 +502,6 @@ class ReferenceAttentionControl():
 
                 output_states = output_states + (hidden_states,)
 
-            if MODE == "read":
-                self.mean_bank = []
-                self.var_bank = []
-
             if self.downsamplers is not None:
                 for downsampler in self.downsamplers:
                     hidden_states = downsampler(hidden_states)
@@ -482,10 +556,6 @@ class ReferenceAttentionControl():
                             hidden_states_c[uc_mask] = hidden_states[uc_mask].to(hidden_states_c.dtype)
                         hidden_states = style_fidelity * hidden_states_c + (1.0 - style_fidelity) * hidden_states_uc
 
-            if MODE == "read":
-                self.mean_bank = []
-                self.var_bank = []
-
             if self.upsamplers is not None:
                 for upsampler in self.upsamplers:
                     hidden_states = upsampler(hidden_states, upsample_size)
@@ -519,10 +589,6 @@ class ReferenceAttentionControl():
                             hidden_states_c[uc_mask] = hidden_states[uc_mask].to(hidden_states_c.dtype)
                         hidden_states = style_fidelity * hidden_states_c + (1.0 - style_fidelity) * hidden_states_uc
 
-            if MODE == "read":
-                self.mean_bank = []
-                self.var_bank = []
-
             if self.upsamplers is not None:
                 for upsampler in self.upsamplers:
                     hidden_states = upsampler(hidden_states, upsample_size)
@@ -530,16 +596,13 @@ class ReferenceAttentionControl():
             return hidden_states
 
         if self.reference_attn:
-            if self.fusion_blocks == "midup":
-                attn_modules = [module for module in (torch_dfs(self.unet.mid_block)+torch_dfs(self.unet.up_blocks)) if isinstance(module, BasicTransformerBlock) or isinstance(module, _BasicTransformerBlock)]
-            elif self.fusion_blocks == "full":
-                attn_modules = [module for module in torch_dfs(self.unet) if isinstance(module, BasicTransformerBlock) or isinstance(module, _BasicTransformerBlock)]            
-            attn_modules = sorted(attn_modules, key=lambda x: -x.norm1.normalized_shape[0])
+            attn_modules = self.attention_modules()
 
             for i, module in enumerate(attn_modules):
                 module._original_inner_forward = module.forward
                 module.forward = hacked_basic_transformer_inner_forward.__get__(module, BasicTransformerBlock)
                 module.bank = []
+                module.bank_kv = None
                 module.attn_weight = float(i) / float(len(attn_modules))
 
         if self.reference_adain:
@@ -574,69 +637,82 @@ class ReferenceAttentionControl():
                 module.var_bank = []
                 module.gn_weight *= 2
     
-    def update(self, writer, dtype=torch.float16):
-        if self.reference_attn:
+    def attention_modules(self):
+        # transformer blocks taking part in reference attention, in bank order (widest first)
+        if self._attention_modules is None:
             if self.fusion_blocks == "midup":
-                reader_attn_modules = [module for module in (torch_dfs(self.unet.mid_block)+torch_dfs(self.unet.up_blocks)) if isinstance(module, _BasicTransformerBlock)]
-                writer_attn_modules = [module for module in (torch_dfs(writer.unet.mid_block)+torch_dfs(writer.unet.up_blocks)) if isinstance(module, BasicTransformerBlock)]
-            elif self.fusion_blocks == "full":
-                reader_attn_modules = [module for module in torch_dfs(self.unet) if isinstance(module, _BasicTransformerBlock)]
-                writer_attn_modules = [module for module in torch_dfs(writer.unet) if isinstance(module, BasicTransformerBlock)]
-            reader_attn_modules = sorted(reader_attn_modules, key=lambda x: -x.norm1.normalized_shape[0])    
-            writer_attn_modules = sorted(writer_attn_modules, key=lambda x: -x.norm1.normalized_shape[0])
-            for r, w in zip(reader_attn_modules, writer_attn_modules):
-                r.bank = [v.clone().to(dtype) for v in w.bank]
-                # w.bank.clear()
+                modules = torch_dfs(self.unet.mid_block) + torch_dfs(self.unet.up_blocks)
+            else:
+                modules = torch_dfs(self.unet)
+            modules = [module for module in modules if isinstance(module, BasicTransformerBlock) or isinstance(module, _BasicTransformerBlock)]
+            self._attention_modules = sorted(modules, key=lambda x: -x.norm1.normalized_shape[0])
+        return self._attention_modules
+
+    def norm_modules(self):
+        # blocks taking part in reference AdaIN, in bank order
+        if self._norm_modules is None:
+            self._norm_modules = [self.unet.mid_block] + list(self.unet.down_blocks) + list(self.unet.up_blocks)
+        return self._norm_modules
+
+    def pair(self, writer):
+        """
+        Pair this reader's blocks with the writer's blocks (once per writer).
+        """
+        if writer is not self._paired_writer:
+            self._attn_pairs = list(zip(self.attention_modules(), writer.attention_modules())) if self.reference_attn else []
+            self._norm_pairs = list(zip(self.norm_modules(), writer.norm_modules())) if self.reference_adain else []
+            self._paired_writer = writer
+        return self._attn_pairs, self._norm_pairs
+
+    def export_banks(self, dtype=torch.float16, device="cpu"):
+        """
+        Copy of the banks filled by a write-mode pass (attention banks and AdaIN mean/var banks),
+        in the layout load_banks expects.
+        """
+        convert = lambda bank: _map_bank(bank, lambda v: v.detach().to(device=device, dtype=dtype))
+        banks = {}
+        if self.reference_attn:
+            banks["attn"] = [convert(module.bank) for module in self.attention_modules()]
         if self.reference_adain:
-            reader_gn_modules = [self.unet.mid_block]
-            
-            down_blocks = self.unet.down_blocks
-            for w, module in enumerate(down_blocks):
-                reader_gn_modules.append(module)
+            banks["adain"] = [(convert(module.mean_bank), convert(module.var_bank)) for module in self.norm_modules()]
+        return banks
 
-            up_blocks = self.unet.up_blocks
-            for w, module in enumerate(up_blocks):
-                reader_gn_modules.append(module)
-                
-            writer_gn_modules = [writer.unet.mid_block]
-            
-            down_blocks = writer.unet.down_blocks
-            for w, module in enumerate(down_blocks):
-                writer_gn_modules.append(module)
+    def load_banks(self, banks, device, dtype=torch.float16):
+        """
+        Fill the banks from export_banks output, as if a write-mode pass had just run.
+        """
+        convert = lambda bank: _map_bank(bank, lambda v: v.to(device=device, dtype=dtype))
+        if self.reference_attn:
+            modules = self.attention_modules()
+            assert len(modules) == len(banks["attn"]), "Attention banks don't match the UNet's transformer blocks"
+            for module, bank in zip(modules, banks["attn"]):
+                module.bank = convert(bank)
+        if self.reference_adain:
+            for module, (mean_bank, var_bank) in zip(self.norm_modules(), banks["adain"]):
+                module.mean_bank = convert(mean_bank)
+                module.var_bank = convert(var_bank)
+
+    def update(self, writer, dtype=torch.float16):
+        """
+        Point the reader's banks at the writer's banks; call once per denoising step, after the
+        writer pass and before the UNet windows. Tensors are shared, only cast when the dtype differs.
+        """
+        attn_pairs, norm_pairs = self.pair(writer)
+        share = lambda bank: _map_bank(bank, lambda v: v if v.dtype == dtype else v.to(dtype))
+        for r, w in attn_pairs:
+            r.bank = share(w.bank)
+            r.bank_kv = None
+        for r, w in norm_pairs:
+            r.mean_bank = share(w.mean_bank)
+            r.var_bank = share(w.var_bank)
 
-            up_blocks = writer.unet.up_blocks
-            for w, module in enumerate(up_blocks):
-                writer_gn_modules.append(module)
-            
-            for r, w in zip(reader_gn_modules, writer_gn_modules):
-                if len(w.mean_bank) > 0 and isinstance(w.mean_bank[0], list):
-                    r.mean_bank = [[v.clone().to(dtype) for v in vl] for vl in w.mean_bank]
-                    r.var_bank = [[v.clone().to(dtype) for v in vl] for vl in w.var_bank]
-                else:
-                    r.mean_bank = [v.clone().to(dtype) for v in w.mean_bank]
-                    r.var_bank = [v.clone().to(dtype) for v in w.var_bank]
-    
     def clear(self):
+        # rebinds rather than empties the lists, which may be shared with the other side
         if self.reference_attn:
-            if self.fusion_blocks == "midup":
-                reader_attn_modules = [module for module in (torch_dfs(self.unet.mid_block)+torch_dfs(self.unet.up_blocks)) if isinstance(module, BasicTransformerBlock) or isinstance(module, _BasicTransformerBlock)]
-            elif self.fusion_blocks == "full":
-                reader_attn_modules = [module for module in torch_dfs(self.unet) if isinstance(module, BasicTransformerBlock) or isinstance(module, _BasicTransformerBlock)]
-            reader_attn_modules = sorted(reader_attn_modules, key=lambda x: -x.norm1.normalized_shape[0])
-            for r in reader_attn_modules:
-                r.bank.clear()
+            for module in self.attention_modules():
+                module.bank = []
+                module.bank_kv = None
         if self.reference_adain:
-            reader_gn_modules = [self.unet.mid_block]
-            
-            down_blocks = self.unet.down_blocks
-            for w, module in enumerate(down_blocks):
-                reader_gn_modules.append(module)
-
-            up_blocks = self.unet.up_blocks
-            for w, module in enumerate(up_blocks):
-                reader_gn_modules.append(module)
-            
-            for r in reader_gn_modules:
-                r.mean_bank.clear()
-                r.var_bank.clear()
-            
\ No newline at end of file
+            for module in self.norm_modules():
+                module.mean_bank = []
+                module.var_bank = []
@@ -138,6 +138,8 @@ def main(args):
     del motion_module_state_dict
 
     pipeline.to(device)
+    if config.get("identity_cache_dir", None):
+        pipeline.enable_identity_cache(config.identity_cache_dir)
     ### <<< create validation pipeline <<< ###
     
     random_seeds = config.get("seed", [-1])
@@ -172,15 +174,14 @@ def main(args):
         config.random_seed.append(torch.initial_seed())
 
         if test_video.endswith('.mp4'):
-            control = VideoReader(test_video).read()
-            if control[0].shape[0] != size:
-                control = [np.array(Image.fromarray(c).resize((size, size))) for c in control]
+            # decode only the used window, resized during decode, into one preallocated buffer
             if config.max_length is not None:
-                control = control[config.offset: (config.offset+config.max_length)]
-            control = np.array(control)
+                control = VideoReader(test_video).read(start_frame=config.offset, num_frames=config.max_length, size=size)
+            else:
+                control = VideoReader(test_video).read(size=size)
         
         if source_image.endswith(".mp4"):
-            source_image = np.array(Image.fromarray(VideoReader(source_image).read()[0]).resize((size, size)))
+            source_image = np.array(Image.fromarray(VideoReader(source_image).read(num_frames=1)[0]).resize((size, size)))
         else:
             source_image = np.array(Image.open(source_image).resize((size, size)))
         H, W, C = source_image.shape
@@ -210,6 +211,8 @@ def main(args):
             reference_control_writer = reference_control_writer,
             reference_control_reader = reference_control_reader,
             source_image             = source_image,
+            reference_timesteps      = config.get("reference_timesteps", None),
+            reference_lookup         = config.get("reference_lookup", "nearest"),
             **dist_kwargs,
         ).videos
 
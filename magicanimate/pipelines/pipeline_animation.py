@@ -61,6 +61,7 @@ from magicanimate.pipelines.context import (
     get_total_steps
 )
 from magicanimate.utils.util import get_tensor_interpolation_method
+from magicanimate.utils.reference_banks import IdentityBankCache, ReferenceBankSource
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
@@ -148,6 +149,14 @@ class AnimationPipeline(DiffusionPipeline):
             scheduler=scheduler,
         )
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
+        self.identity_cache = None
+
+    def enable_identity_cache(self, cache_dir: Optional[str] = None, max_cached: int = 4):
+        # Reuse the appearance encoder's reference banks across calls with the same source image / resolution / timesteps
+        self.identity_cache = IdentityBankCache(cache_dir, max_cached=max_cached)
+
+    def disable_identity_cache(self):
+        self.identity_cache = None
 
     def enable_vae_slicing(self):
         self.vae.enable_slicing()
@@ -553,6 +562,8 @@ class AnimationPipeline(DiffusionPipeline):
         reference_control_reader = None,
         source_image: str = None,
         decoder_consistency = None, 
+        reference_timesteps: Optional[Union[int, List[int]]] = None,
+        reference_lookup: str = "nearest",
         **kwargs,
     ):
         """
@@ -561,6 +572,8 @@ class AnimationPipeline(DiffusionPipeline):
         - controlnet_conditioning_scale : conditioning scale for controlnet
         - init_latents                  : initial latents to begin with (used along with invert())
         - num_actual_inference_steps    : number of actual inference steps (while total steps is num_inference_steps) 
+        - reference_timesteps           : anchor timestep(s) to compute the reference banks at once, instead of running the appearance encoder every step
+        - reference_lookup              : "nearest" anchor or "interpolate" between anchors (with reference_timesteps)
         """
         controlnet = self.controlnet
 
@@ -649,12 +662,26 @@ class AnimationPipeline(DiffusionPipeline):
             num_actual_inference_steps = num_inference_steps
         
         if isinstance(source_image, str):
-            ref_image_latents = self.images2latents(np.array(Image.open(source_image).resize((width, height)))[None, :], latents_dtype).cuda()
-        elif isinstance(source_image, np.ndarray):
-            ref_image_latents = self.images2latents(source_image[None, :], latents_dtype).cuda()
+            source_image = np.array(Image.open(source_image).resize((width, height)))
+        ref_image_latents = self.images2latents(source_image[None, :], latents_dtype).cuda()
         
         context_scheduler = get_context_scheduler(context_schedule)
-        
+
+        # Reference banks: anchor timesteps / identity cache / appearance encoder at every step
+        reference_banks = ReferenceBankSource(
+            reference_control_writer,
+            appearance_encoder,
+            ref_image_latents.repeat(context_batch_size * (2 if do_classifier_free_guidance else 1), 1, 1, 1),
+            text_embeddings,
+            timesteps.tolist(),
+            reference_timesteps=reference_timesteps,
+            lookup=reference_lookup,
+            identity_cache=self.identity_cache,
+            source_image=source_image,
+            resolution=(height, width),
+            extra=(appearance_encoder.config.get("_name_or_path", ""), repr(prompt), repr(negative_prompt), context_batch_size, do_classifier_free_guidance),
+        )
+
         # Denoising loop
         for i, t in tqdm(enumerate(timesteps), total=len(timesteps), disable=(rank!=0)):
             if num_actual_inference_steps is not None and i < num_inference_steps - num_actual_inference_steps:
@@ -669,12 +696,7 @@ class AnimationPipeline(DiffusionPipeline):
                 (1, 1, latents.shape[2], 1, 1), device=latents.device, dtype=latents.dtype
             )
 
-            appearance_encoder(
-                ref_image_latents.repeat(context_batch_size * (2 if do_classifier_free_guidance else 1), 1, 1, 1),
-                t,
-                encoder_hidden_states=text_embeddings,
-                return_dict=False,
-            )
+            reference_banks.step(t)
             
             context_queue = list(context_scheduler(
                 0, num_inference_steps, latents.shape[2], context_frames, context_stride, 0
@@ -715,6 +737,8 @@ class AnimationPipeline(DiffusionPipeline):
             for i in range(num_context_batches):
                 global_context.append(context_queue[i*context_batch_size: (i+1)*context_batch_size])
             
+            # the reader shares the writer's banks for every window of this step
+            reference_control_reader.update(reference_control_writer)
             for context in global_context[rank::world_size]:
                 # expand the latents if we are doing classifier free guidance
                 latent_model_input = (
@@ -732,8 +756,6 @@ class AnimationPipeline(DiffusionPipeline):
                     b, f
                 )
                 
-                reference_control_reader.update(reference_control_writer)
-                
                 # predict the noise residual
                 pred = self.unet(
                     latent_model_input, 
@@ -744,14 +766,14 @@ class AnimationPipeline(DiffusionPipeline):
                     return_dict=False,
                 )[0]
                 
-                reference_control_reader.clear()
-                
                 pred_uc, pred_c = pred.chunk(2)
                 pred = torch.cat([pred_uc.unsqueeze(0), pred_c.unsqueeze(0)])
                 for j, c in enumerate(context):
                     noise_pred[:, :, c] = noise_pred[:, :, c] + pred[:, j]
                     counter[:, :, c] = counter[:, :, c] + 1
                     
+            reference_control_reader.clear()
+
             if is_dist_initialized:
                 noise_pred_gathered = [torch.zeros_like(noise_pred) for _ in range(world_size)]
                 if rank == 0:
@@ -781,6 +803,8 @@ class AnimationPipeline(DiffusionPipeline):
             
             reference_control_writer.clear()
 
+        reference_banks.finish()
+
         interpolation_factor = 1
         latents = self.interpolate_latents(latents, interpolation_factor, device)
         # Post-processing
@@ -0,0 +1,277 @@
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+
+
+# Identity cache for the reference (appearance encoder) banks.
+# The write-mode ReferenceAttentionControl banks only depend on the source image, the output
+# resolution, the scheduler timesteps and the fused blocks, so for an avatar that is rendered
+# again and again they are computed once and then served from here: per-timestep attention and
+# AdaIN mean/var banks stored as fp16 on disk, with the most recent identities kept in memory.
+
+
+def image_hash(image: np.ndarray) -> str:
+    # content hash of the (already resized) source image pixels
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha1(str((image.shape, image.dtype.str)).encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def bank_key(source_hash: str, resolution: Sequence[int], timesteps: Sequence[int], fusion_blocks: str, extra: Sequence[Any] = ()) -> str:
+    """
+    Cache key of one identity's banks.
+
+    Args:
+        source_hash (str): image_hash of the source image.
+        resolution (tuple): (height, width) of the render.
+        timesteps (list): Scheduler timesteps of the render.
+        fusion_blocks (str): "midup" or "full".
+        extra (tuple): Anything else the banks depend on (model path, batch layout...).
+    """
+    description = repr((source_hash, tuple(int(v) for v in resolution), tuple(int(t) for t in timesteps), fusion_blocks, tuple(extra)))
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+class IdentityBankCache:
+    """
+    key -> {timestep: banks} (ReferenceAttentionControl.export_banks layout), as fp16 .pt files
+    in cache_dir and an in-memory LRU of max_cached identities. cache_dir=None keeps memory only.
+    """
+    def __init__(self, cache_dir: Optional[str] = None, max_cached: int = 4):
+        self.cache_dir = cache_dir
+        self.max_cached = max_cached
+        self._cache: "OrderedDict[str, Dict[int, Dict[str, Any]]]" = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, key: str) -> Optional[str]:
+        return os.path.join(self.cache_dir, f"{key}.pt") if self.cache_dir is not None else None
+
+    def _remember(self, key: str, banks: Dict[int, Dict[str, Any]]):
+        self._cache[key] = banks
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        path = self.path_for(key)
+        return key in self._cache or (path is not None and os.path.exists(path))
+
+    def get(self, key: str) -> Optional[Dict[int, Dict[str, Any]]]:
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        path = self.path_for(key)
+        if path is None or not os.path.exists(path):
+            return None
+        banks = torch.load(path, map_location="cpu")
+        self._remember(key, banks)
+        return banks
+
+    def put(self, key: str, banks: Dict[int, Dict[str, Any]]):
+        self._remember(key, banks)
+        path = self.path_for(key)
+        if path is not None:
+            tmp_path = path + ".tmp"
+            torch.save(banks, tmp_path)
+            os.replace(tmp_path, path)
+
+
+# Timestep-invariant reference mode.
+# The reference self-attention features change little across timesteps, so instead of running the
+# appearance encoder at every step the banks can be computed once at one or a few anchor timesteps
+# and looked up (nearest anchor, or linear interpolation between the two neighbouring anchors).
+
+
+def anchor_timesteps(reference_timesteps) -> List[int]:
+    # int or list of ints -> sorted, de-duplicated anchor timesteps
+    if isinstance(reference_timesteps, int):
+        reference_timesteps = [reference_timesteps]
+    anchors = sorted(set(int(t) for t in reference_timesteps))
+    assert len(anchors) > 0, "reference_timesteps needs at least one anchor timestep"
+    return anchors
+
+
+def banks_to(banks, device, dtype):
+    # export_banks layout moved to device / dtype
+    if isinstance(banks, dict):
+        return {key: banks_to(value, device, dtype) for key, value in banks.items()}
+    if isinstance(banks, (list, tuple)):
+        return type(banks)(banks_to(value, device, dtype) for value in banks)
+    return banks.to(device=device, dtype=dtype)
+
+
+def _blend(a, b, weight: float):
+    # (1 - weight) * a + weight * b over the nested export_banks layout
+    if isinstance(a, dict):
+        return {key: _blend(a[key], b[key], weight) for key in a}
+    if isinstance(a, (list, tuple)):
+        return type(a)(_blend(x, y, weight) for x, y in zip(a, b))
+    return torch.lerp(a, b, weight)
+
+
+def lookup_banks(banks: Dict[int, Dict[str, Any]], timestep: int, mode: str = "nearest") -> Dict[str, Any]:
+    """
+    Banks for timestep from banks computed at anchor timesteps.
+
+    Args:
+        banks (dict): {anchor timestep: export_banks output}.
+        timestep (int): Current scheduler timestep.
+        mode (str): "nearest" or "interpolate" (linear between the neighbouring anchors, clamped at the ends).
+    """
+    assert mode in ("nearest", "interpolate"), f"Unknown reference lookup {mode}"
+    anchors = sorted(banks)
+    timestep = int(timestep)
+    if mode == "nearest" or len(anchors) == 1:
+        return banks[min(anchors, key=lambda anchor: abs(anchor - timestep))]
+    if timestep <= anchors[0]:
+        return banks[anchors[0]]
+    if timestep >= anchors[-1]:
+        return banks[anchors[-1]]
+    upper = next(anchor for anchor in anchors if anchor >= timestep)
+    lower = max(anchor for anchor in anchors if anchor <= timestep)
+    if upper == lower:
+        return banks[lower]
+    return _blend(banks[lower], banks[upper], (timestep - lower) / (upper - lower))
+
+
+class ReferenceBankSource:
+    """
+    Fills the write-mode ReferenceAttentionControl's banks at every denoising step of one pipeline call,
+    from the cheapest source available:
+
+    - reference_timesteps set: banks computed once at the anchor timesteps before the loop, kept on
+      the device and looked up (nearest / interpolate) at every step;
+    - identity cache hit: banks of an earlier call for the same identity;
+    - otherwise the appearance encoder runs at the step's timestep.
+
+    Banks computed here are stored in the identity cache (when one is given) by finish().
+
+    Args:
+        writer (ReferenceAttentionControl): Write-mode control hooked into appearance_encoder.
+        appearance_encoder: Reference UNet.
+        ref_latents (torch.Tensor): Source image latents, already repeated to the writer's batch.
+        encoder_hidden_states (torch.Tensor): Text embeddings for the appearance encoder.
+        timesteps (list): Scheduler timesteps of the call.
+        reference_timesteps (int or list): Anchor timestep(s), None to follow every step.
+        lookup (str): "nearest" or "interpolate" between anchors.
+        identity_cache (IdentityBankCache): Optional cache.
+        source_image (np.ndarray): Resized source image (cache key).
+        resolution (tuple): (height, width) of the render (cache key).
+        extra (tuple): Anything else the banks depend on (cache key).
+    """
+    def __init__(self, writer, appearance_encoder, ref_latents: torch.Tensor, encoder_hidden_states: torch.Tensor,
+                 timesteps: Sequence[int], reference_timesteps=None, lookup: str = "nearest",
+                 identity_cache: Optional[IdentityBankCache] = None, source_image: Optional[np.ndarray] = None,
+                 resolution: Sequence[int] = (), extra: Sequence[Any] = ()):
+        self.writer = writer
+        self.appearance_encoder = appearance_encoder
+        self.ref_latents = ref_latents
+        self.encoder_hidden_states = encoder_hidden_states
+        self.lookup = lookup
+        self.device = ref_latents.device
+        self.dtype = appearance_encoder.dtype
+        self.identity_cache = identity_cache
+
+        bank_timesteps = [int(t) for t in timesteps] if reference_timesteps is None else anchor_timesteps(reference_timesteps)
+        self.cached_banks, self.new_banks = None, None
+        if identity_cache is not None:
+            self.key = bank_key(image_hash(source_image), resolution, bank_timesteps, writer.fusion_blocks, extra=extra)
+            self.cached_banks = identity_cache.get(self.key)
+            self.new_banks = {} if self.cached_banks is None else None
+
+        self.anchor_banks = None
+        if reference_timesteps is not None:
+            self.anchor_banks = {}
+            for anchor in bank_timesteps:
+                if self.cached_banks is not None and anchor in self.cached_banks:
+                    banks = self.cached_banks[anchor]
+                else:
+                    self.run_encoder(anchor)
+                    banks = writer.export_banks()
+                    writer.clear()
+                    if self.new_banks is not None:
+                        self.new_banks[anchor] = banks
+                self.anchor_banks[anchor] = banks_to(banks, device=self.device, dtype=self.dtype)
+
+    def run_encoder(self, timestep):
+        self.appearance_encoder(self.ref_latents, timestep, encoder_hidden_states=self.encoder_hidden_states, return_dict=False)
+
+    def step(self, timestep):
+        """
+        Fill the writer's banks for this timestep (cleared by writer.clear() at the end of the step).
+        """
+        if self.anchor_banks is not None:
+            self.writer.load_banks(lookup_banks(self.anchor_banks, timestep, self.lookup), device=self.device, dtype=self.dtype)
+        elif self.cached_banks is not None and int(timestep) in self.cached_banks:
+            self.writer.load_banks(self.cached_banks[int(timestep)], device=self.device, dtype=self.dtype)
+        else:
+            self.run_encoder(timestep)
+            if self.new_banks is not None:
+                self.new_banks[int(timestep)] = self.writer.export_banks()
+
+    def finish(self):
+        # store the banks computed by this call for the next render of the identity
+        if self.new_banks:
+            self.identity_cache.put(self.key, self.new_banks)
+
+
+def _psnr(video: torch.Tensor, reference: torch.Tensor) -> float:
+    # videos in [0, 1]
+    mse = torch.mean((video.float() - reference.float()) ** 2).item()
+    return float("inf") if mse == 0 else 10.0 * np.log10(1.0 / mse)
+
+
+def reference_mode_report(pipeline, modes: Dict[str, Dict[str, Any]], seed: int = 0, **call_kwargs) -> List[Dict[str, Any]]:
+    """
+    Latency and quality of timestep-invariant reference modes against the per-step baseline.
+
+    Every mode renders the same call (same seed) and is compared with the baseline render
+    (appearance encoder at every step) by PSNR and mean absolute pixel difference.
+
+    Args:
+        pipeline: AnimationPipeline / EMOAnimationPipeline.
+        modes (dict): name -> extra call kwargs, e.g. {"t500": {"reference_timesteps": 500},
+            "3 anchors": {"reference_timesteps": [800, 500, 200], "reference_lookup": "interpolate"}}.
+        seed (int): Generator seed used for every render.
+        call_kwargs: The pipeline call arguments shared by all renders.
+
+    Returns:
+        list: One dict per render (baseline first) with mode, seconds, speedup, psnr, mean_abs_diff.
+    """
+    def render(extra):
+        generator = torch.Generator(device=pipeline._execution_device).manual_seed(seed)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        video = pipeline(generator=generator, **call_kwargs, **extra).videos
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return video, time.perf_counter() - start
+
+    baseline, baseline_seconds = render({"reference_timesteps": None})
+    rows = [{"mode": "per-step", "seconds": baseline_seconds, "speedup": 1.0, "psnr": float("inf"), "mean_abs_diff": 0.0}]
+    for name, extra in modes.items():
+        video, seconds = render(extra)
+        rows.append({
+            "mode": name,
+            "seconds": seconds,
+            "speedup": baseline_seconds / seconds,
+            "psnr": _psnr(video, baseline),
+            "mean_abs_diff": torch.mean(torch.abs(video.float() - baseline.float())).item(),
+        })
+    return rows
+
+
+def print_reference_mode_report(rows: List[Dict[str, Any]]):
+    header = f"{'mode':<24}{'seconds':>10}{'speedup':>10}{'PSNR dB':>10}{'mean |diff|':>13}"
+    print(header)
+    print("-" * len(header))
+    for row in rows:
+        print(f"{row['mode']:<24}{row['seconds']:>10.2f}{row['speedup']:>10.2f}{row['psnr']:>10.2f}{row['mean_abs_diff']:>13.4f}")
@@ -14,19 +14,21 @@
 # disclosure or distribution of this material and related documentation
 # without an express license agreement from ByteDance or
 # its affiliates is strictly prohibited.
-import av, gc
+import av
+import hashlib
+import os
+import tempfile
 import torch
 import warnings
 import numpy as np
 
 
-_CALLED_TIMES = 0
-_GC_COLLECTION_INTERVAL = 20
-
-
 # remove warnings
 av.logging.set_level(av.logging.ERROR)
 
+# frame indexes (.vidx.npz) live in a writable cache, never next to the (possibly read-only) videos
+DEFAULT_INDEX_DIR = os.environ.get("VIDEOREADER_INDEX_DIR", os.path.join(os.path.expanduser("~"), ".cache", "magicanimate", "video_index"))
+
 
 class VideoReader():
     """
@@ -34,13 +36,17 @@ class VideoReader():
     dealing with video reading. PyAV is a pythonic binding for the ffmpeg libraries.
     Acknowledgement: Codes are borrowed from Bruno Korbar
     """
-    def __init__(self, video, num_frames=float("inf"), decode_lossy=False, audio_resample_rate=None, bi_frame=False):
+    def __init__(self, video, num_frames=float("inf"), decode_lossy=False, audio_resample_rate=None, bi_frame=False, index_dir=None):
         """
         Arguments:
             video_path (str): path or byte of the video to be loaded
+            index_dir (str): where the frame index of the video is cached (default DEFAULT_INDEX_DIR)
         """
         self.container = av.open(video)
+        self.path = video if isinstance(video, str) else None
+        self.index_dir = index_dir if index_dir is not None else DEFAULT_INDEX_DIR
         self.num_frames = num_frames
+        self._index = None
         self.bi_frame = bi_frame
         
         self.resampler = None
@@ -62,52 +68,164 @@ class VideoReader():
         stream = self.video_stream
         self.container.seek(pts, any_frame=any_frame, backward=backward, stream=stream)
 
-    def _occasional_gc(self):
-        # there are a lot of reference cycles in PyAV, so need to manually call
-        # the garbage collector from time to time
-        global _CALLED_TIMES, _GC_COLLECTION_INTERVAL
-        _CALLED_TIMES += 1
-        if _CALLED_TIMES % _GC_COLLECTION_INTERVAL == _GC_COLLECTION_INTERVAL - 1:
-            gc.collect()
+    def _seek_to_frame(self, start_frame):
+        """
+        Seek to the closest keyframe at or before frame index start_frame.
+
+        Returns:
+            int: pts of start_frame; decoded frames before it are to be skipped.
+        """
+        index = self.build_index()
+        pts_table, keyframe_pts = index["pts"], index["keyframe_pts"]
+        start_frame = min(max(int(start_frame), 0), len(pts_table) - 1)
+        target_pts = int(pts_table[start_frame])
+        key = np.searchsorted(keyframe_pts, target_pts, side='right') - 1
+        seek_pts = int(keyframe_pts[key]) if key >= 0 else int(pts_table[0])
+        self.seek(seek_pts, backward=True)
+        return target_pts
+
+    def _iter_frames(self):
+        # decode() keeps no packet objects alive between frames, so frames are freed as soon as
+        # the caller drops them (no reference cycles left for the garbage collector)
+        for frame in self.container.decode(self.video_stream):
+            yield frame
+
+    def frame_size(self, size=None):
+        """
+        (height, width) of decoded frames; size is an int (square) or (height, width) to resize to.
+        """
+        if size is None:
+            return self.video_stream.codec_context.height, self.video_stream.codec_context.width
+        if isinstance(size, int):
+            return size, size
+        return tuple(size)
+
+    def _num_frames_from(self, start_frame, num_frames=None):
+        num_frames = self.num_frames if num_frames is None else num_frames
+        return int(max(0, min(num_frames, self.get_num_frames() - start_frame)))
 
-    def _read_video(self, offset):
-        self._occasional_gc()
+    def iter_rgb(self, start_frame=0, num_frames=None, size=None):
+        """
+        Stream [H, W, 3] uint8 RGB arrays of num_frames frames starting at start_frame.
 
-        pts = self.container.duration * offset
-        time_ = pts / float(av.time_base)
-        self.container.seek(int(pts))
+        Each PyAV frame is converted (and resized when size is given) straight to rgb24 and released
+        before the next one is decoded.
+        """
+        num_frames = self._num_frames_from(start_frame, num_frames)
+        if num_frames == 0:
+            return
+        height, width = self.frame_size(size)
+        target_pts = self._seek_to_frame(start_frame)
 
-        video_frames = []
         count = 0
-        for _, frame in enumerate(self._iter_frames()):
-            if frame.pts * frame.time_base >= time_:
-                video_frames.append(frame)
-                if count >= self.num_frames - 1:
-                    break
-                count += 1
-        return video_frames
+        for frame in self._iter_frames():
+            if frame.pts is None or frame.pts < target_pts:
+                continue
+            rgb = frame.to_ndarray(width=width, height=height, format='rgb24')
+            del frame
+            yield rgb
+            count += 1
+            if count >= num_frames:
+                break
 
-    def _iter_frames(self):
+    def read_into(self, out, start_frame=0, size=None):
+        """
+        Decode len(out) frames starting at start_frame into a preallocated [N, H, W, 3] uint8 buffer.
+
+        Returns:
+            int: number of frames written (less than N when the video ends first).
+        """
+        assert out.dtype == np.uint8 and out.ndim == 4 and out.shape[-1] == 3, "out must be a [N, H, W, 3] uint8 array"
+        if size is None and out.shape[1:3] != self.frame_size():
+            size = out.shape[1:3]
+        count = 0
+        for count, rgb in enumerate(self.iter_rgb(start_frame, len(out), size), start=1):
+            out[count - 1] = rgb
+        return count
+
+    def iter_batches(self, batch_size=16, start_frame=0, num_frames=None, size=None, out=None):
+        """
+        Decode num_frames frames from start_frame in batches.
+
+        Args:
+            batch_size (int): Frames per batch.
+            out (np.ndarray): Optional [batch_size, H, W, 3] uint8 buffer, preallocated here when None.
+
+        Yields:
+            np.ndarray: [B, H, W, 3] views of the same buffer (the last one may be shorter); copy a
+            batch if it has to outlive the next iteration.
+        """
+        if out is None:
+            out = np.empty((batch_size, *self.frame_size(size), 3), dtype=np.uint8)
+        elif size is None:
+            size = out.shape[1:3]
+        count = 0
+        for rgb in self.iter_rgb(start_frame, num_frames, size):
+            out[count] = rgb
+            count += 1
+            if count == len(out):
+                yield out
+                count = 0
+        if count:
+            yield out[:count]
+
+    def _sidecar_path(self):
+        # <index_dir>/<video name>-<hash of its absolute path>.vidx.npz
+        if self.path is None:
+            return None
+        name = os.path.splitext(os.path.basename(self.path))[0]
+        path_hash = hashlib.sha1(os.path.abspath(self.path).encode()).hexdigest()[:16]
+        return os.path.join(self.index_dir, f"{name}-{path_hash}.vidx.npz")
+
+    def build_index(self):
+        """
+        Frame count, per-frame pts table (presentation order) and keyframe pts of the video stream.
+
+        Built once per container by demuxing packets (no decoding) and persisted in index_dir as
+        <video>-<path hash>.vidx.npz, which later opens reuse while the video's size and mtime match.
+        """
+        if self._index is not None:
+            return self._index
+        if self.video_stream is None:
+            self._index = {"pts": np.zeros(0, dtype=np.int64), "keyframe_pts": np.zeros(0, dtype=np.int64)}
+            return self._index
+
+        sidecar_path = self._sidecar_path()
+        stat = os.stat(self.path) if sidecar_path is not None else None
+        if sidecar_path is not None and os.path.exists(sidecar_path):
+            with np.load(sidecar_path) as data:
+                if int(data["size"]) == stat.st_size and int(data["mtime_ns"]) == stat.st_mtime_ns:
+                    self._index = {"pts": data["pts"], "keyframe_pts": data["keyframe_pts"]}
+                    return self._index
+
+        pts, keyframe_pts = [], []
+        self.seek(0, backward=True)
         for packet in self.container.demux(self.video_stream):
-            for frame in packet.decode():
-                yield frame
+            if packet.pts is None:
+                continue
+            pts.append(packet.pts)
+            if packet.is_keyframe:
+                keyframe_pts.append(packet.pts)
+        self._index = {"pts": np.sort(np.array(pts, dtype=np.int64)), "keyframe_pts": np.sort(np.array(keyframe_pts, dtype=np.int64))}
+
+        if sidecar_path is not None:
+            try:
+                os.makedirs(self.index_dir, exist_ok=True)
+                # unique temp name: DataLoader workers may index the same video at once
+                with tempfile.NamedTemporaryFile(dir=self.index_dir, suffix=".tmp", delete=False) as f:
+                    np.savez(f, pts=self._index["pts"], keyframe_pts=self._index["keyframe_pts"], size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                os.replace(f.name, sidecar_path)
+            except OSError as e:
+                warnings.warn(f'VideoReader| cannot cache the frame index in {self.index_dir} ({e}); pass a writable index_dir', RuntimeWarning)
+        return self._index
 
     def _compute_video_stats(self):
         if self.video_stream is None or self.container is None:
             return 0
-        num_of_frames = self.container.streams.video[0].frames
-        if num_of_frames == 0:
-            num_of_frames = self.fps * float(self.container.streams.video[0].duration*self.video_stream.time_base)
-        self.seek(0, backward=False)
-        count = 0
-        time_base = 512
-        for p in self.container.decode(video=0):
-            count = count + 1
-            if count == 1:
-                start_pts = p.pts
-            elif count == 2:
-                time_base = p.pts - start_pts
-                break
+        pts_table = self.build_index()["pts"]
+        num_of_frames = len(pts_table)
+        start_pts = int(pts_table[0]) if num_of_frames > 0 else 0
+        time_base = int(pts_table[1] - pts_table[0]) if num_of_frames > 1 else 512
         return start_pts, time_base, num_of_frames
     
     def _get_video_frame_rate(self):
@@ -120,8 +238,7 @@ class VideoReader():
         sample = dict()
         _, _, total_num_frames = self._compute_video_stats()
         offset = torch.randint(max(1, total_num_frames-self.num_frames-1), [1]).item()
-        video_frames = self._read_video(offset/total_num_frames)
-        video_frames = np.array([np.uint8(f.to_rgb().to_ndarray()) for f in video_frames])
+        video_frames = self.read(start_frame=offset)
         sample["frames"] = video_frames
         sample["frame_idx"] = [offset]
 
@@ -140,18 +257,31 @@ class VideoReader():
 
     def read_frames(self, frame_indices):
         self.num_frames = frame_indices[1] - frame_indices[0]
-        video_frames = self._read_video(frame_indices[0]/self.get_num_frames())
-        video_frames = np.array([
-            np.uint8(video_frames[0].to_rgb().to_ndarray()),
-            np.uint8(video_frames[-1].to_rgb().to_ndarray())
-        ])
+        # only the first and last frame of the range are kept
+        video_frames = np.empty((2, *self.frame_size(), 3), dtype=np.uint8)
+        count = 0
+        for count, rgb in enumerate(self.iter_rgb(frame_indices[0], self.num_frames), start=1):
+            video_frames[0 if count == 1 else 1] = rgb
+        if count == 1:
+            video_frames[1] = video_frames[0]
         return video_frames
 
-    def read(self):
-        video_frames = self._read_video(0)
-        video_frames = np.array([np.uint8(f.to_rgb().to_ndarray()) for f in video_frames])
-        return video_frames
+    def read(self, start_frame=0, num_frames=None, size=None, out=None):
+        """
+        Decode num_frames frames (default: self.num_frames, i.e. the whole video) from start_frame.
+
+        Args:
+            size (int or tuple): Optional output size, square or (height, width); frames are resized during decode.
+            out (np.ndarray): Optional preallocated [N, H, W, 3] uint8 buffer to decode into.
+
+        Returns:
+            np.ndarray: uint8 [N, H, W, 3].
+        """
+        if out is None:
+            out = np.empty((self._num_frames_from(start_frame, num_frames), *self.frame_size(size), 3), dtype=np.uint8)
+        count = self.read_into(out, start_frame, size)
+        return out[:count]
     
     def get_num_frames(self):
         _, _, total_num_frames = self._compute_video_stats()
-        return total_num_frames
\ No newline at end of file
+        return total_num_frames
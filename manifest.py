@@ -0,0 +1,234 @@
+import argparse
+import json
+import os
+import sqlite3
+from contextlib import closing
+from typing import Any, Dict, List, Optional
+
+
+# Compact CelebV-HQ clip manifest.
+# The celebvhq_info.json clip dict (ytb_id, duration window, bbox, 0/1 attribute arrays, emotion)
+# is stored one row per clip in SQLite with the attribute arrays packed into integer bitsets, so
+# the dataset can select clips with SQL filters (action=talk, duration > N...) without parsing or
+# holding the whole json in every DataLoader worker.
+#
+# python manifest.py --json_file ./data/celebvhq_info.json --db ./data/celebvhq_info.db
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS clips (
+    video_id TEXT PRIMARY KEY,
+    ytb_id TEXT,
+    start_sec REAL,
+    end_sec REAL,
+    duration REAL,
+    bbox_top REAL,
+    bbox_bottom REAL,
+    bbox_left REAL,
+    bbox_right REAL,
+    appearance INTEGER,
+    action INTEGER,
+    emotion TEXT,
+    emotion_sep INTEGER,
+    emotion_labels TEXT,
+    version TEXT
+);
+CREATE INDEX IF NOT EXISTS clips_duration ON clips (duration);
+CREATE INDEX IF NOT EXISTS clips_emotion ON clips (emotion);
+"""
+
+
+def pack_bits(flags: List[int]) -> int:
+    # attribute arrays are 0/1 lists; bit i <- flags[i]
+    value = 0
+    for i, flag in enumerate(flags):
+        if flag:
+            value |= 1 << i
+    return value
+
+
+def unpack_bits(value: int, length: int) -> List[int]:
+    return [(value >> i) & 1 for i in range(length)]
+
+
+class ClipManifest:
+    def __init__(self, db_path: str):
+        assert os.path.exists(db_path), f"Manifest {db_path} not found, build it with ClipManifest.from_json"
+        self.db_path = db_path
+        self._connection: Optional[sqlite3.Connection] = None
+        self._pid: Optional[int] = None
+
+        # short-lived connection: nothing is left open in the process that builds the manifest
+        with closing(self._connect()) as connection:
+            meta = dict(connection.execute("SELECT key, value FROM meta").fetchall())
+        self.appearance_mapping: List[str] = json.loads(meta.get("appearance_mapping", "[]"))
+        self.action_mapping: List[str] = json.loads(meta.get("action_mapping", "[]"))
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{os.path.abspath(self.db_path)}?mode=ro", uri=True, check_same_thread=False)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # Opened lazily (read-only) on the first query, and again in any process that didn't open
+        # it: sqlite connections must not be shared with forked DataLoader workers
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = self._connect()
+            self._pid = os.getpid()
+        return self._connection
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+    def reset(self):
+        # Forget a connection inherited through fork (without using it); the next query opens a new one
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_pid"] = None
+        return state
+
+    @classmethod
+    def from_json(cls, json_file: str, db_path: str) -> "ClipManifest":
+        """
+        Convert a CelebV-HQ style json ({"meta_info": ..., "clips": {video_id: ...}}) to a manifest.
+        """
+        with open(json_file, 'r') as f:
+            celebvhq_info = json.load(f)
+
+        tmp_path = db_path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        connection = sqlite3.connect(tmp_path)
+        connection.executescript(SCHEMA)
+
+        meta_info = celebvhq_info.get("meta_info", {})
+        connection.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ("appearance_mapping", json.dumps(meta_info.get("appearance_mapping", []))),
+            ("action_mapping", json.dumps(meta_info.get("action_mapping", []))),
+        ])
+
+        rows = []
+        for video_id, clip in celebvhq_info["clips"].items():
+            duration = clip.get("duration", {})
+            bbox = clip.get("bbox", {})
+            attributes = clip.get("attributes", {})
+            emotion = attributes.get("emotion", {})
+            labels = emotion.get("labels", "")
+            start_sec, end_sec = duration.get("start_sec"), duration.get("end_sec")
+            rows.append((
+                video_id,
+                clip.get("ytb_id"),
+                start_sec,
+                end_sec,
+                end_sec - start_sec if start_sec is not None and end_sec is not None else None,
+                bbox.get("top"), bbox.get("bottom"), bbox.get("left"), bbox.get("right"),
+                pack_bits(attributes.get("appearance", [])),
+                pack_bits(attributes.get("action", [])),
+                # single label per clip, or the json of the per-segment labels when sep_flag is set
+                labels if isinstance(labels, str) else None,
+                int(bool(emotion.get("sep_flag", False))),
+                json.dumps(labels),
+                clip.get("version"),
+            ))
+        connection.executemany(f"INSERT INTO clips VALUES ({', '.join(['?'] * 15)})", rows)
+        connection.commit()
+        connection.close()
+        os.replace(tmp_path, db_path)
+        return cls(db_path)
+
+    @classmethod
+    def open(cls, path: str) -> "ClipManifest":
+        """
+        Open a .db manifest, or the manifest next to a .json (rebuilt when the json is newer).
+        """
+        if not path.endswith(".json"):
+            return cls(path)
+        db_path = os.path.splitext(path)[0] + ".db"
+        if not os.path.exists(db_path) or os.path.getmtime(db_path) < os.path.getmtime(path):
+            return cls.from_json(path, db_path)
+        return cls(db_path)
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM clips").fetchone()[0]
+
+    def __contains__(self, video_id: str) -> bool:
+        return self.connection.execute("SELECT 1 FROM clips WHERE video_id = ?", (video_id,)).fetchone() is not None
+
+    def mask(self, names: List[str], mapping: List[str]) -> int:
+        unknown = [name for name in names if name not in mapping]
+        assert not unknown, f"Unknown attributes {unknown}"
+        return pack_bits([int(name in names) for name in mapping])
+
+    def video_ids(self, actions: List[str] = None, appearance: List[str] = None, emotions: List[str] = None,
+                  min_duration: float = None, max_duration: float = None) -> List[str]:
+        """
+        Clip ids matching all given filters (in insertion order).
+
+        Args:
+            actions (List[str]): Every listed action must be set, e.g. ['talk'].
+            appearance (List[str]): Every listed appearance attribute must be set.
+            emotions (List[str]): Clip emotion label is one of these (single-label clips only).
+            min_duration (float), max_duration (float): Bounds on end_sec - start_sec in seconds.
+        """
+        clauses, params = [], []
+        if actions:
+            clauses.append("(action & ?) = ?")
+            params += [self.mask(actions, self.action_mapping)] * 2
+        if appearance:
+            clauses.append("(appearance & ?) = ?")
+            params += [self.mask(appearance, self.appearance_mapping)] * 2
+        if emotions:
+            clauses.append(f"emotion IN ({', '.join(['?'] * len(emotions))})")
+            params += list(emotions)
+        if min_duration is not None:
+            clauses.append("duration >= ?")
+            params.append(min_duration)
+        if max_duration is not None:
+            clauses.append("duration <= ?")
+            params.append(max_duration)
+
+        query = "SELECT video_id FROM clips"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        return [row[0] for row in self.connection.execute(query + " ORDER BY rowid", params)]
+
+    def get(self, video_id: str) -> Dict[str, Any]:
+        """
+        One clip in the original json layout (as ExtractFrames/EMODataset expect it).
+        """
+        row = self.connection.execute(
+            "SELECT ytb_id, start_sec, end_sec, bbox_top, bbox_bottom, bbox_left, bbox_right, appearance, action, "
+            "emotion_sep, emotion_labels, version FROM clips WHERE video_id = ?", (video_id,)).fetchone()
+        if row is None:
+            raise KeyError(video_id)
+        ytb_id, start_sec, end_sec, top, bottom, left, right, appearance, action, emotion_sep, emotion_labels, version = row
+        return {
+            "ytb_id": ytb_id,
+            "duration": {"start_sec": start_sec, "end_sec": end_sec},
+            "bbox": {"top": top, "bottom": bottom, "left": left, "right": right},
+            "attributes": {
+                "appearance": unpack_bits(appearance, len(self.appearance_mapping)),
+                "action": unpack_bits(action, len(self.action_mapping)),
+                "emotion": {"sep_flag": bool(emotion_sep), "labels": json.loads(emotion_labels)},
+            },
+            "version": version,
+        }
+
+    def __getitem__(self, video_id: str) -> Dict[str, Any]:
+        return self.get(video_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert CelebV-HQ json metadata to a SQLite clip manifest")
+    parser.add_argument("--json_file", type=str, default="./data/overfit.json")
+    parser.add_argument("--db", type=str, default=None, help="defaults to the json path with a .db extension")
+    args = parser.parse_args()
+
+    manifest = ClipManifest.from_json(args.json_file, args.db or os.path.splitext(args.json_file)[0] + ".db")
+    print(f"{len(manifest)} clips -> {manifest.db_path}")
+    print(f"talking clips: {len(manifest.video_ids(actions=['talk']))}")
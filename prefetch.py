@@ -0,0 +1,144 @@
+import queue
+import threading
+import time
+from typing import Any, Iterator
+
+import torch
+
+
+# Host-to-device prefetching for the training loops.
+# A background thread pulls batches from the DataLoader (so collation overlaps compute even
+# with num_workers=0), pins them when a GPU is present and copies them to the device on a side
+# CUDA stream. The training loop only blocks when no batch is ready, and that wait is timed so
+# an input-bound run is easy to spot.
+
+_END = object()
+
+
+def to_device(batch: Any, device: torch.device, non_blocking: bool = False, pin_memory: bool = False) -> Any:
+    """
+    Recursively move the tensors of a (dict/list/tuple) batch to a device.
+    """
+    if isinstance(batch, torch.Tensor):
+        if pin_memory and batch.device.type == 'cpu':
+            batch = batch.pin_memory()
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, dict):
+        return {key: to_device(value, device, non_blocking, pin_memory) for key, value in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(to_device(value, device, non_blocking, pin_memory) for value in batch)
+    return batch
+
+
+def _record_stream(batch: Any, stream: "torch.cuda.Stream"):
+    # Tell the caching allocator the tensors are now used on the compute stream
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for value in batch.values():
+            _record_stream(value, stream)
+    elif isinstance(batch, (list, tuple)):
+        for value in batch:
+            _record_stream(value, stream)
+
+
+class DevicePrefetcher:
+    """
+    Wraps a DataLoader and keeps up to num_prefetch batches staged on the target device.
+
+    Args:
+        data_loader (DataLoader): Source of host batches.
+        device (torch.device): Target device.
+        num_prefetch (int): Batches kept in flight.
+        pin_memory (bool): Pin host tensors before the copy (defaults to True on CUDA).
+
+    Attributes:
+        last_wait (float): Seconds the last step waited for its batch.
+        data_wait (float): Total seconds waited since the last reset_stats().
+        steps (int): Batches handed out since the last reset_stats().
+    """
+    def __init__(self, data_loader, device: torch.device, num_prefetch: int = 2, pin_memory: bool = None):
+        assert num_prefetch > 0, "num_prefetch must be positive"
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.use_cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.pin_memory = self.use_cuda if pin_memory is None else pin_memory
+        self.stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        self._error = None
+        self.reset_stats()
+
+    def __len__(self) -> int:
+        return len(self.data_loader)
+
+    def reset_stats(self):
+        self.last_wait = 0.0
+        self.data_wait = 0.0
+        self.steps = 0
+
+    @property
+    def mean_wait(self) -> float:
+        return self.data_wait / self.steps if self.steps else 0.0
+
+    @staticmethod
+    def _put(out_queue: queue.Queue, item: Any, stop: threading.Event) -> bool:
+        # never block on a full queue the consumer has stopped reading
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self, out_queue: queue.Queue, stop: threading.Event):
+        try:
+            if self.use_cuda:
+                torch.cuda.set_device(self.device)
+            for batch in self.data_loader:
+                if self.use_cuda:
+                    with torch.cuda.stream(self.stream):
+                        batch = to_device(batch, self.device, non_blocking=True, pin_memory=self.pin_memory)
+                        ready = torch.cuda.Event()
+                        ready.record(self.stream)
+                else:
+                    batch = to_device(batch, self.device)
+                    ready = None
+                if not self._put(out_queue, (batch, ready), stop):
+                    return
+        except Exception as e:
+            # re-raised by __iter__ when it reaches the end sentinel
+            self._error = e
+        self._put(out_queue, (_END, None), stop)
+
+    def __iter__(self) -> Iterator[Any]:
+        out_queue: queue.Queue = queue.Queue(maxsize=self.num_prefetch)
+        self._error = None
+        stop = threading.Event()
+        thread = threading.Thread(target=self._worker, args=(out_queue, stop), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                start = time.perf_counter()
+                batch, ready = out_queue.get()
+                self.last_wait = time.perf_counter() - start
+
+                if batch is _END:
+                    if self._error is not None:
+                        error, self._error = self._error, None
+                        raise error
+                    return
+
+                if ready is not None:
+                    current_stream = torch.cuda.current_stream(self.device)
+                    current_stream.wait_event(ready)
+                    _record_stream(batch, current_stream)
+
+                self.data_wait += self.last_wait
+                self.steps += 1
+                yield batch
+        finally:
+            stop.set()
+            thread.join(timeout=1.0)
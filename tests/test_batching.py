@@ -0,0 +1,52 @@
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from batching import AUDIO_SAMPLE_RATE, build_bucket_sampler, stack_collate  # noqa: E402
+
+FPS = {"a": 25.0, "b": 30.0, "c": 25.0, "d": 30.0, "e": 24.0, "f": 25.0}
+N_SAMPLE_FRAMES = 4
+
+
+def emodataset_sample(video_id):
+    # the shapes EMODataset emits in stage2: fixed images, audio_frames of sample_rate / fps samples
+    samples_per_frame = int(round(AUDIO_SAMPLE_RATE / FPS[video_id]))
+    return {
+        "video_id": video_id,
+        "images": torch.zeros(N_SAMPLE_FRAMES, 3, 8, 8),
+        "audio_frames": [torch.zeros(1, 1, samples_per_frame) for _ in range(N_SAMPLE_FRAMES)],
+    }
+
+
+def fake_dataset(tmp_path, stage):
+    metadata_path = str(tmp_path / "video_metadata.json")
+    videos = {video_id: {"num_frames": 100, "height": 720, "width": 1280, "fps": fps} for video_id, fps in FPS.items()}
+    with open(metadata_path, "w") as f:
+        json.dump({"videos": videos}, f)
+    dataset = SimpleNamespace(stage=stage, video_ids=sorted(FPS), video_dir=str(tmp_path))
+    return dataset, metadata_path
+
+
+def test_audio_stage_batches_stack(tmp_path):
+    dataset, metadata_path = fake_dataset(tmp_path, "stage2-temporal-audio")
+    sampler = build_bucket_sampler(dataset, batch_size=2, metadata_path=metadata_path)
+    batches = list(sampler)
+    assert sorted(index for batch in batches for index in batch) == list(range(len(FPS)))
+    for batch in batches:
+        collated = stack_collate([emodataset_sample(dataset.video_ids[index]) for index in batch])
+        assert collated["images"].shape == (len(batch) * N_SAMPLE_FRAMES, 3, 8, 8)
+        assert collated["audio_frames"].shape[0] == len(batch) * N_SAMPLE_FRAMES
+        assert collated["padded_pixels"] == 0
+
+
+def test_stages_without_audio_are_one_bucket(tmp_path):
+    dataset, metadata_path = fake_dataset(tmp_path, "stage1-0-framesencoder")
+    sampler = build_bucket_sampler(dataset, batch_size=4, metadata_path=metadata_path)
+    assert len(sampler.buckets) == 1
+    assert len(sampler) == 2
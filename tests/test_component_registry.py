@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+pipeline_module = pytest.importorskip("EMOAnimationPipeline")
+ComponentRegistry = pipeline_module.ComponentRegistry
+EMOAnimationPipeline = pipeline_module.EMOAnimationPipeline
+
+# no GPU needed: parameters on the meta device show where a component was moved to
+TARGET = torch.device("meta")
+
+
+def registry():
+    components = ComponentRegistry(device="cpu")
+    components.register("encoder", lambda device, dtype: torch.nn.Linear(4, 4).to(device=device, dtype=dtype))
+    components.register("late", lambda device, dtype: torch.nn.Linear(4, 4).to(device=device, dtype=dtype))
+    return components
+
+
+def test_built_and_later_components_follow_to():
+    components = registry()
+    assert components.get("encoder").weight.device.type == "cpu"
+    components.to(TARGET)
+    assert components.get("encoder").weight.device == TARGET
+    assert components.get("late").weight.device == TARGET
+    assert components.stats["encoder"]["device"] == str(TARGET)
+
+
+def test_pipeline_to_moves_the_registry(monkeypatch):
+    # DiffusionPipeline.to moves the registered diffusers modules; only the forwarding is under test here
+    monkeypatch.setattr(pipeline_module.DiffusionPipeline, "to", lambda self, *args, **kwargs: self)
+    monkeypatch.setattr(EMOAnimationPipeline, "device", property(lambda self: TARGET))
+    pipeline = EMOAnimationPipeline.__new__(EMOAnimationPipeline)
+    pipeline.component_registry = registry()
+    encoder = pipeline.component_registry.get("encoder")
+
+    assert pipeline.to(TARGET) is pipeline
+    assert encoder.weight.device == TARGET
+    assert pipeline.component_registry.get("late").weight.device == TARGET
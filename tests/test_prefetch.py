@@ -0,0 +1,48 @@
+import os
+import sys
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from prefetch import DevicePrefetcher  # noqa: E402
+
+
+class FailingLoader:
+    def __init__(self, num_batches):
+        self.num_batches = num_batches
+
+    def __len__(self):
+        return self.num_batches + 1
+
+    def __iter__(self):
+        for index in range(self.num_batches):
+            yield {"x": torch.full((2,), float(index))}
+        raise RuntimeError("broken sample")
+
+
+def test_loader_error_is_raised_after_the_good_batches():
+    # the queue is full of good batches when the loader fails: the worker must not block on it
+    prefetcher = DevicePrefetcher(FailingLoader(4), "cpu", num_prefetch=1)
+    seen = []
+    with pytest.raises(RuntimeError, match="broken sample"):
+        for batch in prefetcher:
+            seen.append(int(batch["x"][0]))
+    assert seen == [0, 1, 2, 3]
+
+
+def test_early_exit_stops_the_worker():
+    prefetcher = DevicePrefetcher(FailingLoader(10), "cpu", num_prefetch=1)
+    threads = threading.active_count()
+    for _ in prefetcher:
+        break
+    assert threading.active_count() == threads
+
+    # a second pass starts from a clean state
+    seen = []
+    with pytest.raises(RuntimeError, match="broken sample"):
+        for batch in prefetcher:
+            seen.append(int(batch["x"][0]))
+    assert seen == list(range(10))
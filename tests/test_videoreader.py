@@ -0,0 +1,78 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+av = pytest.importorskip("av")
+pytest.importorskip("torch")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from magicanimate.utils.videoreader import VideoReader  # noqa: E402
+
+NUM_FRAMES = 40
+GOP = 10
+
+
+def frame_value(index):
+    # flat gray frames whose level encodes the frame index
+    return 20 + index * 5
+
+
+@pytest.fixture
+def video_path(tmp_path):
+    path = str(tmp_path / "clip.mp4")
+    with av.open(path, mode="w") as container:
+        stream = container.add_stream("mpeg4", rate=25)
+        stream.width, stream.height = 64, 48
+        stream.pix_fmt = "yuv420p"
+        stream.gop_size = GOP
+        for index in range(NUM_FRAMES):
+            image = np.full((48, 64, 3), frame_value(index), dtype=np.uint8)
+            for packet in stream.encode(av.VideoFrame.from_ndarray(image, format="rgb24")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    return path
+
+
+def assert_frames(frames, start_frame):
+    for offset, frame in enumerate(frames):
+        assert abs(float(frame.mean()) - frame_value(start_frame + offset)) < 2.0
+
+
+def test_read_decodes_from_start_frame(video_path, tmp_path):
+    reader = VideoReader(video_path, index_dir=str(tmp_path / "index"))
+    assert reader.get_num_frames() == NUM_FRAMES
+
+    frames = reader.read(start_frame=13, num_frames=8)
+    assert frames.shape == (8, 48, 64, 3) and frames.dtype == np.uint8
+    assert_frames(frames, 13)
+
+    resized = reader.read(start_frame=0, num_frames=3, size=32)
+    assert resized.shape == (3, 32, 32, 3)
+    assert_frames(resized, 0)
+
+    # clipped at the end of the video
+    assert len(reader.read(start_frame=NUM_FRAMES - 2, num_frames=8)) == 2
+
+
+def test_iter_batches_covers_the_window(video_path, tmp_path):
+    reader = VideoReader(video_path, index_dir=str(tmp_path / "index"))
+    seen = []
+    for batch in reader.iter_batches(batch_size=6, start_frame=5, num_frames=15):
+        assert len(batch) <= 6
+        seen.extend(batch.copy())
+    assert len(seen) == 15
+    assert_frames(seen, 5)
+
+
+def test_index_sidecar_is_reused(video_path, tmp_path):
+    index_dir = str(tmp_path / "index")
+    VideoReader(video_path, index_dir=index_dir).build_index()
+    assert [name for name in os.listdir(index_dir) if name.endswith(".vidx.npz")]
+    # nothing is written next to the video
+    assert sorted(os.listdir(os.path.dirname(video_path))) == ["clip.mp4", "index"]
+    reader = VideoReader(video_path, index_dir=index_dir)
+    assert len(reader.build_index()["pts"]) == NUM_FRAMES
+    assert_frames(reader.read(start_frame=31, num_frames=2), 31)
@@ -9,7 +9,9 @@ from omegaconf import OmegaConf
 from diffusers import  DDPMScheduler
 from diffusers import UNet2DConditionModel
 from magicanimate.models.unet_controlnet import UNet3DConditionModel
-from Net import EMODataset,ReferenceNet
+from batching import build_bucket_sampler, stack_collate, PaddingWasteMeter
+from prefetch import DevicePrefetcher
+from Net import EMODataset,ReferenceNet,worker_init_fn
 from typing import List, Dict, Any
 from diffusers.models import AutoencoderKL
 # Other imports as necessary
@@ -39,38 +41,6 @@ from Net import FaceLocator, EMODataset, BackboneNetwork, AudioAttentionLayers
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-# works but complicated 
-def gpu_padded_collate(batch: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
-    assert isinstance(batch, list), "Batch should be a list"
-
-    # Unpack and flatten the images, motion frames, and speeds from the batch
-    all_images = []
-  
-
-    for item in batch:
-        all_images.extend(item['images'])
-     
- 
-
-    assert all(isinstance(img, torch.Tensor) for img in all_images), "All images must be PyTorch tensors"
-
-    # Determine the maximum dimensions
-    assert all(img.ndim == 3 for img in all_images), "All images must be 3D tensors"
-    max_height = max(img.shape[1] for img in all_images)
-    max_width = max(img.shape[2] for img in all_images)
-
-    # Pad the images and motion frames
-    padded_images = [F.pad(img, (0, max_width - img.shape[2], 0, max_height - img.shape[1])) for img in all_images]
-
-    # Stack the padded images, motion frames, and speeds
-    images_tensor = torch.stack(padded_images)
-
-
-    # Assert the correct shape of the output tensors
-    assert images_tensor.ndim == 4, "Images tensor should be 4D"
-
-    return {'images': images_tensor}
-
 
 # motion frames + reference image is in next training step. 
 # this is more akin training the unet - like a civitai checkpoint model.
@@ -79,8 +49,11 @@ def train_model(model, vae, data_loader, optimizer, criterion, device, num_epoch
 
     for epoch in range(num_epochs):
         running_loss = 0.0
+        padding_waste = PaddingWasteMeter()
+        data_loader.reset_stats()
 
         for batch in data_loader:
+            padding_waste.update(batch)
             video_frames = batch['images'].to(device)
             
             # Encode the video frames using the frozen VAE
@@ -103,7 +76,7 @@ def train_model(model, vae, data_loader, optimizer, criterion, device, num_epoch
             running_loss += loss.item()
 
         epoch_loss = running_loss / len(data_loader)
-        print(f'Epoch [{epoch+1}/{num_epochs}], Loss: {epoch_loss:.4f}')
+        print(f'Epoch [{epoch+1}/{num_epochs}], Loss: {epoch_loss:.4f}, Padding waste: {padding_waste.waste:.1%}, Data wait: {data_loader.mean_wait * 1000:.1f} ms/step')
 
     return model
 
@@ -128,7 +101,13 @@ def main(cfg: OmegaConf) -> None:
         video_dir=cfg.training.video_data_dir,
         json_file='./data/overfit.json',
         stage='stage1-0-framesencoder',
-        transform=transform
+        transform=transform,
+        shard_dir=cfg.training.get('frame_shard_dir'),
+        face_track_dir=cfg.training.get('face_track_dir'),
+        audio_feature_dir=cfg.training.get('audio_feature_dir'),
+        clip_filter=OmegaConf.to_container(cfg.training.clip_filter) if cfg.training.get('clip_filter') else None,
+        clip_decode=cfg.training.get('clip_decode', False),
+        face_detect_every=cfg.training.get('face_detect_every', 1)
     )
 
     # Configuration and Hyperparameters
@@ -136,7 +115,8 @@ def main(cfg: OmegaConf) -> None:
     learning_rate = 1e-3  # Example learning rate
 
     # Initialize Dataset and DataLoader
-    data_loader = DataLoader(dataset, batch_size=cfg.training.batch_size, shuffle=True, num_workers=cfg.training.num_workers, collate_fn=gpu_padded_collate)
+    batch_sampler = build_bucket_sampler(dataset, cfg.training.batch_size, cfg.training.get('metadata_index', './data/video_metadata.json'))
+    data_loader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=cfg.training.num_workers, collate_fn=stack_collate, worker_init_fn=worker_init_fn, persistent_workers=cfg.training.num_workers > 0)
 
     # Model, Criterion, Optimizer
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -169,7 +149,8 @@ def main(cfg: OmegaConf) -> None:
     optimizer = optim.Adam(model.parameters(), lr=learning_rate)
 
     # Train the model
-    trained_model = train_model(model, vae, data_loader, optimizer, criterion, device, num_epochs, cfg)
+    prefetcher = DevicePrefetcher(data_loader, device, num_prefetch=cfg.training.get('prefetch_batches', 2))
+    trained_model = train_model(model, vae, prefetcher, optimizer, criterion, device, num_epochs, cfg)
 
     # Save the model
     torch.save(trained_model.state_dict(), 'reference_net_model.pth')
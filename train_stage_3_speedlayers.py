@@ -12,7 +12,9 @@ from typing import List, Dict, Any
 # Other imports as necessary
 import torch.optim as optim
 
-from Net import FaceLocator, EMODataset, FramesEncodingVAE, BackboneNetwork, AudioAttentionLayers, SpeedEncoder
+from batching import build_bucket_sampler, stack_collate, PaddingWasteMeter
+from prefetch import DevicePrefetcher
+from Net import FaceLocator, EMODataset, FramesEncodingVAE, BackboneNetwork, AudioAttentionLayers, SpeedEncoder, worker_init_fn
 from decord import AudioReader
 
 
@@ -33,50 +35,19 @@ from decord import AudioReader
 # Output: Final trained EMO model that can generate expressive talking head videos with speed control and refined face regions.
 
 
-def gpu_padded_collate(batch: List[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
-    assert isinstance(batch, list), "Batch should be a list"
-
-    # Unpack and flatten the images and audio frames from the batch
-    all_images = []
-    all_audio_frames = []
-    for item in batch:
-        all_images.extend(item['images'])
-        all_audio_frames.extend(item['audio_frames'])
-
-    assert all(isinstance(img, torch.Tensor) for img in all_images), "All images must be PyTorch tensors"
-    assert all(isinstance(audio, torch.Tensor) for audio in all_audio_frames), "All audio frames must be PyTorch tensors"
-
-    # Determine the maximum dimensions
-    assert all(img.ndim == 3 for img in all_images), "All images must be 3D tensors"
-    max_height = max(img.shape[1] for img in all_images)
-    max_width = max(img.shape[2] for img in all_images)
-
-    # Pad the images
-    padded_images = [F.pad(img, (0, max_width - img.shape[2], 0, max_height - img.shape[1])) for img in all_images]
-
-    # Stack the padded images and audio frames
-    images_tensor = torch.stack(padded_images)
-    audio_frames_tensor = torch.stack(all_audio_frames)
-
-    # Assert the correct shape of the output tensors
-    assert images_tensor.ndim == 4, "Images tensor should be 4D"
-    assert audio_frames_tensor.ndim == 3, "Audio frames tensor should be 3D"
-
-    return {'images': images_tensor, 'audio_frames': audio_frames_tensor}
-
-
-
-
 def train_model(model, data_loader, optimizer, criterion, device, num_epochs, cfg):
     model.train()  # Set the model to training mode
 
     for epoch in range(num_epochs):
         running_loss = 0.0
+        padding_waste = PaddingWasteMeter()
+        data_loader.reset_stats()
 
         for batch in data_loader:
+            padding_waste.update(batch)
             reference_images = batch['images'].to(device)
             audio_frames = batch['audio_frames'].to(device)
-            head_rotation_speeds = batch['head_rotation_speeds'].to(device)
+            head_rotation_speeds = batch['speeds'].to(device)
 
             batch_size = reference_images.size(0)
             total_loss = 0.0
@@ -103,7 +74,7 @@ def train_model(model, data_loader, optimizer, criterion, device, num_epochs, cf
             running_loss += batch_loss
 
         epoch_loss = running_loss / len(data_loader)
-        print(f'Epoch [{epoch+1}/{num_epochs}], Loss: {epoch_loss:.4f}')
+        print(f'Epoch [{epoch+1}/{num_epochs}], Loss: {epoch_loss:.4f}, Padding waste: {padding_waste.waste:.1%}, Data wait: {data_loader.mean_wait * 1000:.1f} ms/step')
 
     return model
 
@@ -134,7 +105,13 @@ def main(cfg: OmegaConf) -> None:
         json_file='./data/overfit.json',
         #json_file='./data/celebvhq_info.json',
         stage='stage3-speedlayers',
-        transform=transform
+        transform=transform,
+        shard_dir=cfg.training.get('frame_shard_dir'),
+        face_track_dir=cfg.training.get('face_track_dir'),
+        audio_feature_dir=cfg.training.get('audio_feature_dir'),
+        clip_filter=OmegaConf.to_container(cfg.training.clip_filter) if cfg.training.get('clip_filter') else None,
+        clip_decode=cfg.training.get('clip_decode', False),
+        face_detect_every=cfg.training.get('face_detect_every', 1)
     )
 
     # Configuration and Hyperparameters
@@ -142,7 +119,8 @@ def main(cfg: OmegaConf) -> None:
     learning_rate = 1e-3  # Example learning rate
 
     # Initialize Dataset and DataLoader
-    data_loader = DataLoader(dataset, batch_size=cfg.training.batch_size, shuffle=True, num_workers=cfg.training.num_workers, collate_fn=gpu_padded_collate)
+    batch_sampler = build_bucket_sampler(dataset, cfg.training.batch_size, cfg.training.get('metadata_index', './data/video_metadata.json'))
+    data_loader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=cfg.training.num_workers, collate_fn=stack_collate, worker_init_fn=worker_init_fn, persistent_workers=cfg.training.num_workers > 0)
 
     # Model, Criterion, Optimizer
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -170,7 +148,8 @@ def main(cfg: OmegaConf) -> None:
     optimizer = optim.Adam(list(backbone_network.parameters()) + list(speed_encoder.parameters()), lr=learning_rate)
 
     # Train the model
-    trained_model = train_model(backbone_network, data_loader, optimizer, criterion, device, num_epochs, cfg)
+    prefetcher = DevicePrefetcher(data_loader, device, num_prefetch=cfg.training.get('prefetch_batches', 2))
+    trained_model = train_model(backbone_network, prefetcher, optimizer, criterion, device, num_epochs, cfg)
 
     # Save the model
     torch.save(trained_model.state_dict(), 'emo_model_stage3.pth')